@@ -1,7 +1,7 @@
 from datetime import datetime
+import functools
 import os
 import json
-import jsonschema
 import sys
 
 
@@ -16,6 +16,50 @@ import sys
 
 """
 
+##############################################################################################################################################
+##############################################################################################################################################
+
+"""
+    Validation of the generated datasets with the minimal JSON schema.
+    The schema is read and the validator is built only once per process
+    (jsonschema is imported only then, as it is slow to load).
+
+"""
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Benchmarking_minimal_datasets_schema.json')
+
+
+@functools.lru_cache(maxsize=None)
+def load_schema():
+    with open(SCHEMA_FILE, 'r') as f:
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=None)
+def get_validator():
+    import jsonschema
+
+    schema = load_schema()
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+def validate_dataset(data):
+    """returns data if it is valid, otherwise reports the error and returns None"""
+    import jsonschema
+
+    error = jsonschema.exceptions.best_match(get_validator().iter_errors(data))
+    if error is None:
+        return data
+    sys.stderr.write("ERROR: JSON schema validation failed. Output json file does not have the correct format:\n" + str(error) + "\n")
+
+
+def validate_many(datasets):
+    """validates all datasets. Returns the list of datasets, with None in
+    place of the invalid ones"""
+    return [validate_dataset(data) for data in datasets]
+
+
 ##############################################################################################################################################
 ##############################################################################################################################################
 
@@ -28,8 +72,11 @@ import sys
     - participant_id - name/OEB-id of the tool which generated the dataset
     - validated(boolean) - whether this file passed the validation script or not
 
+    With validate=False, the dataset is returned without checking it against
+    the schema, e.g. to check all datasets of a file at once with validate_many().
+
 """
-def write_participant_dataset( ID, community, challenges, participant_id, validated):
+def write_participant_dataset( ID, community, challenges, participant_id, validated, validate=True):
 
     if validated == True:
         status = "ok"
@@ -50,17 +97,10 @@ def write_participant_dataset( ID, community, challenges, participant_id, valida
 
     }
 
-    # validate the generated object with the minimal JSON schema
-
-    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Benchmarking_minimal_datasets_schema.json'), 'r') as f:
-        schema = json.load(f)
-
-    try:
-        jsonschema.validate(data, schema)
+    if not validate:
         return data
-
-    except jsonschema.exceptions.ValidationError as ve:
-        sys.stderr.write("ERROR: JSON schema validation failed. Output json file does not have the correct format:\n" + str(ve) + "\n")
+    # validate the generated object with the minimal JSON schema
+    return validate_dataset(data)
 
 
 
@@ -75,8 +115,14 @@ def write_participant_dataset( ID, community, challenges, participant_id, valida
     - metric_value - the numeric value of the metric
     - error - the standard error/deviation for the computed metric (can be 0)
 
+    Additional properties of the metrics, e.g. confidence intervals, can be
+    passed as dict in extra.
+    With validate=False, the dataset is returned without checking it against
+    the schema, e.g. to check all datasets of a file at once with validate_many().
+
 """
-def write_assessment_dataset( ID, community, challenge, participant_id, metric, metric_value, error):
+def write_assessment_dataset( ID, community, challenge, participant_id, metric, metric_value, error, validate=True,
+                              extra=None):
 
     data = {
         "_id": ID,
@@ -90,17 +136,10 @@ def write_assessment_dataset( ID, community, challenge, participant_id, metric,
         "participant_id": participant_id
 
     }
+    if extra:
+        data["metrics"].update(extra)
 
-    # validate the generated object with the minimal JSON schema
-
-    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)),'Benchmarking_minimal_datasets_schema.json'), 'r') as f:
-        schema = json.load(f)
-
-    try:
-        jsonschema.validate(data, schema)
+    if not validate:
         return data
-
-    except jsonschema.exceptions.ValidationError as ve:
-        sys.stderr.write(
-            "ERROR: JSON schema validation failed. Output json file does not have the correct format:\n" + str(
-                ve) + "\n")
\ No newline at end of file
+    # validate the generated object with the minimal JSON schema
+    return validate_dataset(data)
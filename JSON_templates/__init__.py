@@ -1,3 +1,3 @@
-from .JSON_templates import write_assessment_dataset, write_participant_dataset
+from .JSON_templates import write_assessment_dataset, write_participant_dataset, validate_dataset, validate_many
 
-__all__ = [write_assessment_dataset, write_assessment_dataset]
\ No newline at end of file
+__all__ = ["write_assessment_dataset", "write_participant_dataset", "validate_dataset", "validate_many"]
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Runs the python benchmarks (SwissProtIDs, VGNC, FAS) for many participants.
+
+The reference data is loaded once in the main process. The participant
+databases are then evaluated by a pool of forked worker processes that
+share the read-only reference data with the main process. For every
+participant the same raw output files and assessment json stubs are
+written as by the individual benchmark scripts, i.e.::
+
+    <outdir>/SwissProtIDs/SP_<participant>_<strategy>_raw.txt.gz
+    <outdir>/VGNC/VGNC_<participant>_raw.txt.gz
+    <outdir>/FAS/FAS_<participant>_raw.txt.gz
+    <assessment_dir>/<participant>/{SP,VGNC,FAS}.json
+
+Participants are given as paths to their sqlite databases (as created by
+map_relations.py), optionally prefixed with the name of the participant,
+e.g. ``"OMA Groups=oma.db"``. Otherwise, the name of the database file
+without extension is used.
+"""
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+
+import benchmark_stats
+import perf
+import swissprot_benchmark
+import vgnc_benchmark
+from helpers import parse_participant
+
+logger = logging.getLogger("batch-benchmark")
+CHALLENGES = ("SwissProtIDs", "VGNC", "FAS")
+
+# reference data of the challenges. It is set up in the main process
+# before the workers are forked and must not be modified by the workers
+_reference = {}
+
+
+def load_reference_data(conf):
+    if "SwissProtIDs" in conf.challenges:
+        sp_entries = swissprot_benchmark.get_swissprot_entries(conf.mapping, conf.sp_entries)
+        _reference['SwissProtIDs'] = (sp_entries, {
+            strategy: swissprot_benchmark.get_strategy(strategy, sp_entries, conf.mapping, conf.sp_entries,
+                                                       conf.lineage_tree)
+            for strategy in conf.strategy})
+    if "VGNC" in conf.challenges:
+        _reference['VGNC'] = vgnc_benchmark.get_vgnc_orthologs(conf.vgnc_orthologs)
+    if "FAS" in conf.challenges:
+        import fas_benchmark
+        _reference['FAS'] = fas_benchmark.load_fas_reference(Path(conf.fas_precomputed_scores),
+                                                             Path(conf.fas_data))
+
+
+def run_participant(participant, db, conf):
+    """runs all challenges for one participant. This function is executed
+    in the worker processes."""
+    stub_dir = os.path.join(conf.assessment_dir, participant.replace(' ', '-'))
+    os.makedirs(stub_dir, exist_ok=True)
+    bootstrap = benchmark_stats.bootstrap_from_args(conf)
+    with perf.session("batch_benchmark:{}".format(participant), stub_dir):
+        if "SwissProtIDs" in conf.challenges:
+            sp_entries, strategies = _reference['SwissProtIDs']
+            for name, strategy in strategies.items():
+                outfn_path = swissprot_benchmark.raw_output_fname(os.path.join(conf.outdir, "SwissProtIDs"),
+                                                                  participant, name)
+                assessment_out = "SP.json" if len(strategies) == 1 else "SP_{}.json".format(name)
+                with perf.phase("SwissProtIDs ({})".format(name)):
+                    swissprot_benchmark.run_benchmark(sp_entries, strategy, db, outfn_path,
+                                                      os.path.join(stub_dir, assessment_out), conf.com, participant,
+                                                      bootstrap=bootstrap)
+        if "VGNC" in conf.challenges:
+            outfn_path = vgnc_benchmark.raw_output_fname(os.path.join(conf.outdir, "VGNC"), participant)
+            with perf.phase("VGNC"):
+                vgnc_benchmark.run_benchmark(_reference['VGNC'], db, outfn_path, os.path.join(stub_dir, "VGNC.json"),
+                                             conf.com, participant, bootstrap=bootstrap)
+        if "FAS" in conf.challenges:
+            import fas_benchmark
+            outfn_path = fas_benchmark.raw_output_fname(Path(conf.outdir) / "FAS", participant)
+            with perf.phase("FAS"):
+                fas_benchmark.run_benchmark(Path(conf.fas_precomputed_scores), Path(conf.fas_data), Path(db),
+                                            conf.fas_cpus, outfn_path, os.path.join(stub_dir, "FAS.json"),
+                                            conf.com, participant, reference=_reference['FAS'], bootstrap=bootstrap)
+
+
+def _run_participant_task(args):
+    participant, db, conf = args
+    try:
+        run_participant(participant, db, conf)
+    except Exception:
+        logger.exception("benchmarking {} failed".format(participant))
+        return participant, False
+    logger.info("finished benchmarks of {}".format(participant))
+    return participant, True
+
+
+def run_batch(participants, conf):
+    """runs the benchmarks for a list of (participant, db_path) tuples and
+    returns the list of participants that failed"""
+    for challenge in conf.challenges:
+        os.makedirs(os.path.join(conf.outdir, challenge), exist_ok=True)
+    with perf.phase("reference load"):
+        load_reference_data(conf)
+    tasks = [(participant, db, conf) for participant, db in participants]
+    nr_procs = min(conf.procs, len(tasks))
+    if nr_procs <= 1:
+        results = map(_run_participant_task, tasks)
+    else:
+        pool = multiprocessing.get_context("fork").Pool(nr_procs)
+        results = pool.imap_unordered(_run_participant_task, tasks)
+    failed = [participant for participant, ok in results if not ok]
+    if nr_procs > 1:
+        pool.close()
+        pool.join()
+    return failed
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the SwissProtIDs, VGNC and FAS benchmarks for many "
+                                                 "participants sharing the reference data")
+    parser.add_argument('participants', nargs="+",
+                        help="sqlite databases with the pairwise predictions of the participants, optionally "
+                             "prefixed with the participant name, e.g. \"OMA Groups=oma.db\"")
+    parser.add_argument('--challenges', nargs="+", choices=CHALLENGES, default=["SwissProtIDs", "VGNC"],
+                        help="challenges to run. FAS requires the FAS tools to be installed")
+    parser.add_argument('--com', required=True, help="community id")
+    parser.add_argument('--outdir', required=True, help="Folder to store the raw output files in. A subfolder "
+                                                        "per challenge is created")
+    parser.add_argument('--assessment-dir', required=True,
+                        help="Folder where the assessment json files will be stored, one subfolder per participant")
+    parser.add_argument('--mapping', help="Path to mapping.json of proper QfO dataset")
+    parser.add_argument('--sp-entries', help="Path to textfile with SwissProt IDs")
+    parser.add_argument('--strategy', nargs="+", choices=("simple", "clade_limit", "ids_exist_in_both"),
+                        default=["ids_exist_in_both"], help="SwissProtIDs benchmark strategies to use")
+    parser.add_argument('--lineage-tree', help="path to lineage tree in phyloxml format. Used for clade_limit "
+                                               "strategy only")
+    parser.add_argument('--vgnc-orthologs', help="Path to text file with VGNC asserted orthologs")
+    parser.add_argument('--fas-precomputed-scores', help="Path to json file with precomputed FAS scores")
+    parser.add_argument('--fas-data', help="Path to the input data of protein to feature architecture mapping")
+    parser.add_argument('--fas-cpus', type=int, default=1, help="nr of cpus fas uses for each participant")
+    parser.add_argument('-p', '--procs', type=int, default=multiprocessing.cpu_count(),
+                        help="number of participants to evaluate in parallel. Defaults to all available cpus")
+    benchmark_stats.add_bootstrap_arguments(parser)
+    parser.add_argument('--log', help="Path to log file. Defaults to stderr")
+    parser.add_argument('-d', '--debug', action="store_true", help="Set logging to debug level")
+    conf = parser.parse_args()
+
+    log_conf = {'level': logging.INFO, 'format': "%(asctime)-15s %(processName)s %(levelname)-7s: %(message)s"}
+    if conf.log is not None:
+        log_conf['filename'] = conf.log
+    if conf.debug:
+        log_conf['level'] = logging.DEBUG
+    logging.basicConfig(**log_conf)
+    logger.info("running batch_benchmark with following arguments: {}".format(conf))
+
+    required = {"SwissProtIDs": ("mapping", "sp_entries"), "VGNC": ("vgnc_orthologs",),
+                "FAS": ("fas_precomputed_scores", "fas_data")}
+    for challenge in conf.challenges:
+        for arg in required[challenge]:
+            if getattr(conf, arg) is None:
+                parser.error("--{} is required for the {} challenge".format(arg.replace('_', '-'), challenge))
+
+    perf.start("batch_benchmark", conf.assessment_dir)
+    failed = run_batch([parse_participant(p) for p in conf.participants], conf)
+    if failed:
+        perf.exit("ERROR: benchmarks failed for {}".format(", ".join(failed)))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Runs the python benchmarks (SwissProtIDs, VGNC, FAS) of one participant
+concurrently in a single process.
+
+The pairwise predictions of the participant are loaded once from the
+sqlite database into a shared in-memory database, which all challenges
+query from a pool of threads. The challenges write the same raw output
+files and assessment json stubs as the individual benchmark scripts::
+
+    <outdir>/SwissProtIDs/SP_<participant>_<strategy>_raw.txt.gz
+    <outdir>/VGNC/VGNC_<participant>_raw.txt.gz
+    <outdir>/FAS/FAS_<participant>_raw.txt.gz
+    <assessment_dir>/{SP,VGNC,FAS}.json
+
+If several SwissProtIDs strategies are evaluated, the stubs are named
+SP_<strategy>.json instead.
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+
+import benchmark_stats
+import perf
+import swissprot_benchmark
+import vgnc_benchmark
+from helpers import load_db_into_memory
+
+logger = logging.getLogger("benchmark-runner")
+CHALLENGES = ("SwissProtIDs", "VGNC", "FAS")
+
+
+def run_vgnc(db, conf):
+    vgnc_orthologs = vgnc_benchmark.get_vgnc_orthologs(conf.vgnc_orthologs)
+    outfn_path = vgnc_benchmark.raw_output_fname(os.path.join(conf.outdir, "VGNC"), conf.participant)
+    return vgnc_benchmark.run_benchmark(vgnc_orthologs, db, outfn_path,
+                                        os.path.join(conf.assessment_dir, "VGNC.json"), conf.com, conf.participant,
+                                        bootstrap=benchmark_stats.bootstrap_from_args(conf))
+
+
+def run_fas(db, conf):
+    import fas_benchmark
+    outfn_path = fas_benchmark.raw_output_fname(Path(conf.outdir) / "FAS", conf.participant)
+    return fas_benchmark.run_benchmark(Path(conf.fas_precomputed_scores), Path(conf.fas_data), db, conf.fas_cpus,
+                                       outfn_path, os.path.join(conf.assessment_dir, "FAS.json"),
+                                       conf.com, conf.participant, bootstrap=benchmark_stats.bootstrap_from_args(conf))
+
+
+def run_swissprot(db, sp_entries, strategy_name, conf):
+    strategy = swissprot_benchmark.get_strategy(strategy_name, sp_entries, conf.mapping, conf.sp_entries,
+                                                conf.lineage_tree)
+    outfn_path = swissprot_benchmark.raw_output_fname(os.path.join(conf.outdir, "SwissProtIDs"),
+                                                      conf.participant, strategy_name)
+    assessment_out = "SP.json" if len(conf.strategy) == 1 else "SP_{}.json".format(strategy_name)
+    return swissprot_benchmark.run_benchmark(sp_entries, strategy, db, outfn_path,
+                                             os.path.join(conf.assessment_dir, assessment_out),
+                                             conf.com, conf.participant,
+                                             bootstrap=benchmark_stats.bootstrap_from_args(conf))
+
+
+def _in_phase(name, func, *args):
+    # the threads of the pool record their phases below the challenge name
+    with perf.phase(name):
+        return func(*args)
+
+
+def run_challenges(conf):
+    """runs all requested challenges and returns the list of failed ones"""
+    for challenge in conf.challenges:
+        os.makedirs(os.path.join(conf.outdir, challenge), exist_ok=True)
+    os.makedirs(conf.assessment_dir, exist_ok=True)
+
+    with perf.phase("database load", bytes=os.path.getsize(conf.db)):
+        db, keeper = load_db_into_memory(conf.db)
+    logger.info("loaded {} into in-memory database".format(conf.db))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=conf.threads) as ex:
+            futures = {}
+            if "VGNC" in conf.challenges:
+                futures[ex.submit(_in_phase, "VGNC", run_vgnc, db, conf)] = "VGNC"
+            if "FAS" in conf.challenges:
+                futures[ex.submit(_in_phase, "FAS", run_fas, db, conf)] = "FAS"
+            if "SwissProtIDs" in conf.challenges:
+                # the swissprot entries are shared among all strategies
+                with perf.phase("reference load"):
+                    sp_entries = swissprot_benchmark.get_swissprot_entries(conf.mapping, conf.sp_entries)
+                for strategy_name in conf.strategy:
+                    name = "SwissProtIDs ({})".format(strategy_name)
+                    futures[ex.submit(_in_phase, name, run_swissprot, db, sp_entries, strategy_name, conf)] = name
+            failed = []
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                    logger.info("finished {} challenge".format(futures[future]))
+                except Exception:
+                    logger.exception("{} challenge failed".format(futures[future]))
+                    failed.append(futures[future])
+    finally:
+        keeper.close()
+    return failed
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the SwissProtIDs, VGNC and FAS benchmarks of a participant "
+                                                 "concurrently in one process")
+    parser.add_argument('--db', required=True, help="Path to sqlite database with pairwise predictions")
+    parser.add_argument('--participant', required=True, help="Name of participant method")
+    parser.add_argument('--com', required=True, help="community id")
+    parser.add_argument('--challenges', nargs="+", choices=CHALLENGES, default=["SwissProtIDs", "VGNC"],
+                        help="challenges to run. FAS requires the FAS tools to be installed")
+    parser.add_argument('--outdir', required=True, help="Folder to store the raw output files in. A subfolder "
+                                                        "per challenge is created")
+    parser.add_argument('--assessment-dir', required=True, help="Folder where the assessment json files will be "
+                                                                "stored")
+    parser.add_argument('--mapping', help="Path to mapping.json of proper QfO dataset")
+    parser.add_argument('--sp-entries', help="Path to textfile with SwissProt IDs")
+    parser.add_argument('--strategy', nargs="+", choices=("simple", "clade_limit", "ids_exist_in_both"),
+                        default=["ids_exist_in_both"], help="SwissProtIDs benchmark strategies to use")
+    parser.add_argument('--lineage-tree', help="path to lineage tree in phyloxml format. Used for clade_limit "
+                                               "strategy only")
+    parser.add_argument('--vgnc-orthologs', help="Path to text file with VGNC asserted orthologs")
+    parser.add_argument('--fas-precomputed-scores', help="Path to json file with precomputed FAS scores")
+    parser.add_argument('--fas-data', help="Path to the input data of protein to feature architecture mapping")
+    parser.add_argument('--fas-cpus', type=int, default=multiprocessing.cpu_count(),
+                        help="nr of cpus to use for computing missing FAS scores")
+    parser.add_argument('--threads', type=int, default=4, help="number of challenges to run concurrently")
+    benchmark_stats.add_bootstrap_arguments(parser)
+    parser.add_argument('--log', help="Path to log file. Defaults to stderr")
+    parser.add_argument('-d', '--debug', action="store_true", help="Set logging to debug level")
+    conf = parser.parse_args()
+
+    log_conf = {'level': logging.INFO, 'format': "%(asctime)-15s %(threadName)s %(levelname)-7s: %(message)s"}
+    if conf.log is not None:
+        log_conf['filename'] = conf.log
+    if conf.debug:
+        log_conf['level'] = logging.DEBUG
+    logging.basicConfig(**log_conf)
+    logger.info("running benchmark_runner with following arguments: {}".format(conf))
+
+    required = {"SwissProtIDs": ("mapping", "sp_entries"), "VGNC": ("vgnc_orthologs",),
+                "FAS": ("fas_precomputed_scores", "fas_data")}
+    for challenge in conf.challenges:
+        for arg in required[challenge]:
+            if getattr(conf, arg) is None:
+                parser.error("--{} is required for the {} challenge".format(arg.replace('_', '-'), challenge))
+
+    perf.start("benchmark_runner", conf.assessment_dir)
+    failed = run_challenges(conf)
+    if failed:
+        perf.exit("ERROR: {} failed".format(", ".join(failed)))
@@ -0,0 +1,259 @@
+"""Breakdown of the SwissProtIDs and VGNC benchmark results per species pair.
+
+The benchmarks count the TP, FP and FN relations of every unordered pair
+of species while they write their raw output. The counts are stored as
+a (kind, species, species) array in ``<base>_species_pairs.npz``, where
+only the upper triangle (including the diagonal) is used. A small json
+summary with the counts and rates per species pair and per species is
+written to ``<base>_species_pairs.json``::
+
+    counts = SpeciesPairCounts()
+    counts.add("TP", "HUMAN", "MOUSE")
+    ...
+    counts.save(species_pairs_fname(raw_out_fn))
+
+Optionally, the benchmarks also compute bootstrap confidence intervals of
+their metrics (see Bootstrap). Relations of the same family are not
+independent, so families (or proteins) are resampled instead of single
+relations. The intervals are added as "bootstrap" to the metrics of the
+assessment stubs, next to the existing stderr.
+"""
+import array
+import json
+import logging
+
+# numpy is only imported once counts are collected, so that the --help of
+# the benchmark scripts does not load it
+logger = logging.getLogger("benchmark-stats")
+KINDS = ("TP", "FP", "FN")
+
+
+def species_pairs_fname(raw_fname):
+    """returns the base name of the species pair files of a raw output
+    file, e.g. SP_method_simple_raw.txt.gz --> SP_method_simple_species_pairs"""
+    base = str(raw_fname)
+    for ext in (".gz", ".txt", "_raw"):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+    return base + "_species_pairs"
+
+
+def _rate(num, denom):
+    return num / denom if denom > 0 else None
+
+
+class SpeciesPairCounts:
+    """Counts of the benchmark relations per kind and unordered species pair.
+
+    Relations are buffered as species indices and added to the count
+    array in blocks of flush_size relations."""
+
+    def __init__(self, species=(), kinds=KINDS, flush_size=1 << 16):
+        import numpy
+        self.species = []
+        self._species_idx = {}
+        self.kinds = tuple(kinds)
+        self._kind_idx = {kind: k for k, kind in enumerate(self.kinds)}
+        self.flush_size = flush_size
+        self.counts = numpy.zeros((len(self.kinds), 0, 0), dtype="int64")
+        self._pending = [[] for _ in self.kinds]
+        self._nr_pending = 0
+        for sp in species:
+            self._index(sp)
+
+    def _index(self, species):
+        try:
+            return self._species_idx[species]
+        except KeyError:
+            idx = self._species_idx[species] = len(self.species)
+            self.species.append(species)
+            return idx
+
+    def add(self, kind, species1, species2):
+        i, j = self._index(species1), self._index(species2)
+        self._pending[self._kind_idx[kind]].append((i, j) if i <= j else (j, i))
+        self._nr_pending += 1
+        if self._nr_pending >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        import numpy
+        n = len(self.species)
+        if n > self.counts.shape[1]:
+            grow = n - self.counts.shape[1]
+            self.counts = numpy.pad(self.counts, ((0, 0), (0, grow), (0, grow)))
+        for k, pending in enumerate(self._pending):
+            if not pending:
+                continue
+            pairs = numpy.array(pending, dtype="int64")
+            self.counts[k] += numpy.bincount(pairs[:, 0] * n + pairs[:, 1], minlength=n * n).reshape(n, n)
+            pending.clear()
+        self._nr_pending = 0
+
+    def totals(self):
+        self.flush()
+        return {kind: int(self.counts[k].sum()) for k, kind in enumerate(self.kinds)}
+
+    def summary(self):
+        """returns the counts, TPR and PPV per species pair with at least
+        one relation and per species"""
+        import numpy
+        self.flush()
+        per_kind = dict(zip(self.kinds, self.counts))
+
+        def rates(entry):
+            if "TP" in entry:
+                entry["TPR"] = _rate(entry["TP"], entry["TP"] + entry.get("FN", 0))
+                entry["PPV"] = _rate(entry["TP"], entry["TP"] + entry.get("FP", 0))
+            return entry
+
+        pairs = []
+        for i, j in zip(*numpy.nonzero(self.counts.sum(axis=0))):
+            entry = {"species1": self.species[i], "species2": self.species[j]}
+            entry.update((kind, int(per_kind[kind][i, j])) for kind in self.kinds)
+            pairs.append(rates(entry))
+        per_species = []
+        for i, sp in enumerate(self.species):
+            entry = {"species": sp}
+            # relations within the species are only counted once
+            entry.update((kind, int(per_kind[kind][i, :].sum() + per_kind[kind][:, i].sum() - per_kind[kind][i, i]))
+                         for kind in self.kinds)
+            per_species.append(rates(entry))
+        return {"kinds": list(self.kinds), "totals": rates(self.totals()),
+                "species_pairs": pairs, "species": per_species}
+
+    def save(self, base):
+        """writes the counts to base.npz and the summary to base.json"""
+        import numpy
+        self.flush()
+        with open(base + ".npz", 'wb') as fh:
+            numpy.savez_compressed(fh, species=numpy.array(self.species, dtype="U"),
+                                   kinds=numpy.array(self.kinds, dtype="U"), counts=self.counts)
+        with open(base + ".json", 'wt') as fh:
+            json.dump(self.summary(), fh, sort_keys=True, indent=4, separators=(',', ': '))
+        logger.info("written counts of {} species pairs to {}.npz".format(
+            int(numpy.count_nonzero(self.counts.sum(axis=0))), base))
+
+    @classmethod
+    def load(cls, fname):
+        import numpy
+        with numpy.load(fname) as data:
+            obj = cls(species=data['species'].tolist(), kinds=data['kinds'].tolist())
+            obj.counts = data['counts'].astype("int64")
+        return obj
+
+
+class UnitCounts:
+    """Number of relations of each kind per resampling unit (e.g. family
+    or protein), used for the bootstrap of the rates."""
+
+    def __init__(self, kinds=KINDS):
+        self.kinds = tuple(kinds)
+        self._kind_idx = {kind: k for k, kind in enumerate(self.kinds)}
+        self.units = {}
+        self._unit_idx = [array.array('l') for _ in self.kinds]
+
+    def add(self, kind, unit):
+        idx = self.units.setdefault(unit, len(self.units))
+        self._unit_idx[self._kind_idx[kind]].append(idx)
+
+    def counts(self):
+        """returns a dict with an array of counts per unit for every kind"""
+        import numpy
+        n = len(self.units)
+        return {kind: numpy.bincount(numpy.frombuffer(idx, dtype=idx.typecode), minlength=n)
+                for kind, idx in zip(self.kinds, self._unit_idx)}
+
+
+class Bootstrap:
+    """Bootstrap confidence intervals of the benchmark metrics.
+
+    The units (families or proteins) are resampled with replacement and
+    the precomputed per-unit counts or score sums of the drawn units are
+    added up. The replicates are drawn as index arrays in chunks of at
+    most max_chunk_elements, so thousands of them take a few seconds.
+    The results are dicts with the percentile interval (ci_low, ci_high)
+    and the standard deviation of the replicates (stderr)."""
+    UNITS = ("family", "protein")
+
+    def __init__(self, replicates=1000, unit="family", confidence=0.95, seed=None, max_chunk_elements=1 << 24):
+        if unit not in self.UNITS:
+            raise ValueError("invalid bootstrap unit: {}".format(unit))
+        self.replicates = replicates
+        self.unit = unit
+        self.confidence = confidence
+        self.seed = seed
+        self.max_chunk_elements = max_chunk_elements
+
+    def _resample(self, nr_units, *per_unit):
+        """returns for each array in per_unit the sums over the resampled
+        units of all replicates"""
+        import numpy
+        rng = numpy.random.default_rng(self.seed)
+        chunk = max(1, min(self.replicates, self.max_chunk_elements // max(nr_units, 1)))
+        per_unit = [numpy.asarray(values) for values in per_unit]
+        res = [numpy.empty(self.replicates) for _ in per_unit]
+        for start in range(0, self.replicates, chunk):
+            size = min(chunk, self.replicates - start)
+            sample = rng.integers(0, nr_units, size=(size, nr_units))
+            for out, values in zip(res, per_unit):
+                out[start:start + size] = values[sample].sum(axis=1)
+        return res
+
+    def _interval(self, replicates, nr_units, unit):
+        """returns the interval of the replicates, ignoring undefined ones
+        (e.g. no positives drawn). None if all are undefined"""
+        import numpy
+        replicates = replicates[numpy.isfinite(replicates)]
+        if len(replicates) == 0:
+            return None
+        alpha = (1 - self.confidence) / 2
+        low, high = numpy.percentile(replicates, [100 * alpha, 100 * (1 - alpha)])
+        stderr = replicates.std(ddof=1) if len(replicates) > 1 else 0.0
+        return {"ci_low": float(low), "ci_high": float(high), "stderr": float(stderr),
+                "confidence": self.confidence, "replicates": self.replicates, "unit": unit,
+                "nr_units": nr_units}
+
+    def rates(self, unit_counts):
+        """returns the intervals of TPR and PPV from a UnitCounts object"""
+        import numpy
+        counts = unit_counts.counts()
+        nr_units = len(unit_counts.units)
+        if nr_units == 0:
+            return {}
+        tp, fp, fn = self._resample(nr_units, counts["TP"], counts["FP"], counts["FN"])
+        with numpy.errstate(all="ignore"):
+            intervals = {"TPR": self._interval(tp / (tp + fn), nr_units, self.unit),
+                         "PPV": self._interval(tp / (tp + fp), nr_units, self.unit)}
+        return {name: interval for name, interval in intervals.items() if interval is not None}
+
+    def mean(self, values, units, unit=None):
+        """returns the interval of the mean of values, where units holds
+        the unit index of every value. unit names the kind of the units
+        if it differs from the configured one"""
+        import numpy
+        values = numpy.asarray(values, dtype="float")
+        units = numpy.asarray(units, dtype="int64")
+        if len(values) == 0:
+            return None
+        nr_units = int(units.max()) + 1
+        sums, nrs = self._resample(nr_units, numpy.bincount(units, weights=values, minlength=nr_units),
+                                   numpy.bincount(units, minlength=nr_units).astype("float"))
+        with numpy.errstate(all="ignore"):
+            return self._interval(sums / nrs, nr_units, unit or self.unit)
+
+
+def add_bootstrap_arguments(parser):
+    parser.add_argument('--bootstrap', type=int, default=0, metavar="N",
+                        help="compute bootstrap confidence intervals of the metrics with N replicates")
+    parser.add_argument('--bootstrap-unit', choices=Bootstrap.UNITS, default="family",
+                        help="unit to resample for the bootstrap. FAS always resamples proteins")
+    parser.add_argument('--bootstrap-seed', type=int, help="seed of the bootstrap resampling")
+
+
+def bootstrap_from_args(conf):
+    """returns the Bootstrap settings of the parsed command line arguments,
+    or None if no bootstrap is requested"""
+    if not getattr(conf, 'bootstrap', 0):
+        return None
+    return Bootstrap(replicates=conf.bootstrap, unit=conf.bootstrap_unit, seed=conf.bootstrap_seed)
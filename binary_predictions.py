@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Binary submission format for pairwise ortholog predictions.
+
+Predictions stored in this format are already mapped to the prot_nrs of a
+reference release, so they can be loaded without parsing and id mapping.
+All integers are little-endian. A file consists of
+
+    magic        8 bytes   b"QFOPAIRS"
+    version      uint16    format version, currently 1
+    header_len   uint32    length of the header in bytes
+    header       utf-8 encoded json object with the keys
+                   release              reference release name, e.g. "2022"
+                   mapping_fingerprint  ReferenceProteomes.fingerprint() of the
+                                        mapping used for the conversion
+                   nr_proteins          number of proteins in the release
+    blocks       repeated, each consisting of
+                   nr_pairs    uint32, at most BLOCK_PAIRS
+                   data_len    uint32
+                   data        zlib compressed int32 array of shape
+                               (nr_pairs, 2) with (min, max) prot_nr pairs
+    end marker   a block with nr_pairs = 0 and data_len = 0
+
+Pairs are deduplicated within a block, but may repeat across blocks.
+
+Files can be converted from tsv or orthoxml with::
+
+    binary_predictions.py --release 2022 mapping.json.gz predictions.tsv.gz predictions.qfo
+"""
+import json
+import logging
+import os
+import struct
+import zlib
+
+import numpy
+
+import perf
+
+logger = logging.getLogger("binary-predictions")
+
+MAGIC = b"QFOPAIRS"
+FORMAT_VERSION = 1
+BLOCK_PAIRS = 1 << 20
+_PREAMBLE = struct.Struct("<8sHI")
+_BLOCK = struct.Struct("<II")
+
+
+def is_binary_predictions(head):
+    """checks whether the first bytes of a file are the magic bytes of the format"""
+    return head.startswith(MAGIC)
+
+
+class BinaryPredictionsWriter:
+    """Writes pairwise orthologs in the binary submission format.
+
+    It offers the same add_orthologs / add_ortholog_block interface as
+    map_relations.DatabaseInterface, so the parsers of map_relations can
+    write into it directly."""
+
+    def __init__(self, fname, refset, release):
+        self.fname = fname
+        self.header = {'release': release,
+                       'mapping_fingerprint': refset.fingerprint(),
+                       'nr_proteins': refset.nr_proteins}
+        self.nr_pairs = 0
+        self._pair_buffer = []
+
+    def __enter__(self):
+        self.fh = open(self.fname, 'wb')
+        header = json.dumps(self.header).encode('utf-8')
+        self.fh.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        self.fh.write(header)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            # do not leave a seemingly complete file behind
+            self.fh.close()
+            os.remove(self.fname)
+            return
+        self.flush()
+        self.fh.write(_BLOCK.pack(0, 0))
+        self.fh.close()
+        logger.info("written {} pairs to {}".format(self.nr_pairs, self.fname))
+
+    def add_orthologs(self, p1, p2):
+        self._pair_buffer.append((p1, p2))
+        if len(self._pair_buffer) >= BLOCK_PAIRS:
+            self.flush()
+
+    def add_ortholog_block(self, pairs):
+        for start in range(0, len(pairs), BLOCK_PAIRS):
+            self._write_block(pairs[start:start + BLOCK_PAIRS])
+
+    def flush(self):
+        if len(self._pair_buffer) > 0:
+            self._write_block(numpy.array(self._pair_buffer, dtype="int32"))
+            self._pair_buffer = []
+
+    def _write_block(self, pairs):
+        pairs = numpy.asarray(pairs, dtype="int64")
+        keys = numpy.unique(pairs.min(axis=1) << 32 | pairs.max(axis=1))
+        if len(keys) == 0:
+            return
+        block = numpy.column_stack((keys >> 32, keys & 0xFFFFFFFF)).astype("<i4")
+        data = zlib.compress(block.tobytes(), 1)
+        self.fh.write(_BLOCK.pack(len(block), len(data)))
+        self.fh.write(data)
+        self.nr_pairs += len(block)
+
+
+def read_header(fh):
+    magic, version, header_len = _PREAMBLE.unpack(fh.read(_PREAMBLE.size))
+    if magic != MAGIC:
+        raise ValueError("not a binary predictions file")
+    if version != FORMAT_VERSION:
+        raise ValueError("unsupported binary predictions format version {}".format(version))
+    return json.loads(fh.read(header_len).decode('utf-8'))
+
+
+def iter_blocks(fh):
+    """yields the pair blocks of a file handle positioned after the header
+    as int32 arrays of shape (n, 2)"""
+    while True:
+        buf = fh.read(_BLOCK.size)
+        if len(buf) < _BLOCK.size:
+            raise ValueError("truncated binary predictions file")
+        nr_pairs, data_len = _BLOCK.unpack(buf)
+        if nr_pairs == 0 and data_len == 0:
+            return
+        if nr_pairs > BLOCK_PAIRS:
+            raise ValueError("block of {} pairs exceeds the maximum of {}".format(nr_pairs, BLOCK_PAIRS))
+        data = fh.read(data_len)
+        if len(data) < data_len:
+            raise ValueError("truncated binary predictions file")
+        # the output is limited to the announced size, so a small block
+        # cannot be decompressed into gigabytes of data
+        expected = 8 * nr_pairs
+        dec = zlib.decompressobj()
+        try:
+            raw = dec.decompress(data, expected)
+        except zlib.error as e:
+            raise ValueError("corrupt block in binary predictions file: {}".format(e))
+        if len(raw) != expected or dec.unconsumed_tail or dec.unused_data or not dec.eof:
+            raise ValueError("corrupt block in binary predictions file")
+        yield numpy.frombuffer(raw, dtype="<i4").reshape(-1, 2)
+
+
+def check_compatible(header, refset):
+    """raises a ValueError if the predictions were not converted with the
+    mapping of the given reference proteomes"""
+    if header.get('mapping_fingerprint') != refset.fingerprint():
+        raise ValueError("predictions were converted for a different reference release ({})"
+                         .format(header.get('release')))
+
+
+if __name__ == "__main__":
+    import argparse
+    from refset import ReferenceProteomes
+    import map_relations
+
+    parser = argparse.ArgumentParser(description="Convert tsv or orthoxml predictions into the binary "
+                                                 "submission format")
+    parser.add_argument('mapping', help="Path to mapping.json of proper QfO dataset")
+    parser.add_argument('input_rels', help="Path to input relation file. either tsv or orthoxml")
+    parser.add_argument('out', help="Path to output file")
+    parser.add_argument('--release', required=True, help="name of the reference release, e.g. 2022")
+    parser.add_argument('-d', '--debug', action="store_true", help="Set logging to debug level")
+    conf = parser.parse_args()
+
+    log_conf = {'level': logging.INFO, 'format': "%(asctime)-15s %(levelname)-7s: %(message)s"}
+    if conf.debug:
+        log_conf['level'] = logging.DEBUG
+    logging.basicConfig(**log_conf)
+
+    perf.start("binary_predictions", os.path.dirname(os.path.abspath(conf.out)))
+    with perf.phase("mapping load"):
+        mapping_data = map_relations.load_mapping(conf.mapping)
+    refset = ReferenceProteomes.from_mapping(mapping_data)
+    with perf.phase("parse", bytes=os.path.getsize(conf.input_rels)):
+        with BinaryPredictionsWriter(conf.out, refset, conf.release) as writer:
+            map_relations.parse_predictions(conf.input_rels, refset, writer)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""Compares the pairwise predictions of several participants of a release.
+
+The participants are given as paths to their sqlite databases (as created
+by map_relations.py), optionally prefixed with the name of the
+participant, e.g. ``"OMA Groups=oma.db"``. The predicted pairs of every
+method are loaded once into a sorted array of unique int64 keys
+``prot_nr1 << 32 | prot_nr2`` (with prot_nr1 < prot_nr2) and stored as
+``<work_dir>/<participant>-<digest>.pairs.npy``. All methods are then
+compared pairwise by a pool of processes, which intersect the sorted key
+arrays without building any tuples of protein ids.
+
+The results are written to ``<out>.json`` (number of pairs per method and
+the matrices of shared pairs, union sizes and Jaccard similarities) and
+``<out>.npz``. If the mapping of the release is given, the npz file also
+contains the number of pairs per method and the number of shared pairs
+per pair of methods for every (unordered) pair of species.
+"""
+import contextlib
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+
+import numpy
+
+import perf
+from helpers import connect_db, parse_participant
+from reference_indexes import load_mapping
+from refset import ReferenceProteomes
+
+logger = logging.getLogger("compare-methods")
+PAIRS_EXT = ".pairs.npy"
+
+# layout of the release. It is set up in the main process before the
+# workers are forked and must not be modified by the workers
+_refset = None
+
+
+def pair_keys(prot_nr1, prot_nr2):
+    """returns the int64 keys of the unordered pairs"""
+    a = numpy.minimum(prot_nr1, prot_nr2).astype("int64")
+    b = numpy.maximum(prot_nr1, prot_nr2).astype("int64")
+    return (a << 32) | b
+
+
+def split_keys(keys):
+    """returns the arrays of the first and second prot_nrs of the keys"""
+    return keys >> 32, keys & 0xFFFFFFFF
+
+
+def load_pairs(db_path, chunk_size=1 << 20):
+    """returns the sorted unique keys of the orthologous pairs in a database"""
+    con = connect_db(db_path)
+    cur = con.cursor()
+    cur.execute("SELECT prot_nr1, prot_nr2 FROM orthologs WHERE prot_nr1 < prot_nr2")
+    chunks = []
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if len(rows) == 0:
+            break
+        rel = numpy.array(rows, dtype="int64")
+        chunks.append(pair_keys(rel[:, 0], rel[:, 1]))
+    con.close()
+    if not chunks:
+        return numpy.empty(0, dtype="int64")
+    return numpy.unique(numpy.concatenate(chunks))
+
+
+def intersect_sorted(a, b):
+    """returns the elements of the sorted unique array a that are also in
+    the sorted unique array b. The shorter array is looked up in the
+    longer one, which costs O(n log m) and no extra memory beyond the
+    result."""
+    if len(a) > len(b):
+        a, b = b, a
+    if len(b) == 0:
+        return a[:0]
+    pos = numpy.searchsorted(b, a)
+    pos[pos == len(b)] = 0
+    return a[b[pos] == a]
+
+
+def species_pair_counts(keys, refset):
+    """returns the (genome, genome) matrix with the number of pairs per
+    unordered pair of species, stored in the upper triangle"""
+    n = refset.nr_genomes
+    if len(keys) == 0:
+        return numpy.zeros((n, n), dtype="int64")
+    p1, p2 = split_keys(keys)
+    g1 = refset.genome_of(p1).astype("int64")
+    g2 = refset.genome_of(p2).astype("int64")
+    lo, hi = numpy.minimum(g1, g2), numpy.maximum(g1, g2)
+    return numpy.bincount(lo * n + hi, minlength=n * n).reshape(n, n)
+
+
+def pairs_fname(work_dir, name):
+    """returns the path of the sorted pairs of a participant. The digest of
+    the name keeps names apart that only differ in replaced characters,
+    e.g. "OMA Groups" and "OMA-Groups"."""
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:10]
+    return os.path.join(work_dir, "{}-{}{}".format(name.replace(' ', '-').replace(os.sep, '-'), digest, PAIRS_EXT))
+
+
+def _prepare_method(args):
+    """stores the sorted pair keys of a method unless they are up to date"""
+    name, db_path, fname = args
+    if os.path.exists(fname) and os.path.getmtime(fname) >= os.path.getmtime(db_path):
+        keys = numpy.load(fname, mmap_mode='r')
+        logger.info("reusing {} pairs of {} from {}".format(len(keys), name, fname))
+    else:
+        keys = load_pairs(db_path)
+        tmp = fname + ".tmp.npy"
+        numpy.save(tmp, keys)
+        os.replace(tmp, fname)
+        logger.info("loaded {} pairs of {} from {}".format(len(keys), name, db_path))
+    per_species = species_pair_counts(keys, _refset) if _refset is not None else None
+    return len(keys), per_species
+
+
+def _compare_methods(args):
+    i, j, fname_i, fname_j = args
+    shared = intersect_sorted(numpy.load(fname_i, mmap_mode='r'), numpy.load(fname_j, mmap_mode='r'))
+    per_species = species_pair_counts(shared, _refset) if _refset is not None else None
+    return i, j, len(shared), per_species
+
+
+def _run(pool, func, tasks, ordered=True):
+    if pool is None:
+        return map(func, tasks)
+    return pool.imap(func, tasks) if ordered else pool.imap_unordered(func, tasks)
+
+
+def compare(participants, work_dir, nr_procs=1, refset=None):
+    """compares all pairs of participants, given as list of (name, db_path)
+    tuples. Returns a dict with the number of pairs per method and the
+    matrices of shared pairs, union sizes and jaccard similarities, plus
+    the per species pair counts if the layout of the release is given."""
+    global _refset
+    _refset = refset
+    names = [name for name, _ in participants]
+    fnames = [pairs_fname(work_dir, name) for name in names]
+    m = len(participants)
+    pool = None
+    if nr_procs > 1:
+        pool = multiprocessing.get_context("fork").Pool(nr_procs)
+    try:
+        with perf.phase("load pairs") as ph:
+            prepared = list(_run(pool, _prepare_method,
+                                 [(name, db, fname) for (name, db), fname in zip(participants, fnames)]))
+            sizes = numpy.array([size for size, _ in prepared], dtype="int64")
+            ph.rows = int(sizes.sum())
+
+        shared = numpy.diag(sizes)
+        species_shared = None
+        if refset is not None:
+            g = refset.nr_genomes
+            species_shared = numpy.zeros((m, m, g, g), dtype="int64")
+            for k, (_, per_species) in enumerate(prepared):
+                species_shared[k, k] = per_species
+        with perf.phase("compare", rows=m * (m - 1) // 2):
+            tasks = [(i, j, fnames[i], fnames[j]) for i, j in itertools.combinations(range(m), 2)]
+            for i, j, nr_shared, per_species in _run(pool, _compare_methods, tasks, ordered=False):
+                shared[i, j] = shared[j, i] = nr_shared
+                if species_shared is not None:
+                    species_shared[i, j] = species_shared[j, i] = per_species
+                logger.debug("{} vs {}: {} shared pairs".format(names[i], names[j], nr_shared))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    union = sizes[:, None] + sizes[None, :] - shared
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        jaccard = numpy.where(union > 0, shared / union, 1.0)
+    res = {'methods': names, 'sizes': sizes, 'shared': shared, 'union': union, 'jaccard': jaccard}
+    if refset is not None:
+        res['species'] = refset.species
+        res['species_pair_shared'] = species_shared
+    return res
+
+
+def write_results(res, out):
+    """writes the similarity matrices to out.json and all results to out.npz"""
+    with open(out + ".json", 'wt') as fh:
+        json.dump({'methods': res['methods'],
+                   'sizes': res['sizes'].tolist(),
+                   'shared': res['shared'].tolist(),
+                   'union': res['union'].tolist(),
+                   'jaccard': res['jaccard'].tolist()}, fh, indent=4, separators=(',', ': '))
+    arrays = {k: numpy.asarray(v) for k, v in res.items() if k not in ('methods', 'species')}
+    arrays['methods'] = numpy.array(res['methods'], dtype="U")
+    if 'species' in res:
+        arrays['species'] = numpy.array(res['species'], dtype="U")
+    with open(out + ".npz", 'wb') as fh:
+        numpy.savez_compressed(fh, **arrays)
+
+
+def print_matrix(res):
+    names = res['methods']
+    width = max(len(name) for name in names)
+    for name, size, row in zip(names, res['sizes'], res['jaccard']):
+        print("{:<{w}} {:>11d} ".format(name, int(size), w=width) + " ".join("{:5.3f}".format(x) for x in row))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare the predicted orthologs of several participants")
+    parser.add_argument('participants', nargs="+",
+                        help="sqlite databases of the participants, optionally prefixed by the name of the "
+                             "participant, e.g. \"OMA Groups=oma.db\"")
+    parser.add_argument('--out', required=True, help="prefix of the output files (<out>.json and <out>.npz)")
+    parser.add_argument('--mapping', help="Path to mapping.json of the QfO dataset. If given, the overlaps are "
+                                          "also computed per pair of species")
+    parser.add_argument('--work-dir', help="directory to keep the sorted pairs of the participants in for later "
+                                           "comparisons. Defaults to a temporary directory")
+    parser.add_argument('-p', '--procs', type=int, default=multiprocessing.cpu_count(),
+                        help="number of processes. Defaults to all available cpus")
+    parser.add_argument('-d', '--debug', action="store_true", help="Set logging to debug level")
+    conf = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if conf.debug else logging.INFO,
+                        format="%(asctime)-15s %(processName)s %(levelname)-7s: %(message)s")
+
+    participants = [parse_participant(p) for p in conf.participants]
+    if len(set(name for name, _ in participants)) != len(participants):
+        parser.error("participant names must be unique")
+    out_dir = os.path.dirname(os.path.abspath(conf.out))
+    os.makedirs(out_dir, exist_ok=True)
+    perf.start("compare_methods", out_dir)
+    refset = None
+    if conf.mapping is not None:
+        with perf.phase("mapping load"):
+            refset = ReferenceProteomes.from_mapping(load_mapping(conf.mapping))
+    if conf.work_dir is not None:
+        os.makedirs(conf.work_dir, exist_ok=True)
+        work_dir = contextlib.nullcontext(conf.work_dir)
+    else:
+        work_dir = tempfile.TemporaryDirectory(prefix="compare-methods-")
+    with work_dir as path:
+        res = compare(participants, path, nr_procs=conf.procs, refset=refset)
+    write_results(res, conf.out)
+    print_matrix(res)
@@ -0,0 +1,109 @@
+"""Content addressed cache of validated and converted predictions.
+
+Cache entries are keyed by the sha256 digests of the submitted prediction
+file and of the mapping of the reference release, so a re-submission of
+the same file against the same release can reuse the results of the
+earlier validation and conversion. Each stage (e.g. 'validation' or
+'conversion') has its own namespace in the cache directory::
+
+    <cache_dir>/<stage>/<key[:2]>/<key>/<files>
+
+Entries are populated in a temporary directory and moved into place with
+a single rename, so concurrent runs never see incomplete entries.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+logger = logging.getLogger("conversion-cache")
+CACHE_FORMAT_VERSION = 1
+
+
+def file_digest(path, blocksize=1 << 22):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        while True:
+            block = fh.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+class ConversionCache:
+    """Cache of converted predictions.
+
+    Example::
+
+        cache = ConversionCache("/data/qfo-cache")
+        key = cache.key_for(predictions, mapping)
+        if not cache.restore("conversion", key, {"orthologs.db": "orthologs.db"}):
+            convert(...)
+            cache.store("conversion", key, {"orthologs.db": "orthologs.db"})
+
+    :param cache_dir: base directory of the cache. It is created if needed.
+    :param link: names of the cached files that are restored as hardlinks
+        into the cache instead of copies. Only use this for files that are
+        never modified after the restore: the read-only mode of the cached
+        files does not protect them from root, e.g. inside a container.
+    """
+
+    def __init__(self, cache_dir, link=()):
+        self.cache_dir = cache_dir
+        self.link = frozenset(link)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key_for(self, input_path, mapping_path):
+        h = hashlib.sha256("qfo-cache-v{}".format(CACHE_FORMAT_VERSION).encode('utf-8'))
+        for path in (input_path, mapping_path):
+            h.update(file_digest(path).encode('utf-8'))
+        return h.hexdigest()
+
+    def entry_dir(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key[:2], key)
+
+    def restore(self, stage, key, targets):
+        """restores the cached files of an entry.
+
+        :param targets: dict of cached file name to destination path
+        :returns: True on a cache hit, False otherwise"""
+        entry = self.entry_dir(stage, key)
+        if not all(os.path.isfile(os.path.join(entry, name)) for name in targets):
+            logger.info("no cached {} results found for {}".format(stage, key))
+            return False
+        for name, dest in targets.items():
+            src = os.path.join(entry, name)
+            if os.path.lexists(dest):
+                os.remove(dest)
+            if name in self.link:
+                try:
+                    os.link(src, dest)
+                    continue
+                except OSError as e:
+                    logger.debug("cannot hardlink {}: {}. Copying instead".format(src, e))
+            shutil.copyfile(src, dest)
+        logger.info("restored cached {} results {} from {}".format(stage, list(targets), entry))
+        return True
+
+    def store(self, stage, key, files):
+        """stores files in the cache.
+
+        :param files: dict of cached file name to path of the file to store
+        """
+        entry = self.entry_dir(stage, key)
+        parent = os.path.dirname(entry)
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=parent)
+        try:
+            for name, src in files.items():
+                dest = os.path.join(tmp, name)
+                shutil.copyfile(src, dest)
+                os.chmod(dest, 0o444)
+            os.rename(tmp, entry)
+            logger.info("stored {} results in cache {}".format(stage, entry))
+        except OSError as e:
+            # most likely a concurrent run stored the same entry first
+            logger.info("could not store {} results in cache: {}".format(stage, e))
+            shutil.rmtree(tmp, ignore_errors=True)
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import collections
 import concurrent.futures
 import csv
 import itertools
@@ -9,19 +10,20 @@ import subprocess
 import tempfile
 import random
 
-import numpy
-import sqlite3
 from pathlib import Path
 from typing import TextIO
-from tqdm import tqdm
 
-from JSON_templates import write_assessment_dataset
-from helpers import auto_open, load_json_file
+import benchmark_stats
+import perf
+from JSON_templates import write_assessment_dataset, validate_many
+from helpers import auto_open, load_json_file, RawOutputWriter, connect_db
+from reference_indexes import load_index
 
 logger = logging.getLogger("FAS-Benchmark")
 MAX_PAIRS_COMPUTE = 9_000
 
 def load_precomputed_fas_scores(f: Path):
+    import numpy
     dat = load_json_file(str(f))
     data = {}
     for pair, vals in dat.items():
@@ -77,7 +79,23 @@ def compute_fas_scores_for_pairs(pairs, prot2tax, annotations, nr_cpus):
     return scores
 
 
-def compute_fas_benchmark(precomputed_scores: Path, annotations: Path, db_path: Path, nr_cpus: int, raw_out: TextIO, limited_species=False):
+def load_fas_reference(precomputed_scores: Path, annotations: Path):
+    """returns the lookup table of precomputed FAS scores and the map of
+    proteins to their annotation file"""
+    scores_lookup = load_index("fas_scores", precomputed_scores)
+    if scores_lookup is None:
+        scores_lookup = load_precomputed_fas_scores(precomputed_scores)
+    prot_2_tax_map = load_index("fas_prot2tax", annotations)
+    if prot_2_tax_map is None:
+        prot_2_tax_map = generate_prot_to_annoationfile_map(annotations)
+    return scores_lookup, prot_2_tax_map
+
+
+def compute_fas_benchmark(precomputed_scores: Path, annotations: Path, db_path: Path, nr_cpus: int, raw_out: TextIO,
+                          limited_species=False, reference=None, bootstrap=None):
+    import numpy
+    from tqdm import tqdm
+
     def iter_all_orthologs(species=None):
         cur = con.cursor()
         query = "SELECT DISTINCT p1.uniprot_id, p2.uniprot_id FROM orthologs JOIN proteomes as p1 ON orthologs.prot_nr1 = p1.prot_nr JOIN proteomes as p2 ON orthologs.prot_nr2 = p2.prot_nr WHERE p1.uniprot_id < p2.uniprot_id"
@@ -92,25 +110,29 @@ def compute_fas_benchmark(precomputed_scores: Path, annotations: Path, db_path:
                 break
             yield from chunk
 
-    con = sqlite3.connect(db_path)
-    scores_lookup = load_precomputed_fas_scores(precomputed_scores)
-    prot_2_tax_map = generate_prot_to_annoationfile_map(annotations)
+    con = connect_db(db_path)
+    if reference is None:
+        with perf.phase("reference load"):
+            reference = load_fas_reference(precomputed_scores, annotations)
+    scores_lookup, prot_2_tax_map = reference
     logger.info("feature annotations available for %d proteins", len(prot_2_tax_map))
     logger.debug(list(itertools.islice(prot_2_tax_map.items(), 30)))
 
     scores = []; missing_pairs = []; no_fa = 0
     species = ("HUMAN", "MOUSE", "RATNO", "YEAST", "ECOLI", "ARATH") if limited_species else None
-    for p1, p2 in tqdm(iter_all_orthologs(species)):
-        if '_' in p1 or '_' in p2:
-            # skipping uniprot_ids, only uniprot accessions!
-            continue
-        if (p1, p2) in scores_lookup:
-            scores.append((p1, p2))
-        elif p1 in prot_2_tax_map and p2 in prot_2_tax_map:
-            missing_pairs.append((p1, p2))
-        else:
-            logger.info("No feature architecture found for relation %s/%s. Skipping", p1, p2)
-            no_fa += 1
+    with perf.phase("ortholog scan") as ph:
+        for p1, p2 in tqdm(iter_all_orthologs(species)):
+            ph.rows += 1
+            if '_' in p1 or '_' in p2:
+                # skipping uniprot_ids, only uniprot accessions!
+                continue
+            if (p1, p2) in scores_lookup:
+                scores.append((p1, p2))
+            elif p1 in prot_2_tax_map and p2 in prot_2_tax_map:
+                missing_pairs.append((p1, p2))
+            else:
+                logger.info("No feature architecture found for relation %s/%s. Skipping", p1, p2)
+                no_fa += 1
 
     nr_orthologs = len(scores) + len(missing_pairs)
     logger.info("%d pairs precomputed, %d missing (will compute); %d no feature annotations",
@@ -125,47 +147,80 @@ def compute_fas_benchmark(precomputed_scores: Path, annotations: Path, db_path:
         random.shuffle(scores)
         scores = scores[:nr_precomp_maintain_frac]
 
-        score2 = compute_fas_scores_for_pairs(missing_pairs, prot_2_tax_map, annotations, nr_cpus)
-        scores_lookup.update(score2)
-    csv_writer = csv.writer(raw_out, dialect="excel-tab")
-    csv_writer.writerow(("Acc1", "Acc2", "FAS"))
-    scores_list = []
-    for part, pairs in zip(("precomputed", "missing"), (scores, missing_pairs)):
-        score_part = []
-        for pair in pairs:
-            try:
-                score = scores_lookup[pair]
-                csv_writer.writerow((pair[0], pair[1], score))
-                score_part.append(score)
-            except KeyError:
-                pass
-        scores_list.extend(score_part)
-        score_part = numpy.array(score_part, dtype="float")
-        logger.info("FAS score[%s]: %f +- %f [N=%d]", part, score_part.mean(),
-                    score_part.std(ddof=1) / numpy.sqrt(numpy.size(score_part)),
-                    len(score_part))
-
-    fas_scores = numpy.array(scores_list, dtype="float")
-    fas_mean = fas_scores.mean()
-    fas_sem = fas_scores.std(ddof=1) / numpy.sqrt(numpy.size(fas_scores))
+        with perf.phase("fas computation", rows=len(missing_pairs)):
+            score2 = compute_fas_scores_for_pairs(missing_pairs, prot_2_tax_map, annotations, nr_cpus)
+        # the precomputed scores might be shared between several runs, so the
+        # newly computed scores are not added to them
+        scores_lookup = collections.ChainMap(score2, scores_lookup)
+    with perf.phase("metric computation") as ph:
+        csv_writer = csv.writer(raw_out, dialect="excel-tab")
+        csv_writer.writerow(("Acc1", "Acc2", "FAS"))
+        scores_list = []
+        # index of the first protein of every scored pair, the unit resampled by the bootstrap
+        protein_idx = {}
+        score_units = []
+        for part, pairs in zip(("precomputed", "missing"), (scores, missing_pairs)):
+            score_part = []
+            for pair in pairs:
+                try:
+                    score = scores_lookup[pair]
+                    csv_writer.writerow((pair[0], pair[1], score))
+                    score_part.append(score)
+                    score_units.append(protein_idx.setdefault(pair[0], len(protein_idx)))
+                except KeyError:
+                    pass
+            scores_list.extend(score_part)
+            score_part = numpy.array(score_part, dtype="float")
+            logger.info("FAS score[%s]: %f +- %f [N=%d]", part, score_part.mean(),
+                        score_part.std(ddof=1) / numpy.sqrt(numpy.size(score_part)),
+                        len(score_part))
+
+        fas_scores = numpy.array(scores_list, dtype="float")
+        fas_mean = fas_scores.mean()
+        fas_sem = fas_scores.std(ddof=1) / numpy.sqrt(numpy.size(fas_scores))
+        ph.rows = len(fas_scores)
 
     logger.info(f"FAS_mean: {fas_mean} +- {fas_sem}; nr_orthologs: {nr_orthologs}; sample_size: {len(fas_scores)} vs {numpy.size(fas_scores)}")
 
     metrics = [{"name": "FAS", "value": float(fas_mean), "stderr": float(fas_sem)},
                {"name": "NR_ORTHOLOGS", "value": nr_orthologs, "stderr": 0},
                ]
+    if bootstrap is not None:
+        if bootstrap.unit != "protein":
+            logger.info("FAS scores are resampled by protein instead of %s", bootstrap.unit)
+        with perf.phase("bootstrap", rows=len(protein_idx)):
+            interval = bootstrap.mean(fas_scores, score_units, unit="protein")
+        if interval is not None:
+            interval['unit'] = "protein"
+            metrics[0]['bootstrap'] = interval
     return metrics
 
 
 
 
+def raw_output_fname(outdir: Path, participant, challenge="FAS"):
+    return outdir / "{}_{}_raw.txt.gz".format(challenge, participant.replace(' ', '-').replace('_', '-'))
+
+
+def run_benchmark(precomputed_scores: Path, annotations: Path, db_path: Path, nr_cpus: int, outfn_path: Path,
+                  assessment_out, community, participant, limited_species=False, reference=None, bootstrap=None):
+    challenge = "FAS"
+    with RawOutputWriter(str(outfn_path)) as raw_out_fh:
+        res = compute_fas_benchmark(precomputed_scores, annotations, db_path, nr_cpus, raw_out_fh,
+                                    limited_species=limited_species, reference=reference, bootstrap=bootstrap)
+    write_assessment_json_stub(assessment_out, community, participant, res, challenge)
+    return res
+
+
 def write_assessment_json_stub(fn, community, participant, result, challenge):
     stubs = []
     for metric in result:
         id_ = "{}:{}_{}_{}_A".format(community, challenge, metric['name'],
                                      participant.replace(' ', '-').replace('_', '-'))
+        extra = {'bootstrap': metric['bootstrap']} if 'bootstrap' in metric else None
         stubs.append(write_assessment_dataset(id_, community, challenge, participant, metric['name'], metric['value'],
-                                              metric.get('stderr', 0)))
+                                              metric.get('stderr', 0), validate=False, extra=extra))
+    stubs = validate_many(stubs)
     with auto_open(fn, 'wt') as fout:
         json.dump(stubs, fout, sort_keys=True, indent=4, separators=(',', ': '))
 
@@ -184,6 +239,7 @@ if __name__ == "__main__":
                                           "and not computed on the fly")
     parser.add_argument('--limited-species', action="store_true", help="run on limited species set (6 species)")
     parser.add_argument('--participant', required=True, help="Name of participant method")
+    benchmark_stats.add_bootstrap_arguments(parser)
     parser.add_argument('--log', help="Path to log file. Defaults to stderr")
     parser.add_argument('--cpus', type=int, help="nr of cpus to use. defaults to all available cpus")
     parser.add_argument('-d', '--debug', action="store_true", help="Set logging to debug level")
@@ -198,12 +254,11 @@ if __name__ == "__main__":
         conf.cpus = multiprocessing.cpu_count()
     logging.basicConfig(**log_conf)
     logger.info("running fas_benchmark with following arguments: {}".format(conf))
-    challenge = "FAS"
-    
+
+    perf.start("fas_benchmark", str(Path(conf.assessment_out).resolve().parent))
     outdir = Path(conf.outdir)
     outdir.mkdir(parents=True, exist_ok=True)
-    outfn_path = outdir / "{}_{}_raw.txt.gz".format(challenge, conf.participant.replace(' ', '-').replace('_', '-'))
-
-    with auto_open(str(outfn_path), 'wt') as raw_out_fh:
-        res = compute_fas_benchmark(Path(conf.fas_precomputed_scores), Path(conf.fas_data), Path(conf.db), conf.cpus, raw_out_fh, limited_species=conf.limited_species)
-    write_assessment_json_stub(conf.assessment_out, conf.com, conf.participant, res, challenge)
+    outfn_path = raw_output_fname(outdir, conf.participant)
+    run_benchmark(Path(conf.fas_precomputed_scores), Path(conf.fas_data), Path(conf.db), conf.cpus, outfn_path,
+                  conf.assessment_out, conf.com, conf.participant, limited_species=conf.limited_species,
+                  bootstrap=benchmark_stats.bootstrap_from_args(conf))
@@ -1,12 +1,16 @@
 #!/usr/bin/env python
+import concurrent.futures
+import hashlib
+import json
+import logging
 import os
+import re
 import subprocess
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
 
-try:
-    from urllib.request import urlretrieve
-except ImportError:
-    from urllib import urlretrieve
-
+logger = logging.getLogger("fetch-reference-data")
 
 BASEURLS = {
         "2022.1": "https://zenodo.org/records/10517603/files/",
@@ -17,11 +21,14 @@ BASEURLS = {
 }
 BASEURLS["2022"] = BASEURLS["2022.1"]
 BASEURLS["2020"] = BASEURLS["2020.2"]
+CHUNK_SIZE = 1 << 20
 
 
-def get_file_list(release):
-    if release not in BASEURLS:
-        raise KeyError(f"Either release {release} is unknown, or a base URL is not available for it yet")
+def get_file_list(release, base_url=None):
+    if base_url is None:
+        if release not in BASEURLS:
+            raise KeyError(f"Either release {release} is unknown, or a base URL is not available for it yet")
+        base_url = BASEURLS[release]
     files = [
        'Summaries.drw.gz',
        'GOdata.drw.gz',
@@ -56,18 +63,167 @@ def get_file_list(release):
             'fas_precomputed.json.gz',
             'fas_annotations.tgz',
         ])
-    return [os.path.join(BASEURLS[release], f) for f in files]
+    return [base_url.rstrip('/') + '/' + f for f in files]
+
+
+def get_published_checksums(base_url):
+    """returns the sizes and md5 checksums of the files of a zenodo record
+    as a dict filename -> {'size': int, 'md5': str}.
+
+    The record metadata is fetched from <host>/api/records/<id>, which is
+    derived from a base url of the form <host>/records/<id>/files/. An
+    empty dict is returned if the checksums are not available."""
+    m = re.match(r"(?P<host>.*)/records/(?P<id>\d+)/files/?$", base_url)
+    if m is None:
+        logger.warning("cannot derive record metadata url from {}. Files will not be verified".format(base_url))
+        return {}
+    api_url = "{}/api/records/{}".format(m.group('host'), m.group('id'))
+    try:
+        with urlopen(api_url, timeout=60) as response:
+            record = json.load(response)
+    except (URLError, OSError, ValueError) as e:
+        logger.warning("cannot retrieve checksums from {}: {}. Files will not be verified".format(api_url, e))
+        return {}
+    checksums = {}
+    for f in record.get('files', []):
+        algo, _, digest = f.get('checksum', '').partition(':')
+        checksums[f['key']] = {'size': f.get('size'), 'md5': digest if algo == 'md5' else None}
+    return checksums
+
+
+def _md5_of_file(path, md5=None):
+    md5 = md5 if md5 is not None else hashlib.md5()
+    with open(path, 'rb') as fh:
+        while True:
+            block = fh.read(CHUNK_SIZE)
+            if not block:
+                break
+            md5.update(block)
+    return md5
+
+
+def _verify(fname, size, md5, expected):
+    if expected is None:
+        return
+    if expected.get('size') is not None and size != expected['size']:
+        raise IOError("size of {} does not match: {} vs published {}".format(fname, size, expected['size']))
+    if expected.get('md5') is not None and md5 != expected['md5']:
+        raise IOError("md5 checksum of {} does not match: {} vs published {}".format(fname, md5, expected['md5']))
+
 
+def is_complete(target, expected):
+    """checks whether an already downloaded file matches the published checksums"""
+    if not os.path.exists(target):
+        return False
+    if expected is None:
+        return True
+    try:
+        _verify(target, os.path.getsize(target), _md5_of_file(target).hexdigest(), expected)
+    except IOError as e:
+        logger.warning("{}. Downloading again".format(e))
+        return False
+    return True
 
-def retrieve_files(files, target_dir):
+
+def download_file(url, target, expected=None, extract_dir=None):
+    """downloads url into target. An incomplete download in target.part
+    is resumed with an HTTP range request. If extract_dir is set, the file
+    is a gzipped tarball that is extracted while it is downloaded."""
+    fname = os.path.basename(target)
+    part = target + ".part"
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    request = Request(url)
+    if offset > 0:
+        request.add_header("Range", "bytes={}-".format(offset))
+    try:
+        response = urlopen(request, timeout=60)
+    except HTTPError as e:
+        if e.code != 416:
+            raise
+        # requested range not satisfiable: the part file is already complete
+        response = None
+    if response is not None and offset > 0 and response.status != 206:
+        logger.info("server does not support resuming {}. Restarting download".format(fname))
+        offset = 0
+    logger.info("{} {} from byte {}".format("resuming" if offset > 0 else "downloading", fname, offset))
+
+    md5 = hashlib.md5()
+    tar = None
+    if extract_dir is not None:
+        tar = subprocess.Popen(['tar', 'xzf', '-'], cwd=extract_dir, stdin=subprocess.PIPE)
+    try:
+        if offset > 0:
+            with open(part, 'rb') as fh:
+                while True:
+                    block = fh.read(CHUNK_SIZE)
+                    if not block:
+                        break
+                    md5.update(block)
+                    if tar is not None:
+                        tar.stdin.write(block)
+        if response is not None:
+            with response, open(part, 'ab' if offset > 0 else 'wb') as fh:
+                while True:
+                    block = response.read(CHUNK_SIZE)
+                    if not block:
+                        break
+                    fh.write(block)
+                    md5.update(block)
+                    if tar is not None:
+                        tar.stdin.write(block)
+    finally:
+        if tar is not None:
+            tar.stdin.close()
+            tar.wait()
+
+    try:
+        _verify(fname, os.path.getsize(part), md5.hexdigest(), expected)
+    except IOError:
+        os.remove(part)
+        raise
+    if tar is not None and tar.returncode != 0:
+        raise IOError("extracting {} failed with exit code {}".format(fname, tar.returncode))
+    os.replace(part, target)
+    logger.info("finished {}".format(fname))
+
+
+def _fetch_with_retries(url, target, expected, extract_dir, retries):
+    for attempt in range(retries + 1):
+        try:
+            return download_file(url, target, expected=expected, extract_dir=extract_dir)
+        except (URLError, ConnectionError, TimeoutError) as e:
+            if attempt == retries:
+                raise
+            logger.warning("downloading {} failed: {}. Retrying".format(os.path.basename(target), e))
+            time.sleep(2 ** attempt)
+
+
+def retrieve_files(files, target_dir, checksums=None, nr_parallel=4, retries=3):
+    """downloads the files concurrently into target_dir. Files that are
+    already complete are skipped, incomplete downloads are resumed and
+    the result is verified against the published checksums if provided."""
     if not os.path.exists(target_dir):
         os.makedirs(target_dir)
-    for url in files:
-        fname = os.path.basename(url)
-        target = os.path.join(target_dir, fname)
-        urlretrieve(url, target)
-        if fname.endswith('.tgz'):
-            subprocess.run(['tar', 'xzf', fname], cwd=target_dir, check=True)
+    checksums = checksums if checksums is not None else {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nr_parallel) as ex:
+        futures = {}
+        for url in files:
+            fname = os.path.basename(url)
+            target = os.path.join(target_dir, fname)
+            if is_complete(target, checksums.get(fname)):
+                logger.info("{} is already complete".format(fname))
+                continue
+            extract_dir = target_dir if fname.endswith('.tgz') else None
+            futures[ex.submit(_fetch_with_retries, url, target, checksums.get(fname), extract_dir, retries)] = fname
+        failed = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logger.error("failed to retrieve {}: {}".format(futures[future], e))
+                failed.append(futures[future])
+    if failed:
+        raise IOError("failed to retrieve {}".format(", ".join(sorted(failed))))
 
 
 if __name__ == "__main__":
@@ -79,11 +235,27 @@ if __name__ == "__main__":
                         "version of that year (e.g. 2020 --> 2020.2"
                    )
     p.add_argument('--out-dir', help="directory where to store the data. Defaults to ./reference_data/<release>")
+    p.add_argument('--base-url', help="url of the directory to download the files from. Defaults to the "
+                                      "zenodo record of the release")
+    p.add_argument('--parallel', type=int, default=4, help="number of concurrent downloads")
+    p.add_argument('--prepare', action="store_true",
+                   help="build the derived indexes of the reference data after the download "
+                        "(see reference_indexes.py)")
+    p.add_argument('-d', '--debug', action="store_true", help="Set logging to debug level")
 
     conf = p.parse_args()
+    logging.basicConfig(level=logging.DEBUG if conf.debug else logging.INFO,
+                        format="%(asctime)-15s %(levelname)-7s: %(message)s")
     if conf.out_dir is None:
         conf.out_dir = os.path.join("reference_data", str(conf.release))
+    base_url = conf.base_url if conf.base_url is not None else BASEURLS.get(conf.release)
+    if base_url is None:
+        p.error(f"no base URL available for release {conf.release}. Use --base-url")
 
-    retrieve_files(get_file_list(conf.release), conf.out_dir)
+    retrieve_files(get_file_list(conf.release, base_url), conf.out_dir,
+                   checksums=get_published_checksums(base_url), nr_parallel=conf.parallel)
     print("Finished downloading data for release {}. Stored in {}".format(conf.release, conf.out_dir))
-
+    if conf.prepare:
+        import reference_indexes
+        built = reference_indexes.prepare(conf.out_dir)
+        print("Built indexes {} for release {}".format(", ".join(built), conf.release))
@@ -1,3 +1,4 @@
+import collections
 import time
 
 import dendropy
@@ -6,8 +7,10 @@ import os
 import Bio.Phylo
 import io
 import logging
+import multiprocessing
 
 logger = logging.getLogger('tree-sampler')
+MAX_TRIALS_WITHOUT_PROGRESS = 20000
 
 
 def is_bifurcating(tree):
@@ -17,42 +20,130 @@ def is_bifurcating(tree):
     return True
 
 
-def shuffle_children_order(tree:dendropy.Tree):
+def shuffle_children_order(tree:dendropy.Tree, rng=random):
     for nd in tree.postorder_internal_node_iter():
-        nd._child_nodes.sort(key=lambda n: random.random())
-
-
-def sample_cases(newick_tree, nr_samples, tree_size, exclude=None):
-    t = dendropy.Tree.get(data=newick_tree, schema="newick")
-    for k, top_clade_node in enumerate(t.seed_node.child_nodes()):
-        for l in top_clade_node.leaf_iter():
-            l.taxon.annotations.add(k)
-    if exclude is None:
-        exclude = []
-    all_taxa = [tax for tax in t.taxon_namespace if tax.label not in exclude]
-
-    cases = []
-    lst_time = 0
-    MAX_TRIALS_WITHOUT_PROGRESS = rem_trials = 20000
-    while rem_trials > 0 and len(cases) < nr_samples:
-        if time.time() - lst_time > 30:
-            logger.info("cur_samplesize: {}; {} unsuccessful consecutive trials"
-                        .format(len(cases), MAX_TRIALS_WITHOUT_PROGRESS - rem_trials))
-            lst_time = time.time()
-        rem_trials -= 1
-        sample = random.sample(all_taxa, tree_size)
-        cov_clades = {s.annotations[0] for s in sample}
-        if len(cov_clades) < 2:
-            continue
-
-        candidate = t.extract_tree_with_taxa(sample)
-        if is_bifurcating(candidate):
-            shuffle_children_order(candidate)
-            cases.append(candidate)
+        nd._child_nodes.sort(key=lambda n: rng.random())
+
+
+class SpeciesTreeSampler:
+    """Draws random bifurcating subtrees of a fixed size from a species tree.
+
+    For every taxon, the toplevel clade it belongs to and the multifurcating
+    nodes on its path to the root are precomputed. A sample induces a
+    bifurcating tree if it covers at least two toplevel clades and no
+    multifurcating node has sampled taxa below more than two of its children.
+    Hence, unsuitable samples are rejected without extracting the subtree."""
+
+    def __init__(self, newick_tree, exclude=None):
+        self.tree = dendropy.Tree.get(data=newick_tree, schema="newick")
+        if exclude is None:
+            exclude = []
+        self.taxa = [tax for tax in self.tree.taxon_namespace if tax.label not in exclude]
+
+        top_clade = {}
+        for k, top_clade_node in enumerate(self.tree.seed_node.child_nodes()):
+            for l in top_clade_node.leaf_iter():
+                top_clade[l.taxon] = k
+        leaf_of_taxon = {l.taxon: l for l in self.tree.leaf_node_iter()}
+        multifurcating_nodes = {}
+        self.clade_of = []
+        self.multifurcations_on_path = []
+        for tax in self.taxa:
+            path = []
+            node = leaf_of_taxon[tax]
+            while node.parent_node is not None:
+                parent = node.parent_node
+                if parent.num_child_nodes() > 2:
+                    node_nr = multifurcating_nodes.setdefault(parent, len(multifurcating_nodes))
+                    path.append((node_nr, parent.child_nodes().index(node)))
+                node = parent
+            self.clade_of.append(top_clade[tax])
+            self.multifurcations_on_path.append(tuple(path))
+        logger.debug("species tree with {} sampleable taxa and {} multifurcating nodes"
+                     .format(len(self.taxa), len(multifurcating_nodes)))
+
+    def induces_bifurcating_tree(self, sample):
+        if len({self.clade_of[i] for i in sample}) < 2:
+            return False
+        covered_children = collections.defaultdict(set)
+        for i in sample:
+            for node_nr, child_pos in self.multifurcations_on_path[i]:
+                children = covered_children[node_nr]
+                children.add(child_pos)
+                if len(children) > 2:
+                    return False
+        return True
+
+    def sample(self, rng, nr_samples, tree_size):
+        """returns a list of nr_samples newick strings of bifurcating subtrees
+        with tree_size taxa each, drawn using the random generator rng."""
+        cases = []
+        rem_trials = MAX_TRIALS_WITHOUT_PROGRESS
+        taxa_idx = range(len(self.taxa))
+        while rem_trials > 0 and len(cases) < nr_samples:
+            rem_trials -= 1
+            sample = rng.sample(taxa_idx, tree_size)
+            if not self.induces_bifurcating_tree(sample):
+                continue
+
+            candidate = self.tree.extract_tree_with_taxa([self.taxa[i] for i in sample])
+            assert is_bifurcating(candidate)
+            shuffle_children_order(candidate, rng)
+            cases.append(candidate.as_string(schema='newick'))
             rem_trials = MAX_TRIALS_WITHOUT_PROGRESS
-    if rem_trials <= 0:
-        raise ValueError("too many trials without successful sampling. Too ambitious parameters?")
-    return cases
+        if rem_trials <= 0:
+            raise ValueError("too many trials without successful sampling. Too ambitious parameters?")
+        return cases
+
+
+_sampler = None
+
+
+def _init_sampler(newick_tree, exclude):
+    global _sampler
+    _sampler = SpeciesTreeSampler(newick_tree, exclude=exclude)
+
+
+def _sample_chunk(job):
+    seed, chunk_nr, nr_samples, tree_size = job
+    # every chunk has its own random stream, so the result does not depend
+    # on the number of processes used.
+    rng = random.Random("{}-{}".format(seed, chunk_nr))
+    return _sampler.sample(rng, nr_samples, tree_size)
+
+
+def sample_cases(newick_tree, nr_samples, tree_size, exclude=None, seed=None, nr_procs=1, chunk_size=1000):
+    """generates nr_samples bifurcating subtrees of newick_tree.
+
+    The samples are drawn in chunks of chunk_size trees, each chunk with an
+    independent random stream derived from seed. The chunks are distributed
+    over nr_procs processes. The sampled trees are yielded as newick strings
+    in a reproducible order."""
+    if seed is None:
+        seed = random.randrange(2**32)
+    logger.info("sampling {} trees of size {} using seed {}".format(nr_samples, tree_size, seed))
+    jobs = [(seed, k, min(chunk_size, nr_samples - start), tree_size)
+            for k, start in enumerate(range(0, nr_samples, chunk_size))]
+    done = 0
+    lst_time = time.time()
+    if nr_procs > 1:
+        pool = multiprocessing.Pool(nr_procs, initializer=_init_sampler, initargs=(newick_tree, exclude))
+        results = pool.imap(_sample_chunk, jobs)
+    else:
+        pool = None
+        _init_sampler(newick_tree, exclude)
+        results = map(_sample_chunk, jobs)
+    try:
+        for cases in results:
+            done += len(cases)
+            if time.time() - lst_time > 30:
+                logger.info("cur_samplesize: {}".format(done))
+                lst_time = time.time()
+            yield from cases
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
 
 def extract_relevant_newick_tree(fn_phyloxml, clade):
@@ -91,6 +182,11 @@ if __name__ == "__main__":
                         help="increase verbosity of program. add -vv for debug level")
     parser.add_argument('--exclude', default=None, nargs="*",
                         help="species codes to exclude")
+    parser.add_argument('--seed', type=int,
+                        help="seed for the random number generator. Using the same seed "
+                             "reproduces the same samples. Defaults to a random seed.")
+    parser.add_argument('--procs', '-p', default=os.cpu_count(), type=int,
+                        help="nr of processes used for sampling, defaults to all available cpus")
     parser.add_argument('treefile', help="species tree file in phyloxml format")
     conf = parser.parse_args()
     logging.basicConfig(level=30 - 10 * min(conf.v, 2),
@@ -99,9 +195,10 @@ if __name__ == "__main__":
     lab = conf.clade
     clade = clades[lab]
     newick = extract_relevant_newick_tree(conf.treefile, clade)
-    samples = sample_cases(newick, conf.nr_samples, conf.tree_size, exclude=conf.exclude)
+    samples = sample_cases(newick, conf.nr_samples, conf.tree_size, exclude=conf.exclude,
+                           seed=conf.seed, nr_procs=conf.procs)
     with open(os.path.join(conf.out, 'species_tree_samples_{}.nwk'.format(lab)), 'wt') as fh:
-        for t in samples:
-            t.write(file=fh, schema='newick')
+        for nwk in samples:
+            fh.write(nwk)
 
 
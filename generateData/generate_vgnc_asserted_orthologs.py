@@ -1,16 +1,55 @@
 import itertools
 import logging
 import gzip
-import json
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vgnc_benchmark import binary_orthologs_fname, write_vgnc_orthologs_binary
 
 logger = logging.getLogger("vgnc-convert")
+MAPPING_ENTRY = re.compile(r'"([^"\\]*)"\s*:\s*(-?\d+)')
+
+
+def get_uniprot_accs_of_gene(gene):
+    return gene.rsplit("#", 1)[1].split("|")
+
+
+def load_mapping_subset(mapping_fname, accessions, blocksize=1 << 22):
+    """returns the part of the reference dataset id mapping that covers the
+    requested accessions.
+
+    The mapping json file is scanned block by block for `"xref": prot_nr`
+    entries, so only the requested entries are ever kept in memory."""
+    wanted = set(accessions)
+    mapping = {}
+    with gzip.open(mapping_fname, 'rt') as fh:
+        tail = ""
+        while True:
+            block = fh.read(blocksize)
+            buf = tail + block
+            # entries are separated by commas, so everything up to the last
+            # comma contains only complete entries.
+            cut = buf.rfind(',') if block else len(buf)
+            if cut < 0:
+                tail = buf
+                continue
+            for m in MAPPING_ENTRY.finditer(buf, 0, cut):
+                if m.group(1) in wanted:
+                    mapping[m.group(1)] = int(m.group(2))
+            tail = buf[cut:]
+            if not block:
+                break
+    logger.info("resolved {} of {} requested accessions".format(len(mapping), len(wanted)))
+    return {'mapping': mapping}
 
 
 def extract_rels_from_line(line, refset_data):
     symbol, *genes = line.strip().split("\t")
     acc_per_gene = []
     for gene in genes:
-        up_ids = gene.rsplit("#", 1)[1].split("|")
+        up_ids = get_uniprot_accs_of_gene(gene)
         mapped = list(filter(lambda x: x is not None,
                              (refset_data['mapping'].get(up, None) for up in up_ids)))
         if len(mapped) > 1:
@@ -23,12 +62,26 @@ def extract_rels_from_line(line, refset_data):
         yield rel, symbol
 
 
-def extract_and_write_vgnc_orthologs(vgnc_dump, refset_data, out_fh):
+def read_vgnc_dump(vgnc_dump):
     open_ = gzip.open if vgnc_dump.endswith(".gz") else open
     with open_(vgnc_dump, 'rt') as vgnc_fh:
-        for line in vgnc_fh:
-            for rel, symbol in extract_rels_from_line(line, refset_data):
-                out_fh.write(f"{rel[0]}\t{rel[1]}\t{symbol}\n")
+        return vgnc_fh.readlines()
+
+
+def extract_and_write_vgnc_orthologs(vgnc_lines, refset_data, out_fh, batchsize=50000):
+    """writes the asserted relations to out_fh and returns them as a dictionary
+    of deduplicated (min, max) pairs to their VGNC symbol"""
+    orthologs = {}
+    buf = []
+    for line in vgnc_lines:
+        for rel, symbol in extract_rels_from_line(line, refset_data):
+            buf.append(f"{rel[0]}\t{rel[1]}\t{symbol}\n")
+            orthologs[(min(rel), max(rel))] = symbol
+        if len(buf) > batchsize:
+            out_fh.writelines(buf)
+            buf = []
+    out_fh.writelines(buf)
+    return orthologs
 
 
 if __name__ == "__main__":
@@ -46,10 +99,13 @@ if __name__ == "__main__":
                         format='%(asctime)-15s %(name)s %(levelname)-8s: %(message)s')
     logger.info(str(conf))
 
-    with gzip.open(conf.mapping, 'rt') as fh:
-        refset_data = json.load(fh)
+    vgnc_lines = read_vgnc_dump(conf.vgnc_dump)
+    accessions = itertools.chain.from_iterable(
+        get_uniprot_accs_of_gene(gene) for line in vgnc_lines for gene in line.strip().split("\t")[1:])
+    refset_data = load_mapping_subset(conf.mapping, accessions)
 
     with gzip.open(conf.out, 'wt') as fh:
-        extract_and_write_vgnc_orthologs(conf.vgnc_dump, refset_data, fh)
-
-
+        orthologs = extract_and_write_vgnc_orthologs(vgnc_lines, refset_data, fh)
+    write_vgnc_orthologs_binary(binary_orthologs_fname(conf.out), orthologs)
+    logger.info("written {} deduplicated asserted orthologs to {}"
+                .format(len(orthologs), binary_orthologs_fname(conf.out)))
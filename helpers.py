@@ -1,22 +1,183 @@
 import bz2
+import collections
 import gzip
+import io
+import lzma
 import os
 import json
+import logging
+import queue
+import shutil
+import sqlite3
+import subprocess
+import threading
+import uuid
 from io import BytesIO
 
+import perf
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger("helpers")
 
 # File opening. This is based on the example on SO here:
 # http://stackoverflow.com/a/26986344
-fmagic = {b'\x1f\x8b\x08': gzip.open,
-          b'\x42\x5a\x68': bz2.BZ2File}
+fmagic = {b'\x1f\x8b\x08': 'gzip',
+          b'\x42\x5a\x68': 'bz2',
+          b'\xfd\x37\x7a\x58\x5a\x00': 'xz',
+          b'\x28\xb5\x2f\xfd': 'zstd'}
+fext = {'gz': 'gzip', 'bz2': 'bz2', 'xz': 'xz', 'zst': 'zstd'}
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+# reading through an external multi-threaded tool only pays off for large files
+PARALLEL_MIN_SIZE = 16 << 20
+# multi-threaded command line tools per format: (tool, threads option, default compression level)
+parallel_tools = {'gzip': [('pigz', '-p{}', 9)],
+                  'bz2': [('pbzip2', '-p{}', 9), ('lbzip2', '-n{}', 9)],
+                  'xz': [('xz', '-T{}', 6)],
+                  'zstd': [('zstd', '-T{}', 3)]}
+
+
+def _stdlib_open(fmt, fn, mode, compresslevel=None):
+    if fmt == 'gzip':
+        return gzip.GzipFile(fn, mode, compresslevel=9 if compresslevel is None else compresslevel)
+    elif fmt == 'bz2':
+        return bz2.BZ2File(fn, mode, compresslevel=9 if compresslevel is None else compresslevel)
+    elif fmt == 'xz':
+        return lzma.LZMAFile(fn, mode, preset=compresslevel)
+    elif fmt == 'zstd' and zstandard is not None:
+        if 'r' in mode:
+            return zstandard.open(fn, mode)
+        return zstandard.open(fn, mode, cctx=zstandard.ZstdCompressor(level=3 if compresslevel is None else compresslevel))
+    raise ValueError("no support available to open {} compressed file {}".format(fmt, fn))
+
+
+class ProcessStream(io.RawIOBase):
+    """Raw file object that reads from the output of a decompressing
+    subprocess or writes into the input of a compressing subprocess."""
+
+    def __init__(self, cmd, fn, mode):
+        super().__init__()
+        self.cmd = cmd
+        self._eof = False
+        if 'r' in mode:
+            self.proc = subprocess.Popen(cmd + [fn], stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+            self._pipe = self.proc.stdout
+        else:
+            with open(fn, 'wb') as out:
+                self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out, stderr=subprocess.PIPE, bufsize=0)
+            self._pipe = self.proc.stdin
+
+    def readable(self):
+        return self.proc.stdout is not None
+
+    def writable(self):
+        return self.proc.stdin is not None
+
+    def readinto(self, b):
+        n = self._pipe.readinto(b)
+        if n == 0:
+            self._eof = True
+        return n
+
+    def write(self, b):
+        return self._pipe.write(b)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self._pipe.close()
+        if self.readable() and not self._eof:
+            # reader stopped early, the remaining output is not needed
+            self.proc.kill()
+        err = self.proc.stderr.read()
+        self.proc.stderr.close()
+        if self.proc.wait() != 0 and (self.writable() or self._eof):
+            raise OSError("{} failed with exit code {}: {}"
+                          .format(" ".join(self.cmd), self.proc.returncode, err.decode(errors='replace')))
+
+
+def _parallel_command(fmt, mode, threads, compresslevel=None):
+    for tool, thread_opt, default_level in parallel_tools.get(fmt, []):
+        exe = shutil.which(tool)
+        if exe is None:
+            continue
+        if 'r' in mode:
+            return [exe, '-d', '-c', thread_opt.format(threads)]
+        level = default_level if compresslevel is None else compresslevel
+        return [exe, '-c', '-{}'.format(level), thread_opt.format(threads)]
+    return None
+
+
+def _nr_threads(threads):
+    if threads is None:
+        threads = int(os.getenv('QFO_COMPRESSION_THREADS', os.cpu_count() or 1))
+    return threads
+
+
+def _open_compressed(fmt, fn, mode, buffer_size=None, threads=None, compresslevel=None,
+                     encoding=None, errors=None, newline=None):
+    bmode = mode.replace('t', '').replace('b', '')
+    raw = None
+    threads = _nr_threads(threads)
+    # without the zstandard module, zstd files can only be handled by the command line tool
+    needs_tool = fmt == 'zstd' and zstandard is None
+    use_tool = needs_tool or (threads > 1 and (bmode == 'w' or os.stat(fn).st_size >= PARALLEL_MIN_SIZE))
+    if bmode in ('r', 'w') and use_tool:
+        cmd = _parallel_command(fmt, bmode, threads, compresslevel)
+        if cmd is not None:
+            try:
+                raw = ProcessStream(cmd, fn, bmode)
+            except OSError:
+                raw = None
+    if raw is None:
+        raw = _stdlib_open(fmt, fn, bmode + 'b', compresslevel)
+    if buffer_size is None:
+        buffer_size = DEFAULT_BUFFER_SIZE
+    if bmode == 'r':
+        fh = io.BufferedReader(raw, buffer_size=buffer_size)
+    else:
+        fh = io.BufferedWriter(raw, buffer_size=buffer_size)
+    if 't' in mode:
+        fh = io.TextIOWrapper(fh, encoding=encoding, errors=errors, newline=newline)
+    return fh
 
 
-def auto_open(fn, *args, **kwargs):
+def detect_compression(fn):
+    """returns the compression format of a file (one of 'gzip', 'bz2', 'xz',
+    'zstd') or None for uncompressed files.
+
+    Existing files are identified by their magic bytes, new files by
+    their file extension."""
+    if os.path.isfile(fn) and os.stat(fn).st_size > 0:
+        with open(fn, 'rb') as fp:
+            fs = fp.read(max([len(x) for x in fmagic]))
+        for (magic, fmt) in fmagic.items():
+            if fs.startswith(magic):
+                return fmt
+    else:
+        for ext, fmt in fext.items():
+            if fn.endswith(ext):
+                return fmt
+    return None
+
+
+def auto_open(fn, mode='r', buffer_size=None, threads=None, **kwargs):
     """function to open regular or compressed files for read / write.
 
-    This function opens files based on their "magic bytes". Supports bz2
-    and gzip. If it finds neither of these, presumption is it is a
-    standard, uncompressed file.
+    This function opens files based on their "magic bytes". Supports bz2,
+    gzip, xz and zstd. If it finds neither of these, presumption is it is a
+    standard, uncompressed file. New files are compressed according to
+    their file extension.
+
+    Compressed files are read and written through multi-threaded command
+    line tools (pigz, pbzip2/lbzip2, xz and zstd) if these are available.
+    For reading, this is only done for files larger than PARALLEL_MIN_SIZE.
+    Otherwise, the python modules are used. zstd files are always handled
+    by the zstd tool if the zstandard module is not installed.
 
     Example::
 
@@ -28,6 +189,13 @@ def auto_open(fn, *args, **kwargs):
 
     :param fn: either a string of an existing or new file path, or
         a BytesIO handle
+    :param mode: the file mode. As for gzip.open, compressed files are
+        opened in binary mode unless 't' is part of the mode.
+    :param buffer_size: size of the read / write buffer in bytes.
+        Defaults to DEFAULT_BUFFER_SIZE for compressed files.
+    :param threads: number of threads used by the external (de)compression
+        tools. Defaults to the environment variable QFO_COMPRESSION_THREADS
+        or the number of cpus. A value of 1 disables the external tools.
     :param **kwargs: additional arguments that are understood by the
         underlying open handler
     :returns: a file handler
@@ -35,18 +203,181 @@ def auto_open(fn, *args, **kwargs):
     if isinstance(fn, BytesIO):
         return fn
 
-    if os.path.isfile(fn) and os.stat(fn).st_size > 0:
-        with open(fn, 'rb') as fp:
-            fs = fp.read(max([len(x) for x in fmagic]))
-        for (magic, _open) in fmagic.items():
-            if fs.startswith(magic):
-                return _open(fn, *args, **kwargs)
-    else:
-        if fn.endswith('gz'):
-            return gzip.open(fn, *args, **kwargs)
-        elif fn.endswith('bz2'):
-            return bz2.BZ2File(fn, *args, **kwargs)
-    return open(fn, *args, **kwargs)
+    fmt = detect_compression(fn)
+    if fmt is not None:
+        return _open_compressed(fmt, fn, mode, buffer_size=buffer_size, threads=threads, **kwargs)
+    if buffer_size is not None:
+        kwargs['buffering'] = buffer_size
+    return open(fn, mode, **kwargs)
+
+
+class RawOutputWriter:
+    """Text writer for large (compressed) raw output files.
+
+    Written strings are collected into batches of about batch_size
+    characters. The encoded batches are handed to a background thread
+    that writes them to the file opened with auto_open, so that the
+    compression runs concurrently with the computation producing the
+    next lines. The file content is the same as if the lines were written
+    to auto_open(fn, 'wt') directly.
+
+    Example::
+
+        with RawOutputWriter("/tmp/raw.txt.gz") as out:
+            out.write("P1\tP2\tTP\n")
+    """
+
+    def __init__(self, fn, batch_size=1 << 22, queue_size=4, encoding='utf-8', **kwargs):
+        self.fn = fn
+        self.batch_size = batch_size
+        self.encoding = encoding
+        self.lines_written = 0
+        self.bytes_written = 0
+        self._buf = []
+        self._buffered = 0
+        self._error = None
+        self._fh = auto_open(fn, 'wb', **kwargs)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._write_batches, name="raw-writer", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, s):
+        self._buf.append(s)
+        self._buffered += len(s)
+        if self._buffered >= self.batch_size:
+            self.flush()
+        return len(s)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self._error is not None:
+            raise self._error
+        if len(self._buf) == 0:
+            return
+        data = "".join(self._buf).encode(self.encoding)
+        self._buf = []
+        self._buffered = 0
+        self.lines_written += data.count(b'\n')
+        self.bytes_written += len(data)
+        self._queue.put(data)
+
+    def _write_batches(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if self._error is None:
+                try:
+                    self._fh.write(data)
+                except Exception as e:
+                    self._error = e
+
+    def close(self):
+        if self._thread is None:
+            return
+        with perf.phase("raw output") as ph:
+            try:
+                if self._error is None:
+                    self.flush()
+            finally:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+                self._fh.close()
+            ph.rows, ph.bytes = self.lines_written, self.bytes_written
+        if self._error is not None:
+            raise self._error
+        logger.info("written {} lines ({:.1f} MB uncompressed) to {}"
+                    .format(self.lines_written, self.bytes_written / 1e6, self.fn))
+
+
+class RateLimitedLogger:
+    """Wrapper around a logger that emits at most `limit` warnings of each
+    kind. Further warnings of that kind are only counted and reported in
+    the summary."""
+
+    def __init__(self, log, limit=100):
+        self.log = log
+        self.limit = limit
+        self.counts = collections.Counter()
+
+    def warning(self, kind, fmt, *args):
+        self.counts[kind] += 1
+        cnt = self.counts[kind]
+        if cnt <= self.limit:
+            self.log.warning(fmt.format(*args))
+        elif cnt == self.limit + 1:
+            self.log.warning("too many '{}' warnings, suppressing further ones".format(kind))
+
+    def log_summary(self):
+        for kind, cnt in self.counts.items():
+            if cnt > self.limit:
+                self.log.warning("{} '{}' warnings in total, {} of them suppressed"
+                                 .format(cnt, kind, cnt - self.limit))
+
+
+class JsonArrayWriter:
+    """Writes a json array to a file one element at a time.
+
+    The file content is the same as json.dump(elements, fh, sort_keys=True,
+    indent=4, separators=(',', ': ')) of the list of all elements, or
+    with compact=True the same as json.dump(elements, fh, sort_keys=True,
+    separators=(',', ':')), without holding the elements in memory.
+    Elements that go into several arrays can be serialized once with
+    encode() and added with write_encoded().
+
+    Example::
+
+        with JsonArrayWriter("/tmp/out.json") as out:
+            for obj in objects:
+                out.write(obj)
+    """
+
+    def __init__(self, fn, compact=False, sort_keys=True):
+        self.fn = fn
+        self.compact = compact
+        self.sort_keys = sort_keys
+        self.nr_elements = 0
+        self._fh = open(fn, 'w', encoding="utf-8")
+        self._fh.write("[")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def encode(self, obj):
+        """returns the text of obj as element of the array"""
+        if self.compact:
+            return json.dumps(obj, sort_keys=self.sort_keys, separators=(',', ':'))
+        text = json.dumps(obj, sort_keys=self.sort_keys, indent=4, separators=(',', ': '))
+        return "\n    " + text.replace("\n", "\n    ")
+
+    def write_encoded(self, text):
+        if self.nr_elements > 0:
+            self._fh.write(",")
+        self._fh.write(text)
+        self.nr_elements += 1
+
+    def write(self, obj):
+        self.write_encoded(self.encode(obj))
+
+    def close(self):
+        if self._fh is None:
+            return
+        self._fh.write("\n]" if self.nr_elements > 0 and not self.compact else "]")
+        self._fh.close()
+        self._fh = None
 
 
 def unique(seq):
@@ -62,3 +393,40 @@ def load_json_file(path):
     with auto_open(path, 'rb') as fh:
         data = json.loads(fh.read().decode('utf-8'))
     return data
+
+
+def connect_db(db_path):
+    """opens a sqlite database. db_path is either a file path or a sqlite
+    URI filename (starting with 'file:'), e.g. of a shared in-memory
+    database created by :func:`load_db_into_memory`."""
+    db_path = str(db_path)
+    return sqlite3.connect(db_path, uri=db_path.startswith("file:"))
+
+
+def load_db_into_memory(db_path):
+    """copies a sqlite database into a shared in-memory database.
+
+    Returns the URI of the in-memory database, which can be opened by
+    several threads of this process with :func:`connect_db`, and the
+    connection that keeps the in-memory database alive. Once this
+    connection is closed, the in-memory database is discarded."""
+    uri = "file:qfo-{}?mode=memory&cache=shared".format(uuid.uuid4().hex)
+    keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    src = sqlite3.connect(str(db_path))
+    try:
+        src.backup(keeper)
+    finally:
+        src.close()
+    return uri, keeper
+
+
+def parse_participant(arg):
+    """returns the (name, db_path) of a participant given as "name=db_path"
+    or as db_path, in which case the name is the file name of the database
+    without extension"""
+    if "=" in arg:
+        name, db = arg.split("=", 1)
+    else:
+        db = arg
+        name = os.path.splitext(os.path.basename(db))[0]
+    return name, db
@@ -40,6 +40,8 @@ if (params.help) {
         --statsdir              The output directory with nextflow statistics
         --data_model_export_dir The output dir where json file with benchmarking data model contents will be saved
         --otherdir              The output directory where custom results will be saved (no directory inside)
+        --cache_dir             Directory of a cache of validated and converted predictions. Re-submissions of
+                                the same file against the same reference set reuse the cached results
 
     Flags:
         --help                  Display this message¬
@@ -91,12 +93,17 @@ assessment_out = file(params.assessment_results)
 result_file_path = file(params.outdir, type: 'dir')
 data_model_export_dir = file(params.data_model_export_dir)
 otherdir = file(params.otherdir, type: 'dir')
+cache_dir = params.cache_dir ? file(params.cache_dir, type: 'dir') : null
+cache_opt = cache_dir ? "--cache-dir $cache_dir" : ""
+// the cache is kept across runs, so it is mounted read-write into the containers
+cache_mount = !cache_dir ? "" : workflow.containerEngine == 'singularity' ? "-B $cache_dir" : "-v $cache_dir:$cache_dir"
 
 // create output directories
 assessment_out.parent.mkdirs()
 result_file_path.mkdirs()
 data_model_export_dir.parent.mkdirs()
 otherdir.mkdirs()
+if (cache_dir) cache_dir.mkdirs()
 
 
 /*
@@ -104,6 +111,7 @@ otherdir.mkdirs()
  */
 process validate_input_file {
     label "py"
+    containerOptions cache_mount
 
     input:
     path predictions
@@ -117,7 +125,7 @@ process validate_input_file {
     path "participant.json" into PARTICIPANT_STUB
 
     """
-    /benchmark/validate.py --com $community_id --challenges_ids "$benchmarks" --participant "$method_name" --out "participant.json" $refset_dir/mapping.json.gz $predictions
+    /benchmark/validate.py $cache_opt --com $community_id --challenges_ids "$benchmarks" --participant "$method_name" --out "participant.json" $refset_dir/mapping.json.gz $predictions
     """
 }
 
@@ -144,6 +152,7 @@ sqlite_db.into(db_sp, db_vgnc, db_fas)
 process convertPredictions {
 
     label "py"
+    containerOptions cache_mount
     publishDir path: "$otherdir", saveAs: {file -> (file == 'orthologs.db') ? "${method_name}.db" : null}, mode: "copy", enabled: params.cpy_sqlite_db
 
     input:
@@ -160,7 +169,7 @@ process convertPredictions {
     file_validated == 0
 
     """
-    /benchmark/map_relations.py --out predictions.db --db orthologs.db $refset_dir/mapping.json.gz $predictions
+    /benchmark/map_relations.py $cache_opt --out predictions.db --db orthologs.db $refset_dir/mapping.json.gz $predictions
     """
 }
 
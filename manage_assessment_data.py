@@ -1,74 +1,220 @@
 from __future__ import division
 
+import bisect
 import collections
+import concurrent.futures
+import hashlib
 import io
+import multiprocessing
 import shutil
 import json
 import os
 import fnmatch
 from argparse import ArgumentParser
-import numpy as np
-import pandas
-import matplotlib
-matplotlib.use("SVG")
-import matplotlib.pyplot as plt
-plt.ioff()
 import logging
-logger = logging.getLogger('manage_assessment_data')
-
 
-def main(metrics_data_files, benchmark_data_dir, output_dir):
+import perf
+logger = logging.getLogger('manage_assessment_data')
+# matplotlib is slow to import and only needed to draw the charts. It is
+# loaded on first use by load_pyplot()
+plt = None
+CHART_FORMATS = ("svg", "pdf", "png")
+# increase whenever the look of the charts changes, so that existing
+# charts are not reused
+CHART_VERSION = 1
+# name of the cached index of the benchmark data directory
+INDEX_CACHE = ".aggregation_index.json"
+
+
+def load_pyplot():
+    global plt
+    if plt is None:
+        import matplotlib
+        matplotlib.use("SVG")
+        import matplotlib.pyplot
+        plt = matplotlib.pyplot
+        plt.ioff()
+    return plt
+
+
+def main(metrics_data_files, benchmark_data_dir, output_dir, formats=("svg", "pdf"), nr_procs=1, force=False,
+         index_cache=None, nr_threads=8):
     logger.debug('{}, {}, {}'.format(metrics_data_files, benchmark_data_dir, output_dir))
     # read participant metrics
-    participant_data = read_metrics_stubs(metrics_data_files)
-    generate_manifest(benchmark_data_dir, output_dir, participant_data)
-
-
-def read_metrics_stubs(metrics_stubs):
+    with perf.phase("read stubs", rows=len(metrics_data_files)):
+        participant_data = read_metrics_stubs(metrics_data_files, nr_threads=nr_threads)
+    index = AggregationFileIndex(benchmark_data_dir, cache_file=index_cache)
+    charts = generate_manifest(benchmark_data_dir, output_dir, participant_data, index=index)
+    index.save()
+    with perf.phase("charts", rows=len(charts)):
+        render_charts(charts, formats, nr_procs=nr_procs, force=force)
+
+
+def _load_metrics_stub(result_file):
+    logger.debug('loading data in {}'.format(result_file))
+    with io.open(result_file, mode='r', encoding="utf-8") as f:
+        result = json.load(f)
+    return result if isinstance(result, list) else [result]
+
+
+def read_metrics_stubs(metrics_stubs, nr_threads=8):
+    """loads the assessment stubs with a pool of threads. The entries are
+    grouped by challenge in the order of the stub files"""
+    stub_files = [result_file for result_file in metrics_stubs
+                  if fnmatch.fnmatch(result_file, "*.json") and os.path.isfile(result_file)]
     participant_data = collections.defaultdict(list)
-    for result_file in metrics_stubs:
-        if fnmatch.fnmatch(result_file, "*.json") and os.path.isfile(result_file):
-            logger.debug('loading data in {}'.format(result_file))
-            with io.open(result_file, mode='r', encoding="utf-8") as f:
-                result = json.load(f)
-            if not isinstance(result, list):
-                result = [result]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, nr_threads)) as ex:
+        for result in ex.map(_load_metrics_stub, stub_files):
             for res in result:
                 participant_data[res['challenge_id']].append(res)
-            logger.debug('loaded data in {}'.format(result_file))
     return participant_data
 
 
-def all_datafiles_for_challenge(data_dir, challenge):
-    def json_files_for_challenge(base, challenge):
-        for file in os.scandir(base):
-            if file.name.startswith(challenge) and file.name.endswith('.json'):
-                fnd = True
-                yield file
-
-    fnd = False
-    nested_dir = os.path.join(data_dir, challenge)
-    if os.path.isdir(nested_dir):
-        yield from json_files_for_challenge(nested_dir, challenge)
-    if not fnd:
-        yield from json_files_for_challenge(data_dir, challenge)
+class AggregationFileIndex:
+    """index of the json files in the benchmark data directory and its
+    challenge subdirectories.
+
+    Every directory is scanned at most once. The sorted file names are
+    cached together with the modification time of the directory in
+    cache_file, so that unchanged directories are not scanned again in
+    later runs. The cache file should be kept outside of data_dir, as
+    writing it changes the modification time of its directory."""
+    VERSION = 1
+
+    def __init__(self, data_dir, cache_file=None):
+        self.data_dir = data_dir
+        self.cache_file = cache_file
+        self._cache_path = os.path.abspath(cache_file) if cache_file is not None else None
+        self._dirs = {}
+        self._modified = False
+        if cache_file is not None:
+            self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_file, 'rt') as fh:
+                cache = json.load(fh)
+            if cache.get('version') == self.VERSION and cache.get('data_dir') == os.path.abspath(self.data_dir):
+                self._dirs = cache['dirs']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        if self.cache_file is None or not self._modified:
+            return
+        try:
+            tmp = "{}.{}.tmp".format(self.cache_file, os.getpid())
+            with open(tmp, 'wt') as fh:
+                json.dump({'version': self.VERSION, 'data_dir': os.path.abspath(self.data_dir), 'dirs': self._dirs}, fh)
+            os.replace(tmp, self.cache_file)
+            self._modified = False
+        except OSError as e:
+            logger.debug("cannot store index of {} in {}: {}".format(self.data_dir, self.cache_file, e))
+
+    def _json_files(self, subdir):
+        path = os.path.join(self.data_dir, subdir)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return []
+        cached = self._dirs.get(subdir)
+        if cached is None or cached['mtime_ns'] != mtime:
+            logger.debug("scanning {}".format(path))
+            names = sorted(entry.name for entry in os.scandir(path)
+                           if entry.name.endswith('.json') and entry.is_file()
+                           and os.path.abspath(entry.path) != self._cache_path)
+            cached = self._dirs[subdir] = {'mtime_ns': mtime, 'files': names}
+            self._modified = True
+        return cached['files']
+
+    def files_for_challenge(self, challenge):
+        """returns the paths of the json files whose names start with the
+        challenge. Files in a subdirectory named after the challenge take
+        precedence over the ones directly in the data directory."""
+        for subdir in (challenge, ""):
+            if subdir and not os.path.isdir(os.path.join(self.data_dir, subdir)):
+                continue
+            names = self._json_files(subdir)
+            # names are sorted, so all matches follow the first one
+            matches = []
+            for name in names[bisect.bisect_left(names, challenge):]:
+                if not name.startswith(challenge):
+                    break
+                matches.append(os.path.join(self.data_dir, subdir, name))
+            if matches:
+                return matches
+        return []
 
 
-def generate_manifest(data_dir, output_dir, participant_data):
+def all_datafiles_for_challenge(data_dir, challenge):
+    return AggregationFileIndex(data_dir).files_for_challenge(challenge)
+
+
+def _indent_json(obj, indent):
+    return indent + json.dumps(obj, sort_keys=True, indent=4, separators=(',', ': ')).replace("\n", "\n" + indent)
+
+
+def append_participants(text, participants, new_entries):
+    """adds new_entries to the challenge_participants array of the json
+    document text, keeping the rest of the text unchanged. participants
+    is the parsed content of the array. The entries are formatted like
+    json.dump(sort_keys=True, indent=4) does. Returns None if the array
+    cannot be located in the text or the text is not indented."""
+    decoder = json.JSONDecoder()
+    key = '"challenge_participants"'
+    pos = text.find(key)
+    while pos >= 0:
+        start = pos + len(key)
+        while start < len(text) and text[start] in ' \t\r\n:':
+            start += 1
+        try:
+            value, end = decoder.raw_decode(text, start)
+        except ValueError:
+            value = None
+        if value == participants and text[start] == '[':
+            break
+        pos = text.find(key, pos + 1)
+    else:
+        return None
+    if not new_entries:
+        return text
+    key_indent = text[text.rfind("\n", 0, pos) + 1:pos]
+    if key_indent.strip():
+        # not an indented document, e.g. everything on a single line
+        return None
+    items = ",\n".join(_indent_json(entry, key_indent + "    ") for entry in new_entries)
+    if participants:
+        # insert after the last element, before whitespace and closing bracket
+        last = end - 1
+        while text[last - 1] in ' \t\r\n':
+            last -= 1
+        return text[:last] + ",\n" + items + text[last:]
+    return text[:start] + "[\n" + items + "\n" + key_indent + "]" + text[end:]
+
+
+def generate_manifest(data_dir, output_dir, participant_data, index=None):
+    """writes the updated aggregation files and the manifest. Returns the
+    list of charts to draw as (output_dir, summary_file, challenge,
+    classification_type) tuples"""
+    if index is None:
+        index = AggregationFileIndex(data_dir)
     info = []
+    charts = []
     for challenge, metrics in participant_data.items():
         added_challenge_to_manifest = False
-        for challenge_oeb_data in all_datafiles_for_challenge(data_dir, challenge):
-            logger.debug('loading ' + challenge_oeb_data.path)
-            participants = []
+        for challenge_oeb_data in index.files_for_challenge(challenge):
+            logger.debug('loading ' + challenge_oeb_data)
             # Transferring the public participants data
             with io.open(challenge_oeb_data, mode='r', encoding="utf-8") as f:
-                aggregation_file = json.load(f)
+                text = f.read()
+            aggregation_file = json.loads(text)
+            inline_data = aggregation_file["datalink"]["inline_data"]
             # get id for metrics in x and y axis
-            metric_X = aggregation_file["datalink"]["inline_data"]["visualization"]["x_axis"]
-            metric_Y = aggregation_file["datalink"]["inline_data"]["visualization"]["y_axis"]
+            metric_X = inline_data["visualization"]["x_axis"]
+            metric_Y = inline_data["visualization"]["y_axis"]
 
-            # add new participant data to aggregation file
+            # collect new participant data for the aggregation file
+            new_entries = []
             new_participant_data = {}
             for metrics_data in metrics:
                 participant_id = metrics_data["participant_id"]
@@ -82,26 +228,33 @@ def generate_manifest(data_dir, output_dir, participant_data):
                     # copy the assessment files to output directory
                     new_participant_data["participant_id"] = participant_id
                     logger.debug("new participant_data: {}".format(new_participant_data))
-                    aggregation_file["datalink"]["inline_data"]["challenge_participants"].append(new_participant_data)
+                    new_entries.append(new_participant_data)
                     new_participant_data = {}
 
             # add the rest of participants to manifest
-            for name in aggregation_file["datalink"]["inline_data"]["challenge_participants"]:
-                participants.append(name["participant_id"])
+            existing = inline_data["challenge_participants"]
+            participants = [name["participant_id"] for name in existing + new_entries]
 
-            #copy the updated aggregation file to output directory
+            # copy the updated aggregation file to output directory. The new
+            # participants are spliced into the original text; the file is
+            # only serialized again if the participants cannot be located.
             per_challenge_output = os.path.join(output_dir, challenge)
             if not os.path.exists(per_challenge_output):
                 os.makedirs(per_challenge_output)
-            summary_file = os.path.join(per_challenge_output, challenge_oeb_data.name)
-            with open(summary_file, 'w') as f:
-                json.dump(aggregation_file, f, sort_keys=True, indent=4, separators=(',', ': '))
+            summary_file = os.path.join(per_challenge_output, os.path.basename(challenge_oeb_data))
+            updated = append_participants(text, existing, new_entries)
+            with io.open(summary_file, mode='w', encoding="utf-8") as f:
+                if updated is not None:
+                    f.write(updated)
+                else:
+                    existing.extend(new_entries)
+                    json.dump(aggregation_file, f, sort_keys=True, indent=4, separators=(',', ': '))
 
 
             # Let's draw the assessment charts!
-            print_chart(per_challenge_output, summary_file, challenge, "RAW")
-            #print_chart(per_challenge_output, summary_file, challenge, "SQR")
-            #print_chart(per_challenge_output, summary_file, challenge, "DIAG")
+            charts.append((per_challenge_output, summary_file, challenge, "RAW"))
+            #charts.append((per_challenge_output, summary_file, challenge, "SQR"))
+            #charts.append((per_challenge_output, summary_file, challenge, "DIAG"))
 
             #generate manifest, only once per challenge, not per visualization variant
             if not added_challenge_to_manifest:
@@ -114,6 +267,59 @@ def generate_manifest(data_dir, output_dir, participant_data):
 
     with io.open(os.path.join(output_dir, "Manifest.json"), mode='w', encoding="utf-8") as f:
         json.dump(info, f, sort_keys=True, indent=4, separators=(',', ': '))
+    return charts
+
+
+def chart_basename(challenge, classification_type, x_axis, y_axis):
+    return (challenge + "_benchmark_" + classification_type + "-" + x_axis + "-" + y_axis).replace(' ', '_')
+
+
+def chart_content_hash(summary_file, classification_type):
+    h = hashlib.sha256("{}:{}:".format(CHART_VERSION, classification_type).encode('utf-8'))
+    with open(summary_file, 'rb') as fh:
+        h.update(fh.read())
+    return h.hexdigest()
+
+
+def render_chart(outdir_dir, summary_file, challenge, classification_type, formats, force=False):
+    """draws a chart unless it already exists for the same aggregation
+    data. The content hash of the drawn data is stored in a hidden sidecar
+    file next to the chart. Returns whether the chart was drawn."""
+    with io.open(summary_file, mode='r', encoding="utf-8") as f:
+        visualization = json.load(f)['datalink']['inline_data']['visualization']
+    base = os.path.join(outdir_dir, chart_basename(challenge, classification_type,
+                                                   visualization['x_axis'], visualization['y_axis']))
+    sidecar = os.path.join(outdir_dir, "." + os.path.basename(base) + ".hash")
+    content_hash = chart_content_hash(summary_file, classification_type)
+    if not force and all(os.path.exists(base + "." + fmt) for fmt in formats):
+        try:
+            with open(sidecar, 'rt') as fh:
+                if fh.read().strip() == content_hash:
+                    logger.debug("chart {} is up to date".format(base))
+                    return False
+        except OSError:
+            pass
+    print_chart(outdir_dir, summary_file, challenge, classification_type, formats=formats)
+    with open(sidecar, 'wt') as fh:
+        fh.write(content_hash + "\n")
+    return True
+
+
+def _render_chart_task(args):
+    return render_chart(*args)
+
+
+def render_charts(charts, formats, nr_procs=1, force=False):
+    """draws the charts in a pool of nr_procs processes"""
+    tasks = [chart + (formats, force) for chart in charts]
+    nr_procs = min(nr_procs, len(tasks))
+    if nr_procs <= 1:
+        drawn = [_render_chart_task(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(nr_procs, initializer=load_pyplot) as pool:
+            drawn = pool.map(_render_chart_task, tasks)
+    logger.info("drew {} charts, {} were up to date".format(sum(drawn), len(drawn) - sum(drawn)))
+    return drawn
 
 
 def pareto_frontier(Xs, Ys, maxX=True, maxY=True):
@@ -137,6 +343,7 @@ def pareto_frontier(Xs, Ys, maxX=True, maxY=True):
 
 # funtion that gets quartiles for x and y values
 def plot_square_quartiles(x_values, means, tools, better, ax, percentile=50):
+    import numpy as np
     x_percentile, y_percentile = (np.nanpercentile(x_values, percentile), np.nanpercentile(means, percentile))
     plt.axvline(x=x_percentile, linestyle='--', color='#0A58A2', linewidth=1.5)
     plt.axhline(y=y_percentile, linestyle='--', color='#0A58A2', linewidth=1.5)
@@ -238,6 +445,7 @@ def get_quartile_points(scores_and_values, first_quartile, second_quartile, thir
 
 # funtion that separate the points through diagonal quartiles based on the distance to the 'best corner'
 def plot_diagonal_quartiles(x_values, means, tools, better):
+    import numpy as np
     # get distance to lowest score corner
 
     # normalize data to 0-1 range
@@ -285,6 +493,7 @@ def plot_diagonal_quartiles(x_values, means, tools, better):
 
 # function that prints a table with the list of tools and the corresponding quartiles
 def print_quartiles_table(tools_quartiles):
+    import pandas
     row_names = tools_quartiles.keys()
     quartiles_1 = tools_quartiles.values()
 
@@ -313,7 +522,8 @@ def print_quartiles_table(tools_quartiles):
     plt.subplots_adjust(right=0.65, bottom=0.2)
 
 
-def print_chart(outdir_dir, summary_file, challenge, classification_type):
+def print_chart(outdir_dir, summary_file, challenge, classification_type, formats=("svg", "pdf")):
+    load_pyplot()
     tools = []
     x_values = []
     y_values = []
@@ -427,13 +637,12 @@ def print_chart(outdir_dir, summary_file, challenge, classification_type):
         tools_quartiles = plot_diagonal_quartiles(x_values, y_values, tools, better)
         print_quartiles_table(tools_quartiles)
 
-    outname = (challenge + "_benchmark_" + classification_type + "-" +
-              x_axis + "-" + y_axis + ".svg").replace(' ', '_')
-    outpath = os.path.join(outdir_dir, outname)
+    outpath = os.path.join(outdir_dir, chart_basename(challenge, classification_type, x_axis, y_axis))
+    # the figure is laid out once and saved in all requested formats
     fig = plt.gcf()
     fig.set_size_inches(18.5, 10.5)
-    fig.savefig(outpath, dpi=100)
-    fig.savefig(outpath[:-3]+"pdf", dpi=100)
+    for fmt in formats:
+        fig.savefig(outpath + "." + fmt, dpi=100)
     plt.close("all")
 
 
@@ -445,9 +654,25 @@ if __name__ == '__main__':
                         help="dir where the data for the benchmark are stored", )
     parser.add_argument("-o", "--output", required=True,
                         help="output directory where the manifest, summary data and figures are written", )
+    parser.add_argument("--formats", nargs='+', choices=CHART_FORMATS, default=["svg", "pdf"],
+                        help="file formats of the charts")
+    parser.add_argument("-p", "--procs", type=int, default=multiprocessing.cpu_count(),
+                        help="number of processes drawing the charts")
+    parser.add_argument("--force", action='store_true',
+                        help="draw all charts, even if they are up to date")
+    parser.add_argument("--index-cache",
+                        help="file to cache the index of the benchmark data directory in. Defaults to "
+                             "{} in the output directory".format(INDEX_CACHE))
+    parser.add_argument("-t", "--threads", type=int, default=8,
+                        help="number of threads reading the assessment metrics")
     parser.add_argument("-d", "--debug", action='store_true', help="Turn on debugging output")
     args = parser.parse_args()
     level = logging.DEBUG if args.debug else logging.INFO
     logging.basicConfig(level=level)
 
-    main(args.metrics_data, args.benchmark_data, args.output)
+    perf.start("manage_assessment_data", args.output)
+    index_cache = args.index_cache
+    if index_cache is None:
+        index_cache = os.path.join(args.output, INDEX_CACHE)
+    main(args.metrics_data, args.benchmark_data, args.output, formats=args.formats, nr_procs=args.procs,
+         force=args.force, index_cache=index_cache, nr_threads=args.threads)
@@ -3,8 +3,8 @@ import collections
 import csv
 import json
 import math
+import os
 import sys
-from bisect import bisect_right
 from time import time
 try:
     import lxml.etree as etree
@@ -14,7 +14,15 @@ import re
 import itertools
 import sqlite3
 import logging
-from helpers import auto_open, unique, load_json_file
+
+import numpy
+
+import binary_predictions
+import perf
+import reference_indexes
+from conversion_cache import ConversionCache
+from helpers import auto_open, unique, RateLimitedLogger
+from refset import ReferenceProteomes
 logger = logging.getLogger("relations-processor")
 
 
@@ -37,31 +45,35 @@ def encode_nr_as_seq(nr):
 
 
 def load_mapping(path):
-    return load_json_file(path)
+    return reference_indexes.load_mapping(path)
 
 
 class PairwiseOrthologRelationExtractor(object):
-    def __init__(self, mapping_data, dbi):
-        self.valid_id_map = mapping_data['mapping']
-        self.internal_genome_offs = mapping_data['Goff']
-        self.species_order = mapping_data['species']
-        self.excluded_ids = mapping_data['excluded_ids'] if 'excluded_ids' in mapping_data else set([])
+    def __init__(self, refset, dbi):
+        self.refset = refset
+        self.valid_id_map = self.refset.mapping
+        self.excluded_ids = self.refset.excluded_ids
         self.dbi = dbi
         self.genome_cnt = 0
-        self.generef_to_internal_id = {}
-        self.internal_to_genome_nr = {}
+        # geneRef id -> (internal id, number of the species element) of all
+        # mapped genes. Relations within the same species element are skipped
+        self.generef_table = {}
+        # inverse index: internal id -> first geneRef mapping to it, and
+        # the further geneRefs for internal ids used by several genes
+        self.internal_id_to_generef = {}
+        self.duplicated_generefs = collections.defaultdict(list)
         self.processed_stats = {'last': time(), 'processed_toplevel': 0, 'relations': 0}
 
     def add_genome_genes(self, genome_node):
         self.genome_cnt += 1
+        gene_ids = []
         internal_ids = []
         for gene in genome_node.findall('.//{http://orthoXML.org/2011/}gene'):
             gene_id = gene.get('id')
             gene_prot_id = gene.get('protId')
             try:
                 internal_id = self.valid_id_map[gene_prot_id]
-                self.generef_to_internal_id[int(gene_id)] = internal_id
-                self.internal_to_genome_nr[internal_id] = self.genome_cnt
+                gene_ids.append(int(gene_id))
                 internal_ids.append(internal_id)
             except KeyError:
                 if gene_prot_id not in self.excluded_ids:
@@ -70,28 +82,30 @@ class PairwiseOrthologRelationExtractor(object):
         if len(internal_ids) == 0:
             logger.info("Genome {} does not contain any mapped genes".format(genome_node.get('name')))
             return True
-        min_id = min(internal_ids) - 1
-        max_id = max(internal_ids) - 1
-        k_min = bisect_right(self.internal_genome_offs, min_id)
-        k_max = bisect_right(self.internal_genome_offs, max_id)
-        if k_min != k_max:
-            cnts = collections.Counter(
-                (self.species_order[bisect_right(self.internal_genome_offs, int_id-1) - 1]
-                for int_id in internal_ids)).most_common()
+        genomes = self.refset.genome_of(numpy.array(internal_ids))
+        if (genomes != genomes[0]).any():
+            cnts = collections.Counter(self.refset.species[g] for g in genomes.tolist()).most_common()
             logger.error("Not all crossreferences used in species '{}' map to the same species: {}"
                          .format(genome_node.get('name'), cnts))
             return False
+        for gene_id, internal_id in zip(gene_ids, internal_ids):
+            self.generef_table[gene_id] = (internal_id, self.genome_cnt)
+            first = self.internal_id_to_generef.setdefault(internal_id, gene_id)
+            if first != gene_id:
+                self.duplicated_generefs[internal_id].append(gene_id)
         return True
 
-    def check_unique_id_mapping(self):
-        mapping_ok = True
-        c = collections.Counter(self.generef_to_internal_id.values())
-        for internal_id, cnts in filter(lambda x: x[1]>1, c.most_common()):
-            gene_refs = list(filter(lambda x: x[1]==internal_id, self.generef_to_internal_id.items()))
+    def check_unique_id_mapping(self, max_reported=20):
+        dups = sorted(self.duplicated_generefs.items(), key=lambda x: -len(x[1]))
+        for internal_id, generefs in dups[:max_reported]:
+            gene_refs = [(gene_id, internal_id) for gene_id in [self.internal_id_to_generef[internal_id]] + generefs]
             logger.error("{} different geneRefs {} map to the same reference protein"
-                         .format(cnts, gene_refs))
-            mapping_ok = False
-        return mapping_ok
+                         .format(len(gene_refs), gene_refs))
+        if len(dups) > max_reported:
+            logger.error("{} further reference proteins are used by several geneRefs ({} geneRefs in total)"
+                         .format(len(dups) - max_reported,
+                                 sum(len(generefs) + 1 for _, generefs in dups[max_reported:])))
+        return len(dups) == 0
 
     def log_progress(self):
         logger.info("processed {} toplevel orthologGroups with {} induced pairwise relations"
@@ -105,7 +119,7 @@ class PairwiseOrthologRelationExtractor(object):
             nonlocal nr_rels
             if node.tag == "{http://orthoXML.org/2011/}geneRef":
                 try:
-                    return {self.generef_to_internal_id[int(node.get('id'))]}
+                    return {self.generef_table[int(node.get('id'))]}
                 except KeyError:
                     logger.info("skipping relations involving gene(id={})".format(node.get('id')))
                     return set([])
@@ -113,8 +127,8 @@ class PairwiseOrthologRelationExtractor(object):
                 nodes_of_children = [_rec_extract(child) for child in node]
                 if node.tag == '{http://orthoXML.org/2011/}orthologGroup':
                     for child1, child2 in itertools.combinations(nodes_of_children, 2):
-                        for gId1, gId2 in itertools.product(child1, child2):
-                            if self.internal_to_genome_nr[gId1] != self.internal_to_genome_nr[gId2]:
+                        for (gId1, genome1), (gId2, genome2) in itertools.product(child1, child2):
+                            if genome1 != genome2:
                                 self.dbi.add_orthologs(gId1, gId2)
                                 nr_rels += 1
                 nodes = set.union(*nodes_of_children)
@@ -148,7 +162,7 @@ def parse_orthoxml(fh, processor):
             og_level += 1
         elif event == 'start' and elem.tag == fixtag('', 'groups'):
             if not processor.check_unique_id_mapping():
-                sys.exit(2)
+                perf.exit(2)
         if event == 'end':
             if elem.tag == fixtag('', 'orthologGroup'):
                 og_level -= 1
@@ -157,42 +171,72 @@ def parse_orthoxml(fh, processor):
                     elem.clear()
             elif elem.tag == fixtag('', 'species'):
                 if not processor.add_genome_genes(elem):
-                    sys.exit(2)
+                    perf.exit(2)
                 elem.clear()
     processor.log_progress()
 
 
-def parse_tsv(fh, mapping_data):
+def parse_tsv(fh, refset, chunk_size=1 << 24):
+    """parses a tab-separated file with pairwise orthologs in chunks of
+    about chunk_size characters.
+
+    For every chunk, the ids are mapped to prot_nrs in bulk and relations
+    with unknown ids or within the same genome are removed. The remaining
+    relations are yielded as a deduplicated int32 array of (min, max)
+    prot_nr pairs."""
     logger.info("start mapping of tsv formatted input data")
-    valid_id_map = mapping_data['mapping']
-    excluded_ids = mapping_data['excluded_ids'] if 'excluded_ids' in mapping_data else set([])
-    goff = mapping_data['Goff']
-    dialect = csv.Sniffer().sniff(fh.read(2048))
-    fh.seek(0)
-    csv_reader = csv.reader(fh, dialect)
-    for line_nr, row in enumerate(csv_reader):
-        if len(row) < 2:
-            logger.warning("skipping relation on line {} ({})"
-                           .format(line_nr, row))
-            continue
-        try:
-            id1, id2 = (valid_id_map[z] for z in row[:2])
-            if bisect_right(goff, id1 - 1) == bisect_right(goff, id2 - 1):
-                logger.warning("skipping dubious orthology relation {} within same gnome"
-                               .format(row))
-                continue
-            yield id1, id2
-        except KeyError:
+    valid_id_map = refset.mapping
+    excluded_ids = refset.excluded_ids
+    warn = RateLimitedLogger(logger)
+    dialect = None
+    line_offset = 0
+    while True:
+        lines = fh.readlines(chunk_size)
+        if len(lines) == 0:
+            break
+        if dialect is None:
+            dialect = csv.Sniffer().sniff("".join(lines)[:2048])
+        # the sniffer always reports QUOTE_MINIMAL, so quoted fields are
+        # only split directly if the chunk contains no quote characters
+        if (dialect.delimiter == '\t' and not dialect.skipinitialspace
+                and not any(dialect.quotechar in line for line in lines)):
+            rows = [line.rstrip('\r\n').split('\t') for line in lines]
+        else:
+            rows = list(csv.reader(lines, dialect))
+        short_rows = [k for k, row in enumerate(rows) if len(row) < 2]
+        if len(short_rows) > 0:
+            for k in short_rows:
+                warn.warning("short line", "skipping relation on line {} ({})", line_offset + k, rows[k])
+            rows = [row for row in rows if len(row) >= 2]
+        line_offset += len(lines)
+
+        ids1 = numpy.fromiter(map(valid_id_map.get, (row[0] for row in rows), itertools.repeat(0)),
+                              dtype="int32", count=len(rows))
+        ids2 = numpy.fromiter(map(valid_id_map.get, (row[1] for row in rows), itertools.repeat(0)),
+                              dtype="int32", count=len(rows))
+        unknown = (ids1 == 0) | (ids2 == 0)
+        for k in numpy.flatnonzero(unknown):
+            row = rows[k]
             unkn = list(itertools.filterfalse(lambda x: x in valid_id_map, row[:2]))
             unkn = list(itertools.filterfalse(lambda x: x in excluded_ids, unkn))
-            if len(unkn)>0:
-                logger.warning("relation {} contains unknown ID: {}".format(row, unkn))
+            if len(unkn) > 0:
+                warn.warning("unknown id", "relation {} contains unknown ID: {}", row, unkn)
+        same_genome = ~unknown & refset.same_genome(ids1, ids2)
+        for k in numpy.flatnonzero(same_genome):
+            warn.warning("same genome", "skipping dubious orthology relation {} within same gnome", rows[k])
+
+        keep = ~(unknown | same_genome)
+        ids1, ids2 = ids1[keep], ids2[keep]
+        pairs = numpy.unique(numpy.minimum(ids1, ids2).astype("int64") << 32 | numpy.maximum(ids1, ids2))
+        yield numpy.column_stack((pairs >> 32, pairs & 0xFFFFFFFF)).astype("int32")
+    warn.log_summary()
 
 
 class DatabaseInterface(object):
     def __init__(self, fname):
         self.fname = fname
         self._ortholog_buffer = []
+        self.nr_inserted = 0
 
     def __enter__(self):
         self.con = sqlite3.connect(self.fname)
@@ -206,15 +250,14 @@ class DatabaseInterface(object):
     def commit(self):
         self.con.commit()
 
-    def add_reference_proteomes(self, mapping):
+    def add_reference_proteomes(self, refset):
 
         def yield_uniprot_proteins():
-            goff = mapping['Goff']
-            species = mapping['species']
-            for xref, prot_nr in mapping['mapping'].items():
+            genome_of = refset.genome_idx.tolist()
+            species = refset.species
+            for xref, prot_nr in refset.mapping.items():
                 if RE_UP.match(xref):
-                    gnr = bisect_right(goff, prot_nr - 1)
-                    yield prot_nr, xref, species[gnr - 1]
+                    yield prot_nr, xref, species[genome_of[prot_nr]]
 
         cur = self.con.cursor()
         cur.execute("""DROP TABLE IF EXISTS proteomes""")
@@ -223,8 +266,10 @@ class DatabaseInterface(object):
                          uniprot_id CHAR(10), 
                          species CHAR(5)
                        )""")
-        cur.executemany("INSERT INTO proteomes VALUES (?,?,?)", yield_uniprot_proteins())
-        self.commit()
+        with perf.phase("proteome insert") as ph:
+            cur.executemany("INSERT INTO proteomes VALUES (?,?,?)", yield_uniprot_proteins())
+            self.commit()
+            ph.rows = cur.rowcount
 
     def create_pairwise_ortholog_table(self):
         cur = self.con.cursor()
@@ -237,22 +282,36 @@ class DatabaseInterface(object):
 
     def create_index_of_orthologs(self):
         logger.info("creating index of orthologs...")
-        cur = self.con.cursor()
-        cur.execute("CREATE INDEX pair ON orthologs (prot_nr1, prot_nr2)")
+        with perf.phase("index build", rows=self.nr_inserted):
+            cur = self.con.cursor()
+            cur.execute("CREATE INDEX pair ON orthologs (prot_nr1, prot_nr2)")
+            self.commit()
         logger.info("finished indexing")
-        self.commit()
 
     def add_orthologs(self, p1, p2):
         self._ortholog_buffer.extend([(p1, p2), (p2, p1)])
         if len(self._ortholog_buffer) > 200000:
             self.flush()
 
-    def flush(self):
-        if len(self._ortholog_buffer) > 0:
+    def add_ortholog_block(self, pairs):
+        """adds an int array of shape (n, 2) with pairwise orthologs.
+        Both orientations of every pair are stored."""
+        with perf.phase("insert", rows=2 * len(pairs)):
+            p1, p2 = pairs[:, 0].tolist(), pairs[:, 1].tolist()
             self.con.cursor().executemany(
                 "INSERT INTO orthologs VALUES (?,?)",
-                self._ortholog_buffer)
+                itertools.chain(zip(p1, p2), zip(p2, p1)))
             self.commit()
+        self.nr_inserted += 2 * len(pairs)
+
+    def flush(self):
+        if len(self._ortholog_buffer) > 0:
+            with perf.phase("insert", rows=len(self._ortholog_buffer)):
+                self.con.cursor().executemany(
+                    "INSERT INTO orthologs VALUES (?,?)",
+                    self._ortholog_buffer)
+                self.commit()
+            self.nr_inserted += len(self._ortholog_buffer)
             self._ortholog_buffer = []
 
     def get_orthologs_of(self, prot_nr):
@@ -281,49 +340,68 @@ class DatabaseInterface(object):
 
 
 
-def identify_input_type_and_parse(fpath, mapping_data, db_path):
+def parse_predictions(fpath, refset, sink):
+    """parses a tsv or orthoxml prediction file and adds the pairwise
+    orthologs mapped with the ReferenceProteomes refset to sink, e.g. a
+    DatabaseInterface"""
+    with auto_open(fpath, 'rb') as fh:
+        head = fh.read(20)
+
+    if head.startswith(b'<?xml') or head.startswith(b'<ortho'):
+        with auto_open(fpath, 'rb') as fh:
+            processor = PairwiseOrthologRelationExtractor(refset, sink)
+            parse_orthoxml(fh, processor)
+    else:
+        with auto_open(fpath, 'rt') as fh:
+            for pairs in parse_tsv(fh, refset):
+                sink.add_ortholog_block(pairs)
+
+
+def load_binary_predictions(fpath, refset, sink):
+    """adds the pairs of a file in the binary submission format to sink.
+    No id mapping is needed, but the file must have been converted with
+    the same reference release."""
+    logger.info("loading predictions in binary submission format")
+    nr_pairs = 0
+    with auto_open(fpath, 'rb') as fh:
+        header = binary_predictions.read_header(fh)
+        binary_predictions.check_compatible(header, refset)
+        for pairs in binary_predictions.iter_blocks(fh):
+            sink.add_ortholog_block(pairs)
+            nr_pairs += len(pairs)
+    logger.info("loaded {} pairs converted for release {}".format(nr_pairs, header['release']))
+
+
+def identify_input_type_and_parse(fpath, mapping_data, db_path, refset=None):
+    """converts a prediction file into the sqlite database db_path. The
+    ReferenceProteomes of the mapping can be passed as refset if the
+    caller already built them"""
+    if refset is None:
+        refset = ReferenceProteomes.from_mapping(mapping_data)
     with auto_open(fpath, 'rb') as fh:
         head = fh.read(20)
 
     with DatabaseInterface(db_path) as db:
-        db.add_reference_proteomes(mapping_data)
+        db.add_reference_proteomes(refset)
         db.create_pairwise_ortholog_table()
 
-        if head.startswith(b'<?xml') or head.startswith(b'<ortho'):
-            with auto_open(fpath, 'rb') as fh:
-                processor = PairwiseOrthologRelationExtractor(mapping_data, db)
-                parse_orthoxml(fh, processor)
-        else:
-            with auto_open(fpath, 'rt') as fh:
-                for p1, p2 in parse_tsv(fh, mapping_data):
-                    db.add_orthologs(p1, p2)
+        with perf.phase("parse", bytes=os.path.getsize(fpath)) as ph:
+            if binary_predictions.is_binary_predictions(head):
+                load_binary_predictions(fpath, refset, db)
+            else:
+                parse_predictions(fpath, refset, db)
+            db.flush()
+            ph.rows = db.nr_inserted
         db.create_index_of_orthologs()
 
 
-if __name__ == "__main__":
-    import argparse
-    parser = argparse.ArgumentParser(description="Extract Pairwise relations from uploaded data")
-    parser.add_argument('mapping', help="Path to mapping.json of proper QfO dataset")
-    parser.add_argument('input_rels', help="Path to input relation file. either tsv or orthoxml")
-    parser.add_argument('--out', help="Path to output file")
-    parser.add_argument('--db', default="orthologs.db", help="Path to sqlite database with pairwise predictions")
-    parser.add_argument('--log', help="Path to log file. Defaults to stderr")
-    parser.add_argument('-d', '--debug', action="store_true", help="Set logging to debug level")
-    conf = parser.parse_args()
-
-    log_conf = {'level': logging.INFO, 'format': "%(asctime)-15s %(levelname)-7s: %(message)s"}
-    if conf.log is not None:
-        log_conf['filename'] = conf.log
-    if conf.debug:
-        log_conf['level'] = logging.DEBUG
-    logging.basicConfig(**log_conf)
-
-    mapping_data = load_mapping(conf.mapping)
-    identify_input_type_and_parse(conf.input_rels, mapping_data, conf.db)
-    nr_genes_in_reference_set = mapping_data['Goff'][-1]
+def export_darwin_predictions(db_path, out, nr_genes_in_reference_set):
+    """writes the pairwise orthologs of the database into the darwin
+    compatible predictions file and returns the number of exported
+    (directed) relations"""
     tot_pred = 0
-    with DatabaseInterface(conf.db) as dbi:
-        with open(conf.out, 'w') as fh:
+    with perf.phase("export") as ph, DatabaseInterface(db_path) as dbi:
+        with open(out, 'w') as fh:
             per_prot_ortholog_iter = dbi.iter_all_orthologs()
             nxt_prot, orths = next(per_prot_ortholog_iter)
             for i in range(1, nr_genes_in_reference_set + 1):
@@ -341,6 +419,49 @@ if __name__ == "__main__":
                 fh.write("<E><OE>{}</OE><VP>[{}]</VP><SEQ>{}</SEQ></E>\n"
                          .format(i, ",".join(orthologs), encode_nr_as_seq(i)))
                 tot_pred += len(orthologs)
+        ph.rows, ph.bytes = tot_pred, os.path.getsize(out)
+    return tot_pred
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Extract Pairwise relations from uploaded data")
+    parser.add_argument('mapping', help="Path to mapping.json of proper QfO dataset")
+    parser.add_argument('input_rels', help="Path to input relation file. either tsv, orthoxml or the binary submission format")
+    parser.add_argument('--out', help="Path to output file")
+    parser.add_argument('--db', default="orthologs.db", help="Path to sqlite database with pairwise predictions")
+    parser.add_argument('--cache-dir', help="Directory of a cache of converted predictions. If the same input "
+                                            "file was converted before with the same mapping, the cached "
+                                            "databases are reused")
+    parser.add_argument('--cache-link', action="store_true",
+                        help="restore the cached predictions file (--out) as hardlink instead of a copy. "
+                             "The sqlite database (--db) is always copied, as the benchmarks write to it")
+    parser.add_argument('--log', help="Path to log file. Defaults to stderr")
+    parser.add_argument('-d', '--debug', action="store_true", help="Set logging to debug level")
+    conf = parser.parse_args()
+
+    log_conf = {'level': logging.INFO, 'format': "%(asctime)-15s %(levelname)-7s: %(message)s"}
+    if conf.log is not None:
+        log_conf['filename'] = conf.log
+    if conf.debug:
+        log_conf['level'] = logging.DEBUG
+    logging.basicConfig(**log_conf)
+
+    perf.start("map_relations", os.path.dirname(os.path.abspath(conf.out)))
+    cache, cache_key = None, None
+    cached_files = {'orthologs.db': conf.db, 'predictions.db': conf.out}
+    if conf.cache_dir is not None:
+        cache = ConversionCache(conf.cache_dir, link=('predictions.db',) if conf.cache_link else ())
+        cache_key = cache.key_for(conf.input_rels, conf.mapping)
+        if cache.restore("conversion", cache_key, cached_files):
+            sys.exit(0)
+
+    with perf.phase("mapping load"):
+        mapping_data = load_mapping(conf.mapping)
+        refset = ReferenceProteomes.from_mapping(mapping_data)
+    identify_input_type_and_parse(conf.input_rels, mapping_data, conf.db, refset=refset)
+    tot_pred = export_darwin_predictions(conf.db, conf.out, refset.nr_proteins)
     logger.info("*** Successfully extracted {} pairwise relations from uploaded predictions"
                 .format(tot_pred / 2))
-
+    if cache is not None:
+        cache.store("conversion", cache_key, cached_files)
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
 import json
+import logging
 import os
 import fnmatch
 from argparse import ArgumentParser
 
+from helpers import JsonArrayWriter
+
+logger = logging.getLogger("merge_data_model_files")
+
 
 def files_in_directory(dir, ext=None):
     for cdir, subdir, files in os.walk(dir):
@@ -13,7 +18,11 @@ def files_in_directory(dir, ext=None):
                 yield os.path.join(cdir, fname)
 
 
-def main(participant_data_files, metrics_stub_files, aggregation_stub_dir, aggregation_out_file, model_output_file):
+def main(participant_data_files, metrics_stub_files, aggregation_stub_dir, aggregation_out_file, model_output_file,
+         compact=False):
+    """writes the metrics stubs to aggregation_out_file and the participant,
+    metrics and aggregation stubs to model_output_file. The stubs are
+    streamed to both files in a single pass."""
     # collect all aggregation stubs from the aggregation_stub_dir.
     # (containing the summary datapoints for all previous methods)
     aggregation_stubs = list(files_in_directory(aggregation_stub_dir, '.json'))
@@ -24,34 +33,33 @@ def main(participant_data_files, metrics_stub_files, aggregation_stub_dir, aggre
         if not os.path.exists(out_dir):
             os.makedirs(out_dir)
 
-    data_model_file = []
-    data_model_file = join_json_files(participant_data_files, data_model_file, "*.json")
-    nr_part_stubs = len(data_model_file)
-    data_model_file = join_json_files(metrics_stub_files, data_model_file, "*.json")
-
-    #output_file = os.path.join(aggregation_out_dir, 'Assessment_datasets.json')
-    with open(aggregation_out_file, 'w') as f:
-        json.dump(data_model_file[nr_part_stubs:], f, sort_keys=True, indent=4, separators=(',', ': '))
-
-    # load the aggregation files created in manage_assessment_data.py
-    data_model_file = join_json_files(aggregation_stubs, data_model_file, "*.json")
-
-    # write the merged data model file to json output
-    # output_file = os.path.join(model_output_dir, "data_model_file.json")
-    with open(model_output_file, 'w') as f:
-        json.dump(data_model_file, f, sort_keys=True, indent=4, separators=(',', ': '))
-
-
-def join_json_files(files, data_model_file, file_extension):
+    with JsonArrayWriter(model_output_file, compact=compact) as data_model_file, \
+            JsonArrayWriter(aggregation_out_file, compact=compact) as assessment_file:
+        for obj in iter_json_files(participant_data_files, "*.json"):
+            data_model_file.write(obj)
+        # the metrics stubs go into both files, serialize them only once
+        for obj in iter_json_files(metrics_stub_files, "*.json"):
+            text = data_model_file.encode(obj)
+            data_model_file.write_encoded(text)
+            assessment_file.write_encoded(text)
+        # the aggregation files created in manage_assessment_data.py
+        for obj in iter_json_files(aggregation_stubs, "*.json"):
+            data_model_file.write(obj)
+    logger.info("written {} objects to {} and {} objects to {}".format(
+        data_model_file.nr_elements, model_output_file, assessment_file.nr_elements, aggregation_out_file))
+
+
+def iter_json_files(files, file_extension):
+    """yields the objects stored in the json files. Files containing a
+    list yield its elements"""
     for abs_result_file in files:
         if fnmatch.fnmatch(abs_result_file, file_extension) and os.path.isfile(abs_result_file):
             with open(abs_result_file, mode='r', encoding="utf-8") as f:
                 content = json.load(f)
-                if isinstance(content, dict):
-                    data_model_file.append(content)
-                else:
-                    data_model_file.extend(content)
-    return data_model_file
+            if isinstance(content, dict):
+                yield content
+            else:
+                yield from content
 
 
 if __name__ == '__main__':
@@ -66,7 +74,11 @@ if __name__ == '__main__':
                         help="file where Assessment datasets should be written")
     parser.add_argument("-o", "--output_file", required=True,
                         help="output file where the minimal data model JSON file will be written")
+    parser.add_argument("--compact", action="store_true",
+                        help="write the json files without indentation")
 
     args = parser.parse_args()
-    main(args.participant_data, args.metrics_data, args.results_dir, args.aggregation_file, args.output_file)
+    logging.basicConfig(level=logging.INFO)
+    main(args.participant_data, args.metrics_data, args.results_dir, args.aggregation_file, args.output_file,
+         compact=args.compact)
 
@@ -0,0 +1,284 @@
+"""Instrumentation of the processing phases of the benchmark scripts.
+
+Code sections are timed as named phases. For every phase, the wall
+time, the CPU time of the process, the peak resident set size and the
+number of rows and bytes processed are recorded. Phases can be nested;
+they are aggregated by their path of phase names, so a phase that is
+entered many times (e.g. inserting blocks of orthologs) is reported
+once with the number of calls and the summed times::
+
+    import perf
+
+    perf.start("map_relations", out_dir)
+    with perf.phase("parse") as ph:
+        ...
+        ph.rows += nr_relations
+
+perf.start() begins the recording for an entry point. When the process
+exits, the report is added to ``<out_dir>/perf.json``, which contains a
+list of runs so that several entry points can share an output directory.
+Entry points that fail with an exit code call perf.exit(code) instead of
+sys.exit(code), so that the run is recorded as failed. Use
+perf.session() instead in code that does not exit through the
+interpreter, e.g. forked worker processes.
+
+Setting the environment variable QFO_PROFILE to ``cprofile`` or
+``pyinstrument`` additionally profiles the entry point and stores the
+profile in the same directory.
+"""
+import atexit
+import collections
+import contextlib
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger("perf")
+PERF_FILE = "perf.json"
+PERF_LOCK = ".perf.lock"
+PROFILE_ENV = "QFO_PROFILE"
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return rss / (1 << 20) if sys.platform == "darwin" else rss / 1024
+
+
+class Phase:
+    """handle of a running phase to report the amount of processed data"""
+    __slots__ = ("name", "rows", "bytes")
+
+    def __init__(self, name, rows=0, bytes=0):
+        self.name = name
+        self.rows = rows
+        self.bytes = bytes
+
+
+class PerfRecorder:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self._wall0 = time.perf_counter()
+        self._cpu0 = time.process_time()
+        self._phases = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def phase(self, name, rows=0, bytes=0):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(name)
+        path = "/".join(stack)
+        ph = Phase(name, rows, bytes)
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        try:
+            yield ph
+        finally:
+            wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+            stack.pop()
+            self._add(path, wall, cpu, ph.rows, ph.bytes)
+
+    def _add(self, path, wall, cpu, rows, nr_bytes):
+        rss = peak_rss_mb()
+        with self._lock:
+            stats = self._phases.get(path)
+            if stats is None:
+                stats = self._phases[path] = {'phase': path, 'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                                              'rows': 0, 'bytes': 0}
+            stats['calls'] += 1
+            stats['wall_time'] += wall
+            stats['cpu_time'] += cpu
+            stats['rows'] += rows
+            stats['bytes'] += nr_bytes
+            stats['peak_rss_mb'] = rss
+
+    def report(self):
+        with self._lock:
+            phases = [dict(stats) for stats in self._phases.values()]
+        return {'entry_point': self.name,
+                'argv': sys.argv,
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'started': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                'wall_time': time.perf_counter() - self._wall0,
+                'cpu_time': time.process_time() - self._cpu0,
+                'peak_rss_mb': peak_rss_mb(),
+                'phases': phases}
+
+
+_recorder = PerfRecorder(os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else "python")
+# session of the entry point started with start()
+_started = None
+
+
+def phase(name, rows=0, bytes=0):
+    """times a named phase of the current recording. Use as context manager"""
+    return _recorder.phase(name, rows=rows, bytes=bytes)
+
+
+def write_report(report, out_dir):
+    """adds a report to the perf.json file in out_dir. The file is locked
+    while it is updated, so that processes sharing out_dir keep all runs"""
+    path = os.path.join(out_dir, PERF_FILE)
+    with open(os.path.join(out_dir, PERF_LOCK), 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        runs = []
+        try:
+            with open(path, 'rt') as fh:
+                runs = json.load(fh)['runs']
+        except (OSError, ValueError, KeyError):
+            pass
+        runs.append(report)
+        fd, tmp = tempfile.mkstemp(prefix=".perf-", dir=out_dir)
+        with os.fdopen(fd, 'wt') as fh:
+            json.dump({'runs': runs}, fh, indent=4, separators=(',', ': '))
+        os.replace(tmp, path)
+    return path
+
+
+class _Profiler:
+    def __init__(self, kind, out_dir, name):
+        self.kind = kind
+        self.out_dir = out_dir
+        self.name = name
+        self._prof = None
+
+    def start(self):
+        if self.kind == "cprofile":
+            import cProfile
+            self._prof = cProfile.Profile()
+            self._prof.enable()
+        elif self.kind == "pyinstrument":
+            try:
+                import pyinstrument
+            except ImportError:
+                logger.warning("pyinstrument is not installed. Not profiling")
+                return
+            self._prof = pyinstrument.Profiler()
+            self._prof.start()
+        else:
+            logger.warning("unknown profiler {}={}. Use cprofile or pyinstrument".format(PROFILE_ENV, self.kind))
+
+    def stop(self):
+        if self._prof is None:
+            return
+        base = os.path.join(self.out_dir, "profile_{}_{}".format(self.name, os.getpid()))
+        if self.kind == "cprofile":
+            self._prof.disable()
+            self._prof.dump_stats(base + ".prof")
+            logger.info("stored cProfile profile in {}.prof".format(base))
+        else:
+            self._prof.stop()
+            with open(base + ".html", 'wt') as fh:
+                fh.write(self._prof.output_html())
+            logger.info("stored pyinstrument profile in {}.html".format(base))
+        self._prof = None
+
+
+class Session:
+    def __init__(self, name, out_dir):
+        self.name = name
+        self.out_dir = out_dir
+        self.recorder = PerfRecorder(name)
+        self.profiler = None
+        self._previous = None
+        self._finished = False
+        self.status = "ok"
+
+    def begin(self):
+        global _recorder
+        self._previous, _recorder = _recorder, self.recorder
+        kind = os.environ.get(PROFILE_ENV)
+        if kind:
+            self.profiler = _Profiler(kind.lower(), self.out_dir, self.name)
+            self.profiler.start()
+        return self
+
+    def finish(self, status=None):
+        global _recorder
+        if self._finished:
+            return
+        self._finished = True
+        if status is None:
+            status = self.status
+        if _recorder is self.recorder:
+            _recorder = self._previous
+        report = self.recorder.report()
+        report['status'] = status
+        try:
+            os.makedirs(self.out_dir, exist_ok=True)
+            if self.profiler is not None:
+                self.profiler.stop()
+            path = write_report(report, self.out_dir)
+            logger.debug("performance report written to {}".format(path))
+        except OSError as e:
+            logger.warning("cannot write performance report to {}: {}".format(self.out_dir, e))
+
+
+@contextlib.contextmanager
+def session(name, out_dir):
+    """records the phases of the enclosed code and writes the report to
+    out_dir when leaving the block"""
+    sess = Session(name, out_dir).begin()
+    status = "failed"
+    try:
+        yield sess.recorder
+        status = "ok"
+    finally:
+        sess.finish(status)
+
+
+def start(name, out_dir):
+    """starts the recording of an entry point. The report is written when
+    the interpreter exits, with status "failed" if it exits due to an
+    uncaught exception. Entry points that exit with an error code call
+    exit() (or finish()) instead of raising SystemExit, as the status of
+    a SystemExit cannot be determined when the interpreter exits."""
+    global _started
+    sess = _started = Session(name, out_dir).begin()
+    previous_hook = sys.excepthook
+
+    def excepthook(exc_type, exc, tb):
+        sess.status = "failed"
+        previous_hook(exc_type, exc, tb)
+
+    sys.excepthook = excepthook
+    atexit.register(sess.finish)
+    return sess.recorder
+
+
+def exit_status(code):
+    """returns the status of a run that exits with the SystemExit code"""
+    return "ok" if code is None or code == 0 else "failed"
+
+
+def finish(status="ok"):
+    """writes the report of the entry point started with start() now"""
+    if _started is not None:
+        _started.finish(status)
+
+
+def exit(code=None):
+    """finishes the recording of the entry point with the status of the
+    exit code and exits the interpreter with it"""
+    finish(exit_status(code))
+    raise SystemExit(code)
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""Measures the throughput of the processing stages on synthetic data.
+
+For every requested size, a synthetic release with two submissions is
+generated with synthetic_data.py (or reused from --data-dir). The
+following stages are then timed on it, each as the minimum wall time of
+several repeats:
+
+    validate[tsv|orthoxml]   validate.identify_input_type_and_validate
+    parse[tsv|orthoxml]      map_relations.identify_input_type_and_parse
+    export                   map_relations.export_darwin_predictions
+    one2one                  swissprot_benchmark.create_one2one_orthologs_table
+    swissprot                swissprot_benchmark.compute_sp_benchmark
+    vgnc                     vgnc_benchmark.compute_vgnc_benchmark
+    fas                      fas_benchmark.compute_fas_benchmark
+    consensus[tsv|sqlite]    consensus.ConsensusBuilder(DBs)
+
+The throughput is reported as predicted pairs of the submission per
+second. The missing FAS scores are computed by a stub replacing
+fas.runMultiTaxa, which assigns random scores. Stages whose
+dependencies are not installed are skipped.
+
+Example::
+
+    ./perftests/run_benchmarks.py --sizes tiny small --save perftests/baseline.json
+    # ... change code ...
+    ./perftests/run_benchmarks.py --sizes tiny small --compare perftests/baseline.json
+
+With --compare, the command exits with a non-zero status if the
+throughput of a stage drops below the baseline by more than the
+tolerance.
+"""
+import datetime
+import gzip
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import sqlite3
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic_data
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+logger = logging.getLogger("run-benchmarks")
+FAS_STUB = """#!{python}
+import argparse, json, os, random
+p = argparse.ArgumentParser()
+p.add_argument('--input')
+p.add_argument('-o')
+p.add_argument('--outName')
+conf, _ = p.parse_known_args()
+os.makedirs(conf.o, exist_ok=True)
+rng = random.Random(1)
+scores = {{}}
+with open(conf.input) as fh:
+    for line in fh:
+        p1, _, p2, _ = line.rstrip('\\n').split('\\t')
+        s = rng.uniform(0.4, 1.0)
+        scores[p1 + '_' + p2] = [s, s]
+with open(os.path.join(conf.o, conf.outName + '.json'), 'w') as fh:
+    json.dump(scores, fh)
+"""
+
+
+class Workload:
+    """synthetic data of one size and the intermediate files derived from it"""
+
+    def __init__(self, data_dir, size, work_dir, seed=1):
+        self.size = size
+        self.dir = os.path.join(data_dir, size)
+        self.work_dir = os.path.join(work_dir, size)
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.summary = self._load_or_generate(seed)
+        self.release = os.path.join(self.dir, self.summary['release_dir'])
+        self._mapping = None
+        self._dbs = {}
+
+    def _load_or_generate(self, seed):
+        nr_species, genes = synthetic_data.SIZES[self.size]
+        summary_fn = os.path.join(self.dir, "synthetic.json")
+        if os.path.exists(summary_fn):
+            with open(summary_fn, 'rt') as fh:
+                summary = json.load(fh)
+            params = summary['parameters']
+            if (params['species'], params['genes_per_species'], params['seed']) == (nr_species, genes, seed) \
+                    and params['submissions'] >= 2 and set(params['formats']) == {"tsv", "orthoxml"}:
+                return summary
+        logger.info("generating synthetic data of size {} in {}".format(self.size, self.dir))
+        return synthetic_data.generate(self.dir, nr_species, genes, nr_submissions=2, seed=seed)
+
+    def path(self, *parts):
+        return os.path.join(self.release, *parts)
+
+    def submission(self, method="method0", fmt="tsv"):
+        return os.path.join(self.dir, "submissions", self.summary['submissions'][method][fmt])
+
+    def pairs(self, method="method0"):
+        return self.summary['submissions'][method]['pairs']
+
+    @property
+    def mapping(self):
+        if self._mapping is None:
+            import map_relations
+            self._mapping = map_relations.load_mapping(self.path("mapping.json.gz"))
+        return self._mapping
+
+    def db(self, method="method0"):
+        """returns the sqlite database with the predictions of a method"""
+        if method not in self._dbs:
+            import map_relations
+            db_path = os.path.join(self.work_dir, method + ".db")
+            if os.path.exists(db_path):
+                os.remove(db_path)
+            map_relations.identify_input_type_and_parse(self.submission(method), self.mapping, db_path)
+            self._dbs[method] = db_path
+        return self._dbs[method]
+
+    def tmp(self, name):
+        return os.path.join(self.work_dir, name)
+
+
+def bench_validate(wl, fmt):
+    import validate
+    mapping = wl.mapping
+    excluded_ids = mapping.get('excluded_ids', set([]))
+
+    def run():
+        assert validate.identify_input_type_and_validate(wl.submission(fmt=fmt), mapping['mapping'], excluded_ids,
+                                                         mapping_data=mapping)
+    return run
+
+
+def bench_parse(wl, fmt):
+    import map_relations
+    mapping = wl.mapping
+    db_path = wl.tmp("parse_{}.db".format(fmt))
+
+    def run():
+        if os.path.exists(db_path):
+            os.remove(db_path)
+        map_relations.identify_input_type_and_parse(wl.submission(fmt=fmt), mapping, db_path)
+    return run
+
+
+def bench_export(wl):
+    import map_relations
+    from refset import ReferenceProteomes
+    db_path = wl.db()
+    nr_proteins = ReferenceProteomes.from_mapping(wl.mapping).nr_proteins
+
+    def run():
+        map_relations.export_darwin_predictions(db_path, wl.tmp("predictions.txt"), nr_proteins)
+    return run
+
+
+def bench_one2one(wl):
+    import swissprot_benchmark
+    db_path = wl.tmp("one2one.db")
+    shutil.copyfile(wl.db(), db_path)
+
+    def run():
+        swissprot_benchmark.create_one2one_orthologs_table(db_path)
+    return run
+
+
+def bench_swissprot(wl, strategy_name):
+    import swissprot_benchmark
+    from helpers import RawOutputWriter
+    sp_file = wl.path("swissprot.txt.gz")
+    sp_entries = swissprot_benchmark.get_swissprot_entries(wl.path("mapping.json.gz"), sp_file)
+    strategy = swissprot_benchmark.get_strategy(strategy_name, sp_entries, wl.path("mapping.json.gz"), sp_file,
+                                                wl.path("lineage_tree.phyloxml"))
+    db_path = wl.db()
+
+    def run():
+        with RawOutputWriter(wl.tmp("sp_raw.txt.gz")) as raw_out:
+            swissprot_benchmark.compute_sp_benchmark(sp_entries, db_path, raw_out, strategy, "orthologs")
+    return run
+
+
+def bench_vgnc(wl):
+    import vgnc_benchmark
+    from helpers import RawOutputWriter
+    vgnc_orthologs = vgnc_benchmark.get_vgnc_orthologs(wl.path("vgnc-orthologs.txt.gz"))
+    db_path = wl.db()
+
+    def run():
+        with RawOutputWriter(wl.tmp("vgnc_raw.txt.gz")) as raw_out:
+            vgnc_benchmark.compute_vgnc_benchmark(vgnc_orthologs, db_path, raw_out)
+    return run
+
+
+def bench_fas(wl):
+    import fas_benchmark
+    from pathlib import Path
+    from helpers import RawOutputWriter
+    precomputed, annotations = Path(wl.path("fas_precomputed.json.gz")), Path(wl.path("fas_annotations"))
+    reference = fas_benchmark.load_fas_reference(precomputed, annotations)
+    db_path = Path(wl.db())
+    install_fas_stub(wl.tmp("bin"))
+
+    def run():
+        with RawOutputWriter(wl.tmp("fas_raw.txt.gz")) as raw_out:
+            fas_benchmark.compute_fas_benchmark(precomputed, annotations, db_path, 1, raw_out, reference=reference)
+    return run
+
+
+def bench_consensus(wl, source):
+    import consensus
+    if source == "sqlite":
+        inputs = [wl.db(m) for m in ("method0", "method1")]
+        builder = consensus.ConsensusBuilderDBs
+    else:
+        # ConsensusBuilder reads uncompressed files only
+        inputs = []
+        for method in ("method0", "method1"):
+            fn = wl.tmp("{}.tsv".format(method))
+            if not os.path.exists(fn):
+                with gzip.open(wl.submission(method), 'rb') as src, open(fn, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+            inputs.append(fn)
+        builder = consensus.ConsensusBuilder
+
+    def run():
+        cons = builder()
+        for fn in inputs:
+            cons.add_method(fn)
+        cons.dump_consensus(wl.tmp("consensus.txt"), min_methods=2)
+    return run
+
+
+def install_fas_stub(bin_dir):
+    os.makedirs(bin_dir, exist_ok=True)
+    stub = os.path.join(bin_dir, "fas.runMultiTaxa")
+    with open(stub, 'wt') as fh:
+        fh.write(FAS_STUB.format(python=sys.executable))
+    os.chmod(stub, os.stat(stub).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    if bin_dir not in os.environ['PATH'].split(os.pathsep):
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+
+# name -> (setup function returning the timed callable, number of submissions whose pairs are processed)
+BENCHMARKS = {
+    "validate[tsv]": (lambda wl: bench_validate(wl, "tsv"), 1),
+    "validate[orthoxml]": (lambda wl: bench_validate(wl, "orthoxml"), 1),
+    "parse[tsv]": (lambda wl: bench_parse(wl, "tsv"), 1),
+    "parse[orthoxml]": (lambda wl: bench_parse(wl, "orthoxml"), 1),
+    "export": (bench_export, 1),
+    "one2one": (bench_one2one, 1),
+    "swissprot[ids_exist_in_both]": (lambda wl: bench_swissprot(wl, "ids_exist_in_both"), 1),
+    "swissprot[clade_limit]": (lambda wl: bench_swissprot(wl, "clade_limit"), 1),
+    "vgnc": (bench_vgnc, 1),
+    "fas": (bench_fas, 1),
+    "consensus[tsv]": (lambda wl: bench_consensus(wl, "tsv"), 2),
+    "consensus[sqlite]": (lambda wl: bench_consensus(wl, "sqlite"), 2),
+}
+
+
+def run_benchmark(wl, name, repeats):
+    setup, nr_methods = BENCHMARKS[name]
+    best_wall, best_cpu = None, None
+    try:
+        func = setup(wl)
+        for _ in range(repeats):
+            t0, c0 = time.perf_counter(), time.process_time()
+            func()
+            wall, cpu = time.perf_counter() - t0, time.process_time() - c0
+            if best_wall is None or wall < best_wall:
+                best_wall, best_cpu = wall, cpu
+    except ImportError as e:
+        # some stages need optional packages, e.g. tqdm for FAS
+        logger.warning("skipping {} on {}: {}".format(name, wl.size, e))
+        return {'skipped': str(e)}
+    pairs = sum(wl.pairs(m) for m in ("method0", "method1")[:nr_methods])
+    return {'pairs': pairs, 'wall_time': best_wall, 'cpu_time': best_cpu,
+            'throughput': pairs / best_wall if best_wall > 0 else None}
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'host': socket.gethostname(),
+            'sqlite': sqlite3.sqlite_version,
+            'numpy': numpy_version,
+            'commit': commit,
+            'date': datetime.datetime.now().replace(microsecond=0).isoformat()}
+
+
+def report(results, baseline=None):
+    for key, res in results.items():
+        if 'skipped' in res:
+            print("{:<40} skipped: {}".format(key, res['skipped']))
+            continue
+        line = "{:<40} {:9.3f}s  {:12.0f} pairs/s".format(key, res['wall_time'], res['throughput'] or 0)
+        base = (baseline or {}).get(key, {})
+        if base.get('throughput'):
+            line += "  (baseline {:12.0f} pairs/s, {:+.0f}%)".format(
+                base['throughput'], 100 * (res['throughput'] - base['throughput']) / base['throughput'])
+        print(line)
+
+
+def regressions(results, baseline, tolerance, min_time):
+    """returns the stages whose throughput dropped below the baseline by
+    more than tolerance. Stages faster than min_time seconds in the
+    baseline are too noisy and are ignored."""
+    slower = []
+    for key, res in results.items():
+        base = baseline.get(key, {})
+        if not res.get('throughput') or not base.get('throughput') or base['wall_time'] < min_time:
+            continue
+        if res['throughput'] < base['throughput'] * (1 - tolerance):
+            slower.append(key)
+    return slower
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Measure the throughput of the benchmark stages on synthetic data")
+    parser.add_argument('--sizes', nargs="+", choices=synthetic_data.SIZES.keys(), default=["tiny", "small"],
+                        help="sizes of the synthetic data sets")
+    parser.add_argument('--only', nargs="+", choices=BENCHMARKS.keys(), help="run only these stages")
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), "qfo-perftests"),
+                        help="directory of the synthetic data. Existing data is reused")
+    parser.add_argument('--repeats', type=int, default=3, help="number of runs per stage")
+    parser.add_argument('--seed', type=int, default=1, help="seed of the synthetic data")
+    parser.add_argument('--save', help="store the measurements as baseline in this file")
+    parser.add_argument('--compare', help="compare against the baseline stored in this file")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed relative drop of the throughput compared to the baseline")
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help="ignore stages that took less than this many seconds in the baseline")
+    parser.add_argument('-d', '--debug', action="store_true", help="Set logging to debug level")
+    conf = parser.parse_args()
+    # the benchmarked modules log a lot on info level
+    logging.basicConfig(level=logging.DEBUG if conf.debug else logging.WARNING,
+                        format="%(asctime)-15s %(name)s %(levelname)-7s: %(message)s")
+    logger.setLevel(logging.DEBUG if conf.debug else logging.INFO)
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="qfo-perftests-") as work_dir:
+        for size in conf.sizes:
+            wl = Workload(conf.data_dir, size, work_dir, seed=conf.seed)
+            for name in conf.only or BENCHMARKS:
+                logger.info("running {} on {}".format(name, size))
+                results["{}/{}".format(size, name)] = run_benchmark(wl, name, conf.repeats)
+    baseline = None
+    if conf.compare is not None:
+        with open(conf.compare, 'rt') as fh:
+            baseline = json.load(fh)['results']
+    report(results, baseline)
+    if conf.save is not None:
+        with open(conf.save, 'wt') as fh:
+            json.dump({'environment': environment(), 'results': results}, fh,
+                      sort_keys=True, indent=4, separators=(',', ': '))
+    if baseline is not None:
+        slower = regressions(results, baseline, conf.tolerance, conf.min_time)
+        if slower:
+            sys.exit("throughput regression in {}".format(", ".join(slower)))
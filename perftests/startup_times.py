@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""Measures the startup time of the command line entry points.
+
+Every entry point is started with ``python -X importtime <script> --help``,
+which loads all module level imports and exits after parsing the
+arguments. The wall time of the process and the cumulative import time
+reported by the interpreter are recorded (minimum over several repeats).
+
+Example::
+
+    # record a baseline
+    ./perftests/startup_times.py --save perftests/startup_baseline.json
+    # ... change code ...
+    ./perftests/startup_times.py --compare perftests/startup_baseline.json
+
+With --compare, the command exits with a non-zero status if the import
+time of an entry point exceeds the baseline by more than the tolerance.
+"""
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+logger = logging.getLogger("startup-times")
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = [
+    "validate.py",
+    "map_relations.py",
+    "binary_predictions.py",
+    "swissprot_benchmark.py",
+    "vgnc_benchmark.py",
+    "fas_benchmark.py",
+    "batch_benchmark.py",
+    "benchmark_runner.py",
+    "manage_assessment_data.py",
+    "merge_data_model_files.py",
+    "reference_indexes.py",
+    "fetch_reference_data.py",
+]
+
+
+def parse_importtime(stderr):
+    """returns the total import time in seconds and a dict of the
+    cumulative import time per top-level module"""
+    per_module = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(parts[1])
+        except ValueError:
+            # header line
+            continue
+        name = parts[2]
+        # nested imports are indented below the module importing them
+        if not name.startswith("  "):
+            per_module[name.strip()] = per_module.get(name.strip(), 0) + cumulative / 1e6
+    return sum(per_module.values()), per_module
+
+
+def measure(script, repeats=5, python=sys.executable):
+    best = None
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        res = subprocess.run([python, "-X", "importtime", script, "--help"], cwd=REPO_DIR,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        wall = time.perf_counter() - t0
+        if res.returncode != 0:
+            err = [l for l in res.stderr.splitlines() if not l.startswith("import time:")]
+            return {'error': err[-1] if err else "exit code {}".format(res.returncode)}
+        import_time, per_module = parse_importtime(res.stderr)
+        if best is None or import_time < best['import_time']:
+            best = {'import_time': import_time, 'wall_time': wall, 'modules': per_module}
+        else:
+            best['wall_time'] = min(best['wall_time'], wall)
+    return best
+
+
+def measure_all(scripts, repeats=5):
+    results = {}
+    for script in scripts:
+        if not os.path.exists(os.path.join(REPO_DIR, script)):
+            logger.warning("{} does not exist. skipping".format(script))
+            continue
+        results[script] = measure(script, repeats=repeats)
+    return results
+
+
+def report(results, baseline=None, top=5):
+    for script, res in results.items():
+        if 'error' in res:
+            print("{:<28} failed: {}".format(script, res['error']))
+            continue
+        line = "{:<28} imports {:7.3f}s  wall {:7.3f}s".format(script, res['import_time'], res['wall_time'])
+        if baseline is not None and 'import_time' in baseline.get(script, {}):
+            base = baseline[script]['import_time']
+            line += "  (baseline {:7.3f}s, {:+.0f}%)".format(base, 100 * (res['import_time'] - base) / base)
+        print(line)
+        heaviest = sorted(res['modules'].items(), key=lambda x: -x[1])[:top]
+        print("    " + ", ".join("{} {:.3f}s".format(mod, t) for mod, t in heaviest))
+
+
+def regressions(results, baseline, tolerance, slack):
+    """returns the entry points whose import time got slower than the
+    baseline by more than tolerance (relative) plus slack (seconds)"""
+    slower = []
+    for script, res in results.items():
+        base = baseline.get(script, {})
+        if 'import_time' not in res or 'import_time' not in base:
+            continue
+        if res['import_time'] > base['import_time'] * (1 + tolerance) + slack:
+            slower.append(script)
+    return slower
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Measure the startup time of the benchmark entry points")
+    parser.add_argument('scripts', nargs="*", help="entry points to measure, relative to the repository. "
+                                                   "Defaults to all known entry points")
+    parser.add_argument('--repeats', type=int, default=5, help="number of runs per entry point")
+    parser.add_argument('--save', help="store the measurements as baseline in this file")
+    parser.add_argument('--compare', help="compare against the baseline stored in this file")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed relative slowdown of the import time compared to the baseline")
+    parser.add_argument('--slack', type=float, default=0.02,
+                        help="allowed absolute slowdown in seconds on top of the tolerance")
+    conf = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(levelname)-7s: %(message)s")
+
+    results = measure_all(conf.scripts or ENTRY_POINTS, repeats=conf.repeats)
+    baseline = None
+    if conf.compare is not None:
+        with open(conf.compare, 'rt') as fh:
+            baseline = json.load(fh)['results']
+    report(results, baseline)
+    if conf.save is not None:
+        with open(conf.save, 'wt') as fh:
+            json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                       'results': results}, fh, sort_keys=True, indent=4, separators=(',', ': '))
+    if baseline is not None:
+        slower = regressions(results, baseline, conf.tolerance, conf.slack)
+        if slower:
+            sys.exit("startup time regression in {}".format(", ".join(slower)))
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+"""Generates a synthetic QfO reference release and ortholog predictions.
+
+The release is self-consistent: gene families are simulated along a
+random species tree with gene duplications and losses, and all reference
+files are derived from these families::
+
+    <out_dir>/release/mapping.json.gz
+    <out_dir>/release/swissprot.txt.gz
+    <out_dir>/release/vgnc-orthologs.txt.gz
+    <out_dir>/release/fas_precomputed.json.gz
+    <out_dir>/release/fas_annotations/<species>.json
+    <out_dir>/release/lineage_tree.phyloxml
+    <out_dir>/submissions/<method>.tsv.gz
+    <out_dir>/submissions/<method>.orthoxml.gz
+    <out_dir>/synthetic.json
+
+The submissions are noisy copies of the gene families: genes are missed
+or swapped against random genes of the same species. The tsv and
+orthoxml file of a method encode the same pairwise relations, the
+orthoxml file with nested paralogGroups at the duplications.
+synthetic.json records the parameters and the sizes of the generated
+data, e.g. the number of pairs of every submission.
+
+The generated data depends only on the parameters and the seed, so the
+same workload can be recreated anywhere::
+
+    ./perftests/synthetic_data.py /tmp/qfo-small --size small
+    ./perftests/synthetic_data.py /tmp/qfo-huge --size large --species 150 --formats tsv --max-pairs 50000000
+"""
+import collections
+import gzip
+import json
+import logging
+import os
+import random
+import string
+
+logger = logging.getLogger("synthetic-data")
+
+# species, genes per species. The submissions contain about 3k, 100k,
+# 3M and 28M pairs with the default rates
+SIZES = {
+    "tiny": (6, 500),
+    "small": (12, 4000),
+    "medium": (40, 8000),
+    "large": (100, 12000),
+}
+WELL_KNOWN_SPECIES = ("HUMAN", "MOUSE", "RATNO", "YEAST", "ECOLI", "ARATH")
+BASE36 = string.digits + string.ascii_uppercase
+MAX_PROTEINS = 3 * 10 * 36 ** 3 * 10
+SPECIATION, DUPLICATION = "S", "D"
+
+
+def uniprot_accession(nr):
+    """returns a unique accession of the form [OPQ][0-9][A-Z0-9]{3}[0-9]
+    for a number between 0 and MAX_PROTEINS-1"""
+    if not 0 <= nr < MAX_PROTEINS:
+        raise ValueError("cannot encode {} as accession".format(nr))
+    nr, last = divmod(nr, 10)
+    mid = ""
+    for _ in range(3):
+        nr, c = divmod(nr, 36)
+        mid = BASE36[c] + mid
+    nr, second = divmod(nr, 10)
+    return "{}{}{}{}".format("OPQ"[nr], second, mid, last)
+
+
+def swissprot_idpart(fam):
+    nr, first = divmod(fam, 26)
+    rest = ""
+    while True:
+        nr, c = divmod(nr, 36)
+        rest = BASE36[c] + rest
+        if nr == 0:
+            break
+    return string.ascii_uppercase[first] + rest
+
+
+class SpeciesTree:
+    """random rooted binary tree over the species of the release"""
+
+    def __init__(self, species, rng):
+        self.species = species
+        nodes = [{'species': k} for k in range(len(species))]
+        nr_clades = 0
+        while len(nodes) > 1:
+            a = nodes.pop(rng.randrange(len(nodes)))
+            b = nodes.pop(rng.randrange(len(nodes)))
+            nr_clades += 1
+            nodes.append({'name': "Clade{}".format(nr_clades), 'children': [a, b]})
+        self.root = nodes[0]
+        self.root['name'] = "LUCA"
+        self.internal_nodes = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if 'children' in node:
+                self.internal_nodes.append(node)
+                stack.extend(node['children'])
+
+    def to_phyloxml(self):
+        def _rec(node):
+            if 'children' in node:
+                return "<clade><taxonomy><scientific_name>{}</scientific_name></taxonomy>\n{}</clade>\n".format(
+                    node['name'], "".join(_rec(c) for c in node['children']))
+            return "<clade><taxonomy><code>{}</code></taxonomy></clade>\n".format(self.species[node['species']])
+        return ('<phyloxml xmlns="http://www.phyloxml.org"><phylogeny rooted="true">'
+                + _rec(self.root) + '</phylogeny></phyloxml>\n')
+
+
+class SyntheticRelease:
+    """the proteins and gene families of a synthetic reference release.
+
+    Gene trees are nested tuples (SPECIATION|DUPLICATION, [children]) with
+    prot_nrs as leaves."""
+
+    def __init__(self, nr_species=12, genes_per_species=4000, nr_families=None, nr_excluded=1,
+                 dup_rate=0.03, loss_rate=0.1, seed=1):
+        rng = random.Random("release-{}".format(seed))
+        self.seed = seed
+        self.species = list(WELL_KNOWN_SPECIES[:nr_species]) + \
+            ["S{:04d}".format(k) for k in range(len(WELL_KNOWN_SPECIES), nr_species)]
+        self.excluded = set(self.species[len(self.species) - nr_excluded:]) if nr_excluded > 0 else set([])
+        sizes = [int(genes_per_species * rng.uniform(0.75, 1.25)) for _ in self.species]
+        self.goff = [0]
+        for size in sizes:
+            self.goff.append(self.goff[-1] + size)
+        if self.nr_proteins >= MAX_PROTEINS:
+            raise ValueError("too many proteins for synthetic accessions: {}".format(self.nr_proteins))
+        self.genome_of = [None]
+        for k, size in enumerate(sizes):
+            self.genome_of.extend([k] * size)
+        self.species_tree = SpeciesTree(self.species, rng)
+        self._accessions = None
+
+        if nr_families is None:
+            nr_families = int(0.7 * genes_per_species)
+        self._next_free = self.goff[:-1]
+        self.families = []
+        while len(self.families) < nr_families:
+            origin = self.species_tree.root if rng.random() < 0.6 else rng.choice(self.species_tree.internal_nodes)
+            tree = self._evolve(origin, rng, dup_rate, loss_rate)
+            if tree is None or isinstance(tree, int):
+                # families need at least two genes
+                if all(self._next_free[k] >= self.goff[k + 1] for k in range(len(self.species))):
+                    break
+                continue
+            self.families.append(tree)
+        logger.info("simulated {} gene families covering {} of {} proteins"
+                    .format(len(self.families), sum(len(leaves(t)) for t in self.families), self.nr_proteins))
+
+    @property
+    def nr_proteins(self):
+        return self.goff[-1]
+
+    def _new_gene(self, species):
+        prot_nr = self._next_free[species] + 1
+        if prot_nr > self.goff[species + 1]:
+            # proteome is exhausted. treat as gene loss
+            return None
+        self._next_free[species] = prot_nr
+        return prot_nr
+
+    def _evolve(self, node, rng, dup_rate, loss_rate, allow_dup=True):
+        if allow_dup and rng.random() < dup_rate:
+            copies = [self._evolve(node, rng, dup_rate, loss_rate, allow_dup=False) for _ in range(2)]
+            return _collapse(DUPLICATION, copies)
+        if 'children' not in node:
+            if rng.random() < loss_rate:
+                return None
+            return self._new_gene(node['species'])
+        return _collapse(SPECIATION, [self._evolve(c, rng, dup_rate, loss_rate) for c in node['children']])
+
+    def accession(self, prot_nr):
+        if self._accessions is None:
+            self._accessions = [None] + [uniprot_accession(nr) for nr in range(self.nr_proteins)]
+        return self._accessions[prot_nr]
+
+    def is_excluded(self, prot_nr):
+        return self.species[self.genome_of[prot_nr]] in self.excluded
+
+    def swissprot_names(self, fraction=0.3, seed_tag="swissprot"):
+        """returns a dict prot_nr -> swissprot id. Orthologs share the id
+        part, paralogs are distinguished by a number suffix."""
+        rng = random.Random("{}-{}".format(seed_tag, self.seed))
+        names = {}
+
+        def _rec(tree, name):
+            if isinstance(tree, int):
+                if rng.random() < 0.9:
+                    names[tree] = "{}_{}".format(name, self.species[self.genome_of[tree]])
+                return
+            typ, children = tree
+            for k, child in enumerate(children):
+                _rec(child, name + str(k + 1) if typ == DUPLICATION else name)
+
+        for fam, tree in enumerate(self.families):
+            if rng.random() < fraction:
+                _rec(tree, swissprot_idpart(fam))
+        return names
+
+    def mapping(self, sp_names):
+        mapping, excluded_ids = {}, []
+        for prot_nr in range(1, self.nr_proteins + 1):
+            ids = [self.accession(prot_nr)]
+            if prot_nr in sp_names:
+                ids.append(sp_names[prot_nr])
+            if self.is_excluded(prot_nr):
+                excluded_ids.extend(ids)
+            else:
+                mapping.update((id_, prot_nr) for id_ in ids)
+        return {'mapping': mapping, 'Goff': self.goff, 'species': self.species, 'excluded_ids': excluded_ids}
+
+    def vgnc_orthologs(self, nr_species=4, fraction=0.3):
+        """returns the VGNC asserted orthologs as list of (prot_nr1, prot_nr2, symbol).
+        Only families with a single copy in the VGNC species are used."""
+        rng = random.Random("vgnc-{}".format(self.seed))
+        vgnc_species = set(k for k, sp in enumerate(self.species[:nr_species]) if sp not in self.excluded)
+        rels = []
+        for fam, tree in enumerate(self.families):
+            if rng.random() >= fraction:
+                continue
+            per_species = collections.defaultdict(list)
+            for prot_nr in leaves(tree):
+                if self.genome_of[prot_nr] in vgnc_species:
+                    per_species[self.genome_of[prot_nr]].append(prot_nr)
+            genes = sorted(g[0] for g in per_species.values() if len(g) == 1)
+            for i, a in enumerate(genes):
+                for b in genes[i + 1:]:
+                    rels.append((a, b, "VG{:05d}".format(fam)))
+        return rels
+
+    def fas_scores(self, max_pairs=200000):
+        """returns a dict "acc1_acc2" -> [score, score] for a sample of the
+        orthologous pairs"""
+        rng = random.Random("fas-{}".format(self.seed))
+        approx_pairs = sum(len(leaves(t)) ** 2 / 2 for t in self.families)
+        rate = min(1.0, max_pairs / approx_pairs) if approx_pairs > 0 else 0
+        scores = {}
+        for tree in self.families:
+            for a, b in ortholog_pairs(tree, self.genome_of):
+                if rng.random() < rate and not (self.is_excluded(a) or self.is_excluded(b)):
+                    s = round(rng.uniform(0.4, 1.0), 4)
+                    scores["{}_{}".format(self.accession(a), self.accession(b))] = \
+                        [s, round(min(1.0, s + rng.uniform(-0.1, 0.1)), 4)]
+        return scores
+
+    def fas_annotations(self, coverage=0.95):
+        """returns per species the feature annotations of the proteins in gene families"""
+        rng = random.Random("fas-annotations-{}".format(self.seed))
+        annotations = collections.defaultdict(dict)
+        for fam, tree in enumerate(self.families):
+            for prot_nr in leaves(tree):
+                if self.is_excluded(prot_nr) or rng.random() >= coverage:
+                    continue
+                length = rng.randint(100, 1500)
+                start = rng.randint(1, length // 2)
+                annotations[self.species[self.genome_of[prot_nr]]][self.accession(prot_nr)] = {
+                    'length': length,
+                    'fmap': {"pfam_PF{:05d}".format(fam % 20000): [[start, min(length, start + 80)]]}}
+        return annotations
+
+    def predictions(self, name, miss_rate=0.1, swap_rate=0.02):
+        """returns the gene trees predicted by a noisy method"""
+        rng = random.Random("method-{}-{}".format(name, self.seed))
+
+        def _rec(tree, used):
+            if isinstance(tree, int):
+                if rng.random() < miss_rate:
+                    return None
+                if rng.random() < swap_rate:
+                    k = self.genome_of[tree]
+                    other = rng.randint(self.goff[k] + 1, self.goff[k + 1])
+                    if other not in used:
+                        return other
+                return tree
+            typ, children = tree
+            return _collapse(typ, [_rec(c, used) for c in children])
+
+        predicted = []
+        for tree in self.families:
+            pred = _rec(tree, set(leaves(tree)))
+            if pred is not None and not isinstance(pred, int):
+                predicted.append(pred)
+        return predicted
+
+
+def _collapse(typ, children):
+    children = [c for c in children if c is not None]
+    if len(children) == 0:
+        return None
+    if len(children) == 1:
+        return children[0]
+    return typ, children
+
+
+def leaves(tree):
+    if isinstance(tree, int):
+        return [tree]
+    res = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, int):
+            res.append(node)
+        else:
+            stack.extend(node[1])
+    return res
+
+
+def ortholog_pairs(tree, genome_of):
+    """yields the pairwise orthologs induced by a gene tree, i.e. the pairs
+    of genes from different species that diverged at a speciation"""
+    pairs = []
+
+    def _rec(node):
+        if isinstance(node, int):
+            return [node]
+        typ, children = node
+        child_leaves = [_rec(c) for c in children]
+        if typ == SPECIATION:
+            for i in range(len(child_leaves)):
+                for j in range(i + 1, len(child_leaves)):
+                    pairs.extend((a, b) for a in child_leaves[i] for b in child_leaves[j]
+                                 if genome_of[a] != genome_of[b])
+        return [x for lst in child_leaves for x in lst]
+
+    _rec(tree)
+    return pairs
+
+
+def count_ortholog_pairs(tree, genome_of):
+    """number of pairs yielded by ortholog_pairs without enumerating them"""
+    def _rec(node):
+        if isinstance(node, int):
+            return collections.Counter({genome_of[node]: 1}), 0
+        typ, children = node
+        results = [_rec(c) for c in children]
+        nr = sum(r[1] for r in results)
+        if typ == SPECIATION:
+            for i in range(len(results)):
+                for j in range(i + 1, len(results)):
+                    ci, cj = results[i][0], results[j][0]
+                    nr += sum(ci.values()) * sum(cj.values()) - sum(v * cj[g] for g, v in ci.items())
+        total = collections.Counter()
+        for counts, _ in results:
+            total.update(counts)
+        return total, nr
+    return _rec(tree)[1]
+
+
+def write_tsv(fname, release, trees):
+    nr_pairs = 0
+    with gzip.open(fname, 'wt', compresslevel=1) as fh:
+        for tree in trees:
+            pairs = ortholog_pairs(tree, release.genome_of)
+            fh.write("".join("{}\t{}\n".format(release.accession(a), release.accession(b)) for a, b in pairs))
+            nr_pairs += len(pairs)
+    return nr_pairs
+
+
+def write_orthoxml(fname, release, trees):
+    def _group(node):
+        if isinstance(node, int):
+            return '<geneRef id="{}"/>'.format(node)
+        typ, children = node
+        tag = "orthologGroup" if typ == SPECIATION else "paralogGroup"
+        return "<{0}>{1}</{0}>\n".format(tag, "".join(_group(c) for c in children))
+
+    genes_per_species = collections.defaultdict(set)
+    for tree in trees:
+        for prot_nr in leaves(tree):
+            genes_per_species[release.genome_of[prot_nr]].add(prot_nr)
+    with gzip.open(fname, 'wt', compresslevel=1) as fh:
+        fh.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                 '<orthoXML xmlns="http://orthoXML.org/2011/" version="0.3" origin="synthetic" '
+                 'originVersion="{}">\n'.format(release.seed))
+        for k in sorted(genes_per_species):
+            fh.write('<species name="{}" NCBITaxId="{}">\n<database name="synthetic" version="{}">\n<genes>\n'
+                     .format(release.species[k], k + 1, release.seed))
+            fh.write("".join('<gene id="{}" protId="{}"/>\n'.format(prot_nr, release.accession(prot_nr))
+                             for prot_nr in sorted(genes_per_species[k])))
+            fh.write('</genes>\n</database>\n</species>\n')
+        fh.write('<groups>\n')
+        for fam, tree in enumerate(trees):
+            group = _group(tree)
+            if tree[0] != SPECIATION:
+                # toplevel groups must be orthologGroups
+                group = "<orthologGroup>{}</orthologGroup>\n".format(group)
+            fh.write(group.replace("<orthologGroup>", '<orthologGroup id="{}">'.format(fam + 1), 1))
+        fh.write('</groups>\n</orthoXML>\n')
+
+
+def write_release(release, release_dir, fas_pairs=200000):
+    os.makedirs(os.path.join(release_dir, "fas_annotations"), exist_ok=True)
+    sp_names = release.swissprot_names()
+    with gzip.open(os.path.join(release_dir, "mapping.json.gz"), 'wt', encoding="utf-8", compresslevel=1) as fh:
+        fh.write(json.dumps(release.mapping(sp_names)))
+    with gzip.open(os.path.join(release_dir, "swissprot.txt.gz"), 'wt') as fh:
+        for prot_nr, name in sorted(sp_names.items()):
+            fh.write(">sp|{}|{}\n".format(release.accession(prot_nr), name))
+    vgnc = release.vgnc_orthologs()
+    with gzip.open(os.path.join(release_dir, "vgnc-orthologs.txt.gz"), 'wt') as fh:
+        fh.write("".join("{}\t{}\t{}\n".format(*rel) for rel in vgnc))
+    fas_scores = release.fas_scores(max_pairs=fas_pairs)
+    with gzip.open(os.path.join(release_dir, "fas_precomputed.json.gz"), 'wt', compresslevel=1) as fh:
+        fh.write(json.dumps(fas_scores))
+    for species, features in release.fas_annotations().items():
+        with open(os.path.join(release_dir, "fas_annotations", species + ".json"), 'wt') as fh:
+            fh.write(json.dumps({'feature': features, 'clan': {}}))
+    with open(os.path.join(release_dir, "lineage_tree.phyloxml"), 'wt') as fh:
+        fh.write(release.species_tree.to_phyloxml())
+    return {'swissprot_entries': len(sp_names), 'vgnc_orthologs': len(vgnc), 'fas_precomputed_pairs': len(fas_scores)}
+
+
+def write_submission(release, name, out_dir, formats=("tsv", "orthoxml"), miss_rate=0.1, swap_rate=0.02,
+                     max_pairs=None):
+    trees = release.predictions(name, miss_rate=miss_rate, swap_rate=swap_rate)
+    if max_pairs is not None:
+        selected, nr_pairs = [], 0
+        for tree in trees:
+            if nr_pairs >= max_pairs:
+                break
+            selected.append(tree)
+            nr_pairs += count_ortholog_pairs(tree, release.genome_of)
+        trees = selected
+    info = {'groups': len(trees)}
+    if "tsv" in formats:
+        info['tsv'] = "{}.tsv.gz".format(name)
+        info['pairs'] = write_tsv(os.path.join(out_dir, info['tsv']), release, trees)
+    else:
+        info['pairs'] = sum(count_ortholog_pairs(tree, release.genome_of) for tree in trees)
+    if "orthoxml" in formats:
+        info['orthoxml'] = "{}.orthoxml.gz".format(name)
+        write_orthoxml(os.path.join(out_dir, info['orthoxml']), release, trees)
+    logger.info("submission {}: {} groups with {} pairwise orthologs".format(name, info['groups'], info['pairs']))
+    return info
+
+
+def generate(out_dir, nr_species, genes_per_species, nr_families=None, nr_excluded=1, nr_submissions=1,
+             formats=("tsv", "orthoxml"), miss_rate=0.1, swap_rate=0.02, max_pairs=None, fas_pairs=200000,
+             seed=1):
+    params = {'species': nr_species, 'genes_per_species': genes_per_species, 'families': nr_families,
+              'excluded_species': nr_excluded, 'submissions': nr_submissions, 'formats': list(formats),
+              'miss_rate': miss_rate, 'swap_rate': swap_rate, 'max_pairs': max_pairs, 'fas_pairs': fas_pairs,
+              'seed': seed}
+    release = SyntheticRelease(nr_species, genes_per_species, nr_families=nr_families, nr_excluded=nr_excluded,
+                               seed=seed)
+    release_dir = os.path.join(out_dir, "release")
+    summary = {'parameters': params, 'release_dir': "release", 'proteins': release.nr_proteins,
+               'families': len(release.families), 'species': release.species,
+               'excluded_species': sorted(release.excluded)}
+    summary.update(write_release(release, release_dir, fas_pairs=fas_pairs))
+    sub_dir = os.path.join(out_dir, "submissions")
+    os.makedirs(sub_dir, exist_ok=True)
+    summary['submissions'] = {}
+    for k in range(nr_submissions):
+        name = "method{}".format(k)
+        summary['submissions'][name] = write_submission(release, name, sub_dir, formats=formats,
+                                                        miss_rate=miss_rate, swap_rate=swap_rate,
+                                                        max_pairs=max_pairs)
+    with open(os.path.join(out_dir, "synthetic.json"), 'wt') as fh:
+        json.dump(summary, fh, indent=4, separators=(',', ': '))
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate a synthetic reference release and ortholog predictions")
+    parser.add_argument('out_dir', help="directory to store the release and submissions in")
+    parser.add_argument('--size', choices=SIZES.keys(), default="small",
+                        help="preset for the number of species and genes per species")
+    parser.add_argument('--species', type=int, help="number of species. overrides --size")
+    parser.add_argument('--genes', type=int, help="average number of genes per species. overrides --size")
+    parser.add_argument('--families', type=int, help="number of gene families. Defaults to 70%% of --genes")
+    parser.add_argument('--excluded-species', type=int, default=1,
+                        help="number of species whose ids are listed as excluded_ids")
+    parser.add_argument('--submissions', type=int, default=1, help="number of predicted ortholog sets")
+    parser.add_argument('--formats', nargs="+", choices=("tsv", "orthoxml"), default=["tsv", "orthoxml"],
+                        help="formats of the submissions")
+    parser.add_argument('--miss-rate', type=float, default=0.1,
+                        help="probability of a gene to be missing in the predicted families")
+    parser.add_argument('--swap-rate', type=float, default=0.02,
+                        help="probability of a gene to be replaced by a random gene of the same species")
+    parser.add_argument('--max-pairs', type=int, help="limit the submissions to about this many pairs")
+    parser.add_argument('--fas-pairs', type=int, default=200000,
+                        help="approximate number of precomputed FAS scores")
+    parser.add_argument('--seed', type=int, default=1, help="seed of the random generators")
+    parser.add_argument('-d', '--debug', action="store_true", help="Set logging to debug level")
+    conf = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if conf.debug else logging.INFO,
+                        format="%(asctime)-15s %(levelname)-7s: %(message)s")
+
+    nr_species, genes = SIZES[conf.size]
+    summary = generate(conf.out_dir, conf.species or nr_species, conf.genes or genes, nr_families=conf.families,
+                       nr_excluded=conf.excluded_species, nr_submissions=conf.submissions, formats=conf.formats,
+                       miss_rate=conf.miss_rate, swap_rate=conf.swap_rate, max_pairs=conf.max_pairs,
+                       fas_pairs=conf.fas_pairs, seed=conf.seed)
+    print("generated {} proteins in {} families; submissions: {}".format(
+        summary['proteins'], summary['families'],
+        ", ".join("{} ({} pairs)".format(k, v['pairs']) for k, v in summary['submissions'].items())))
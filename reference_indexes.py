@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""Derived indexes of the reference data of a QfO release.
+
+Several benchmarks re-derive the same release-invariant data on every run,
+e.g. the true SwissProt ortholog pairs or the FAS score lookup table. The
+``prepare`` command builds all of them once into ``<release_dir>/indexes/``
+and records in a manifest for every index the format version and the size,
+mtime and sha256 checksum of the inputs it was built from.
+
+The benchmarks use an index only if it is listed in the manifest with the
+current format version and its inputs are unchanged. Otherwise they fall
+back to parse the raw reference files as before.
+
+Example::
+
+    ./reference_indexes.py prepare reference_data/2022
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+
+from helpers import auto_open, load_json_file
+
+logger = logging.getLogger("reference-indexes")
+# the index builders and loaders import numpy themselves (see
+# perftests/startup_times.py)
+INDEX_DIR = "indexes"
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+IndexSpec = collections.namedtuple("IndexSpec", ["fname", "inputs", "version", "builder", "loader"])
+
+
+def _build_mapping(inputs, out):
+    data = load_json_file(inputs[0])
+    with open(out, 'wb') as fh:
+        pickle.dump(data, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load_pickle(path):
+    with open(path, 'rb') as fh:
+        return pickle.load(fh)
+
+
+def _build_swissprot_entries(inputs, out):
+    import numpy
+    from swissprot_benchmark import get_swissprot_entries
+    sp_entries = get_swissprot_entries(*inputs)
+    enrs = sorted(sp_entries)
+    with open(out, 'wb') as fh:
+        numpy.savez(fh, prot_nr=numpy.array(enrs, dtype="int32"),
+                    sp_id=numpy.array([sp_entries[en] for en in enrs], dtype="U"))
+
+
+def _load_swissprot_entries(path):
+    import numpy
+    with numpy.load(path) as data:
+        return dict(zip(data['prot_nr'].tolist(), data['sp_id'].tolist()))
+
+
+def _build_swissprot_true_pairs(inputs, out):
+    import numpy
+    from swissprot_benchmark import get_swissprot_entries, SwissProtComparerSimple
+    true_orthologs = SwissProtComparerSimple(get_swissprot_entries(*inputs)).true_orthologs
+    with open(out, 'wb') as fh:
+        numpy.savez(fh, pairs=numpy.array(sorted(true_orthologs), dtype="int32").reshape(-1, 2))
+
+
+def _load_pairs(path):
+    import numpy
+    with numpy.load(path) as data:
+        pairs = data['pairs']
+        return frozenset(zip(pairs[:, 0].tolist(), pairs[:, 1].tolist()))
+
+
+def _build_lineage_species_sets(inputs, out):
+    from swissprot_benchmark import get_swissprot_entries, SwissProtComparerTaxRangeLimited
+    mapping, sp_file, lineage_tree = inputs
+    strategy = SwissProtComparerTaxRangeLimited(get_swissprot_entries(mapping, sp_file), species_tree_fn=lineage_tree)
+    with auto_open(out, 'wt') as fh:
+        json.dump({fam: sorted(species) for fam, species in strategy._per_fam_species_to_consider.items()}, fh)
+
+
+def _load_lineage_species_sets(path):
+    res = collections.defaultdict(set)
+    res.update((fam, set(species)) for fam, species in load_json_file(path).items())
+    return res
+
+
+def _build_vgnc_orthologs(inputs, out):
+    from vgnc_benchmark import read_vgnc_orthologs, write_vgnc_orthologs_binary
+    write_vgnc_orthologs_binary(out, read_vgnc_orthologs(inputs[0]))
+
+
+def _load_vgnc_orthologs(path):
+    from vgnc_benchmark import load_vgnc_orthologs_binary
+    return load_vgnc_orthologs_binary(path)
+
+
+def _build_fas_scores(inputs, out):
+    import numpy
+    from fas_benchmark import load_precomputed_fas_scores
+    scores = load_precomputed_fas_scores(inputs[0])
+    pairs = sorted(scores)
+    with open(out, 'wb') as fh:
+        numpy.savez(fh, acc1=numpy.array([p[0] for p in pairs], dtype="U"),
+                    acc2=numpy.array([p[1] for p in pairs], dtype="U"),
+                    score=numpy.array([scores[p] for p in pairs], dtype="float64"))
+
+
+def _load_fas_scores(path):
+    import numpy
+    with numpy.load(path) as data:
+        return dict(zip(zip(data['acc1'].tolist(), data['acc2'].tolist()), data['score'].tolist()))
+
+
+def _build_fas_prot2tax(inputs, out):
+    import numpy
+    from pathlib import Path
+    from fas_benchmark import generate_prot_to_annoationfile_map
+    prot2tax = generate_prot_to_annoationfile_map(Path(inputs[0]))
+    prots = sorted(prot2tax)
+    taxa = sorted(set(prot2tax.values()))
+    tax_idx = {tax: k for k, tax in enumerate(taxa)}
+    with open(out, 'wb') as fh:
+        numpy.savez(fh, prot=numpy.array(prots, dtype="U"),
+                    tax=numpy.array([tax_idx[prot2tax[p]] for p in prots], dtype="int32"),
+                    taxa=numpy.array(taxa, dtype="U"))
+
+
+def _load_fas_prot2tax(path):
+    import numpy
+    with numpy.load(path) as data:
+        return dict(zip(data['prot'].tolist(), data['taxa'][data['tax']].tolist()))
+
+
+INDEXES = collections.OrderedDict([
+    ("mapping", IndexSpec("mapping.pickle", ("mapping.json.gz",), 1, _build_mapping, _load_pickle)),
+    ("swissprot_entries", IndexSpec("swissprot_entries.npz", ("mapping.json.gz", "swissprot.txt.gz"), 1,
+                                    _build_swissprot_entries, _load_swissprot_entries)),
+    ("swissprot_true_pairs", IndexSpec("swissprot_true_pairs.npz", ("mapping.json.gz", "swissprot.txt.gz"), 1,
+                                       _build_swissprot_true_pairs, _load_pairs)),
+    ("lineage_species_sets", IndexSpec("lineage_species_sets.json.gz",
+                                       ("mapping.json.gz", "swissprot.txt.gz", "lineage_tree.phyloxml"), 1,
+                                       _build_lineage_species_sets, _load_lineage_species_sets)),
+    ("vgnc_orthologs", IndexSpec("vgnc_orthologs.npz", ("vgnc-orthologs.txt.gz",), 1,
+                                 _build_vgnc_orthologs, _load_vgnc_orthologs)),
+    ("fas_scores", IndexSpec("fas_scores.npz", ("fas_precomputed.json.gz",), 1,
+                             _build_fas_scores, _load_fas_scores)),
+    ("fas_prot2tax", IndexSpec("fas_prot2tax.npz", ("fas_annotations",), 1,
+                               _build_fas_prot2tax, _load_fas_prot2tax)),
+])
+
+
+def _files_of(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(root, f) for root, _, files in os.walk(path) for f in files)
+    return [path]
+
+
+def input_checksum(path):
+    """sha256 of an input file. For directories, the checksum covers the
+    relative names and the content of all contained files"""
+    h = hashlib.sha256()
+    for fn in _files_of(path):
+        if fn != path:
+            h.update(os.path.relpath(fn, path).encode('utf-8') + b"\0")
+        with open(fn, 'rb') as fh:
+            while True:
+                block = fh.read(1 << 22)
+                if not block:
+                    break
+                h.update(block)
+    return h.hexdigest()
+
+
+def _input_stat(path):
+    stats = [os.stat(fn) for fn in _files_of(path)]
+    return {'size': sum(st.st_size for st in stats),
+            'mtime': max((st.st_mtime for st in stats), default=0)}
+
+
+def describe_input(path):
+    desc = _input_stat(path)
+    desc['sha256'] = input_checksum(path)
+    return desc
+
+
+def _index_dir(release_dir):
+    return os.path.join(release_dir, INDEX_DIR)
+
+
+def read_manifest(release_dir):
+    try:
+        with open(os.path.join(_index_dir(release_dir), MANIFEST_NAME), 'rt') as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        return {'version': MANIFEST_VERSION, 'indexes': {}}
+    if manifest.get('version') != MANIFEST_VERSION:
+        logger.warning("ignoring index manifest of {} with unsupported version {}"
+                       .format(release_dir, manifest.get('version')))
+        return {'version': MANIFEST_VERSION, 'indexes': {}}
+    return manifest
+
+
+def _write_manifest(release_dir, manifest):
+    index_dir = _index_dir(release_dir)
+    fd, tmp = tempfile.mkstemp(prefix=".manifest-", dir=index_dir)
+    with os.fdopen(fd, 'wt') as fh:
+        json.dump(manifest, fh, sort_keys=True, indent=4, separators=(',', ': '))
+    os.replace(tmp, os.path.join(index_dir, MANIFEST_NAME))
+
+
+def _input_unchanged(path, recorded):
+    try:
+        current = _input_stat(path)
+    except OSError:
+        return False
+    if current['size'] != recorded['size']:
+        return False
+    if current['mtime'] == recorded['mtime']:
+        return True
+    # e.g. copied release directory. Only the content matters
+    return input_checksum(path) == recorded['sha256']
+
+
+def find_index(name, inputs):
+    """returns the path of a valid index `name` that was built from the
+    given input files, or None if no such index exists.
+
+    The input files must be located in the release directory and have
+    the file names listed in :data:`INDEXES`."""
+    spec = INDEXES[name]
+    inputs = [os.path.abspath(p) for p in inputs]
+    if [os.path.basename(p) for p in inputs] != list(spec.inputs):
+        return None
+    release_dir = os.path.dirname(inputs[0])
+    if any(os.path.dirname(p) != release_dir for p in inputs):
+        return None
+    entry = read_manifest(release_dir)['indexes'].get(name)
+    if entry is None:
+        return None
+    path = os.path.join(_index_dir(release_dir), spec.fname)
+    if entry['version'] != spec.version or not os.path.isfile(path):
+        logger.info("index {} of {} is outdated".format(name, release_dir))
+        return None
+    if not all(_input_unchanged(p, entry['inputs'][os.path.basename(p)]) for p in inputs):
+        logger.warning("inputs of index {} in {} have changed since the index was built. "
+                       "Rerun 'reference_indexes.py prepare {}'".format(name, release_dir, release_dir))
+        return None
+    return path
+
+
+def load_index(name, *inputs):
+    """loads the index `name` built from the input files, or returns None
+    if there is no valid index for these inputs"""
+    path = find_index(name, inputs)
+    if path is None:
+        return None
+    logger.info("loading {} from index {}".format(name, path))
+    return INDEXES[name].loader(path)
+
+
+def load_mapping(path):
+    data = load_index("mapping", path)
+    if data is None:
+        data = load_json_file(path)
+    return data
+
+
+def prepare(release_dir, names=None, force=False):
+    """builds the indexes of a release directory and returns the names
+    of the indexes that have been (re-)built. Indexes whose inputs are
+    not part of the release are skipped."""
+    os.makedirs(_index_dir(release_dir), exist_ok=True)
+    manifest = read_manifest(release_dir)
+    built = []
+    for name, spec in INDEXES.items():
+        if names is not None and name not in names:
+            continue
+        inputs = [os.path.join(release_dir, fn) for fn in spec.inputs]
+        missing = [fn for fn in inputs if not os.path.exists(fn)]
+        if missing:
+            logger.info("skipping index {}: {} not available".format(name, ", ".join(missing)))
+            continue
+        if not force and find_index(name, inputs) is not None:
+            logger.info("index {} is up-to-date".format(name))
+            continue
+        logger.info("building index {}".format(name))
+        out = os.path.join(_index_dir(release_dir), spec.fname)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", suffix=spec.fname, dir=_index_dir(release_dir))
+        os.close(fd)
+        try:
+            spec.builder(inputs, tmp)
+            os.replace(tmp, out)
+        except ImportError as e:
+            os.remove(tmp)
+            logger.warning("cannot build index {}: {}".format(name, e))
+            continue
+        except BaseException:
+            os.remove(tmp)
+            raise
+        manifest['indexes'][name] = {'file': spec.fname,
+                                     'version': spec.version,
+                                     'inputs': {os.path.basename(fn): describe_input(fn) for fn in inputs}}
+        _write_manifest(release_dir, manifest)
+        built.append(name)
+    return built
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build and check the derived indexes of QfO reference data")
+    parser.add_argument('-d', '--debug', action="store_true", help="Set logging to debug level")
+    sub = parser.add_subparsers(dest="command")
+    sub.required = True
+    p = sub.add_parser("prepare", help="build all indexes of a release directory")
+    p.add_argument('release_dir', help="directory with the reference data of a release")
+    p.add_argument('--index', action="append", choices=list(INDEXES),
+                   help="only build this index. Can be given several times")
+    p.add_argument('--force', action="store_true", help="rebuild indexes even if they are up-to-date")
+    p = sub.add_parser("status", help="list the indexes of a release directory and whether they are valid")
+    p.add_argument('release_dir', help="directory with the reference data of a release")
+    conf = parser.parse_args()
+
+    log_conf = {'level': logging.INFO, 'format': "%(asctime)-15s %(levelname)-7s: %(message)s"}
+    if conf.debug:
+        log_conf['level'] = logging.DEBUG
+    logging.basicConfig(**log_conf)
+
+    if conf.command == "prepare":
+        built = prepare(conf.release_dir, names=conf.index, force=conf.force)
+        print("built {} indexes in {}: {}".format(len(built), _index_dir(conf.release_dir), ", ".join(built)))
+    else:
+        for name, spec in INDEXES.items():
+            path = find_index(name, [os.path.join(conf.release_dir, fn) for fn in spec.inputs])
+            print("{:<22} {}".format(name, "valid" if path is not None else "missing/outdated"))
@@ -0,0 +1,73 @@
+import hashlib
+import json
+
+import numpy
+
+NO_GENOME = numpy.iinfo("uint16").max
+
+
+class ReferenceProteomes:
+    """Layout of the reference proteomes of a QfO release.
+
+    The proteins of a release are numbered consecutively (prot_nr) starting
+    at 1, genome by genome. The genome k contains the proteins
+    goff[k]+1 .. goff[k+1]. The genome index of every protein is stored in
+    a compact uint16 array, so genome lookups of many proteins can be done
+    at once with numpy indexing instead of bisecting the offsets.
+
+    Example::
+
+        refset = ReferenceProteomes.from_mapping(load_json_file("mapping.json.gz"))
+        refset.same_genome(numpy.array([1, 2]), numpy.array([3, 50000]))
+        first, last = refset.range_of("HUMAN")
+    """
+
+    def __init__(self, goff, species, mapping=None, excluded_ids=None):
+        self.goff = numpy.asarray(goff, dtype="int64")
+        self.species = list(species)
+        self.species_index = {sp: k for k, sp in enumerate(self.species)}
+        self.mapping = mapping if mapping is not None else {}
+        self.excluded_ids = excluded_ids if excluded_ids is not None else set([])
+        if len(self.species) >= NO_GENOME:
+            raise ValueError("too many genomes: {}".format(len(self.species)))
+        # index 0 is not a valid prot_nr
+        self.genome_idx = numpy.empty(self.nr_proteins + 1, dtype="uint16")
+        self.genome_idx[0] = NO_GENOME
+        self.genome_idx[1:] = numpy.repeat(numpy.arange(len(self.species), dtype="uint16"),
+                                           numpy.diff(self.goff))
+
+    @classmethod
+    def from_mapping(cls, mapping_data):
+        """builds the model from the content of a mapping.json file"""
+        return cls(mapping_data['Goff'], mapping_data['species'], mapping=mapping_data['mapping'],
+                   excluded_ids=mapping_data.get('excluded_ids', set([])))
+
+    @property
+    def nr_proteins(self):
+        return int(self.goff[-1])
+
+    @property
+    def nr_genomes(self):
+        return len(self.species)
+
+    def fingerprint(self):
+        """returns a hex digest identifying the protein numbering of the
+        release, i.e. the species and their genome offsets"""
+        layout = json.dumps({'Goff': self.goff.tolist(), 'species': self.species}, sort_keys=True)
+        return hashlib.sha256(layout.encode('utf-8')).hexdigest()
+
+    def genome_of(self, ids):
+        """returns the genome index of a prot_nr or an array of prot_nrs"""
+        return self.genome_idx[ids]
+
+    def species_of(self, prot_nr):
+        return self.species[self.genome_idx[prot_nr]]
+
+    def same_genome(self, a, b):
+        """elementwise test whether the proteins of a and b belong to the same genome"""
+        return self.genome_idx[a] == self.genome_idx[b]
+
+    def range_of(self, species):
+        """returns the first and last prot_nr of the genome of a species"""
+        k = self.species_index[species]
+        return int(self.goff[k]) + 1, int(self.goff[k + 1])
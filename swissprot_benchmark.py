@@ -6,19 +6,23 @@ import json
 import logging
 import math
 import os
-import sqlite3
 
-import Bio.Phylo
-import dendropy
-
-from JSON_templates import write_assessment_dataset
-from helpers import auto_open, load_json_file
+import benchmark_stats
+import perf
+from JSON_templates import write_assessment_dataset, validate_many
+from helpers import auto_open, RawOutputWriter, connect_db
+from reference_indexes import load_index, load_mapping
 
 logger = logging.getLogger("SP-Benchmark")
 
 
 def get_swissprot_entries(mapping_path, sp_file):
-    mapping = load_json_file(mapping_path)
+    sp_entries = load_index("swissprot_entries", mapping_path, sp_file)
+    if sp_entries is not None:
+        logger.info("found {} swissprot entries".format(len(sp_entries)))
+        return sp_entries
+
+    mapping = load_mapping(mapping_path)
     sp_entries = {}
     excluded = 0
     with auto_open(sp_file, 'rt') as fh:
@@ -48,9 +52,12 @@ def get_species(sp):
 
 
 class SwissProtComparerSimple:
-    def __init__(self, sp_entries, **kwargs):
+    def __init__(self, sp_entries, true_orthologs=None, **kwargs):
         self.sp_entries = sp_entries
-        self._init_relations()
+        if true_orthologs is not None:
+            self.true_orthologs = frozenset(true_orthologs)
+        else:
+            self._init_relations()
 
     def are_orthologs(self, en1, en2):
         #sp_id1, sp_id2 = tuple(sp_entries[enr].rsplit('_', 1)[0] for enr in (en1, en2))
@@ -73,12 +80,20 @@ class SwissProtComparerSimple:
 
 
 class SwissProtComparerTaxRangeLimited(SwissProtComparerSimple):
-    def __init__(self, sp_entries, species_tree_fn, **kwargs):
+    def __init__(self, sp_entries, species_tree_fn, per_fam_species=None, **kwargs):
         super().__init__(sp_entries, **kwargs)
-        self.species_tree = self._load_species_tree(species_tree_fn)
-        self._per_fam_species_to_consider = self._extract_per_fam_species_set()
+        if per_fam_species is not None:
+            # precomputed species sets, e.g. from the reference indexes
+            self._per_fam_species_to_consider = per_fam_species
+        else:
+            self.species_tree = self._load_species_tree(species_tree_fn)
+            self._per_fam_species_to_consider = self._extract_per_fam_species_set()
 
     def _load_species_tree(self, tree_fn):
+        # only imported here, as they are slow to load and not needed for
+        # the other strategies or with precomputed species sets
+        import Bio.Phylo
+        import dendropy
         with open(tree_fn, 'rt') as fh:
             tree = Bio.Phylo.read(fh, 'phyloxml')
         for n in tree.get_terminals():
@@ -113,14 +128,14 @@ class SwissProtComparerTaxRangeLimited(SwissProtComparerSimple):
         return per_fam_species
 
     def are_non_orthologs(self, en1, en2, info1, info2, **kwargs):
-        id1, id2 = (get_idpart(sp_entries[en]) for en in (en1, en2))
+        id1, id2 = (get_idpart(self.sp_entries[en]) for en in (en1, en2))
         org1, org2 = (i.Species for i in (info1, info2))
         res = id1[0] != id2[0] and \
               org2 in self._per_fam_species_to_consider[id1] and \
               org1 in self._per_fam_species_to_consider[id2]
         if id1[0] != id2[0] and logger.isEnabledFor(logging.DEBUG):
             logger.debug("check non-ortholog: {} vs {}; {}:{}; {}:{}; return: {}".
-                         format(sp_entries[en1], sp_entries[en2], id1,
+                         format(self.sp_entries[en1], self.sp_entries[en2], id1,
                                 self._per_fam_species_to_consider[id1],
                                 id2,
                                 self._per_fam_species_to_consider[id2],
@@ -141,12 +156,12 @@ class SwissProtComparerExistingIdInBothSpecies(SwissProtComparerSimple):
         return sps
 
     def are_non_orthologs(self, en1, en2, info1, info2, **kwargs):
-        id1, id2 = (get_idpart(sp_entries[en]) for en in (en1, en2))
+        id1, id2 = (get_idpart(self.sp_entries[en]) for en in (en1, en2))
         org1, org2 = (i.Species for i in (info1, info2))
         res = id1[0] != id2[0] and id1 in self.ids_per_species[org2] and id2 in self.ids_per_species[org1]
         if id1[0] != id2[0] and logger.isEnabledFor(logging.DEBUG):
             logger.debug("check non-ortholog: {} vs {}: {} in {}: {}; {} in {}: {}; return {}"
-                         .format(sp_entries[en1], sp_entries[en2],
+                         .format(self.sp_entries[en1], self.sp_entries[en2],
                                  id1, org2, id1 in self.ids_per_species[org2],
                                  id2, org1, id2 in self.ids_per_species[org1],
                                  res))
@@ -191,7 +206,7 @@ def create_one2one_orthologs_table(db_path):
         cur.executemany("INSERT INTO one2one_orthologs (prot_nr1, prot_nr2) VALUES (?, ?)", one_to_one_pairs)
         con.commit()
 
-    con = sqlite3.connect(db_path)
+    con = connect_db(db_path)
     genomes = load_species()
     create_one2one_table()
     for g1, g2 in itertools.combinations(genomes, 2):
@@ -200,7 +215,13 @@ def create_one2one_orthologs_table(db_path):
     con.close()
 
 
-def compute_sp_benchmark(sp_entries, db_path, raw_out, strategy: SwissProtComparerSimple, orth_tab):
+def compute_sp_benchmark(sp_entries, db_path, raw_out, strategy: SwissProtComparerSimple, orth_tab,
+                         pair_counts=None, bootstrap=None):
+    """computes the metrics of the SwissProtIDs benchmark. If pair_counts
+    (a benchmark_stats.SpeciesPairCounts) is given, the TP, FP and FN
+    relations are also counted per species pair. With bootstrap (a
+    benchmark_stats.Bootstrap), confidence intervals of TPR and PPV are
+    added to the metrics."""
 
     def get_prot_data_for(proteins):
         data = {}
@@ -223,28 +244,36 @@ def compute_sp_benchmark(sp_entries, db_path, raw_out, strategy: SwissProtCompar
         for en1, en2 in rels:
             out.write("{}\t{}\t{}\t{}\t{}\n".format(sp_entries[en1], sp_entries[en2], typ,
                                                     protein_infos[en1].Species, protein_infos[en2].Species))
+            if pair_counts is not None:
+                pair_counts.add(typ, protein_infos[en1].Species, protein_infos[en2].Species)
+            if unit_counts is not None:
+                unit_counts.add(typ, get_idpart(sp_entries[en1]) if bootstrap.unit == "family" else en1)
 
-    con = sqlite3.connect(db_path)
+    unit_counts = benchmark_stats.UnitCounts() if bootstrap is not None else None
+    con = connect_db(db_path)
     nr_true = len(strategy.true_orthologs)
     missing_true_orthologs = set(strategy.true_orthologs)
-    protein_infos = get_prot_data_for(list(sp_entries.keys()))
+    with perf.phase("proteome scan", rows=len(sp_entries)):
+        protein_infos = get_prot_data_for(list(sp_entries.keys()))
     
     orthologs_among_sp = 0
     tp = 0
     fp = 0
-    for sp_entry in sp_entries:
-        orths = get_swissprot_orthologs_of(sp_entry)
-        orthologs_among_sp += len(orths)
-        false_positives = [(sp_entry, en) for en in orths
-                           if strategy.are_non_orthologs(sp_entry, en, info1=protein_infos[sp_entry],
-                                                         info2=protein_infos[en])]
-        fp += len(false_positives)
-        write_raw_rels(raw_out, false_positives, 'FP')
-
-        true_positives = {(sp_entry, en) for en in orths if strategy.are_orthologs(sp_entry, en)}
-        tp += len(true_positives)
-        write_raw_rels(raw_out, true_positives, 'TP')
-        missing_true_orthologs -= true_positives
+    with perf.phase("ortholog scan") as ph:
+        for sp_entry in sp_entries:
+            orths = get_swissprot_orthologs_of(sp_entry)
+            orthologs_among_sp += len(orths)
+            false_positives = [(sp_entry, en) for en in orths
+                               if strategy.are_non_orthologs(sp_entry, en, info1=protein_infos[sp_entry],
+                                                             info2=protein_infos[en])]
+            fp += len(false_positives)
+            write_raw_rels(raw_out, false_positives, 'FP')
+
+            true_positives = {(sp_entry, en) for en in orths if strategy.are_orthologs(sp_entry, en)}
+            tp += len(true_positives)
+            write_raw_rels(raw_out, true_positives, 'TP')
+            missing_true_orthologs -= true_positives
+        ph.rows = orthologs_among_sp
 
     con.close()
     write_raw_rels(raw_out, missing_true_orthologs, "FN")
@@ -258,17 +287,61 @@ def compute_sp_benchmark(sp_entries, db_path, raw_out, strategy: SwissProtCompar
                {"name": "TPR", "value": tpr, "stderr": 1.96 * math.sqrt(tpr * (1 - tpr) / nr_true)},
                {"name": "PPV", "value": ppv, "stderr": 1.96 * math.sqrt(ppv * (1 - ppv) / (fp + tp))},
                ]
+    if bootstrap is not None:
+        with perf.phase("bootstrap", rows=len(unit_counts.units)):
+            intervals = bootstrap.rates(unit_counts)
+        for metric in metrics:
+            if metric['name'] in intervals:
+                metric['bootstrap'] = intervals[metric['name']]
     return metrics
 
 
+def get_strategy(strategy_name, sp_entries, mapping_path, sp_file, lineage_tree=None):
+    """returns the comparer object for a benchmark strategy. The true
+    orthologs and lineage species sets are loaded from the reference
+    indexes if available."""
+    true_orthologs = load_index("swissprot_true_pairs", mapping_path, sp_file)
+    if strategy_name.lower() == "simple":
+        strategy = SwissProtComparerSimple(sp_entries, true_orthologs=true_orthologs)
+    elif strategy_name.lower() == "clade_limit":
+        per_fam_species = None
+        if lineage_tree is not None:
+            per_fam_species = load_index("lineage_species_sets", mapping_path, sp_file, lineage_tree)
+        strategy = SwissProtComparerTaxRangeLimited(sp_entries, species_tree_fn=lineage_tree,
+                                                    true_orthologs=true_orthologs, per_fam_species=per_fam_species)
+    elif strategy_name.lower() == "ids_exist_in_both":
+        strategy = SwissProtComparerExistingIdInBothSpecies(sp_entries, true_orthologs=true_orthologs)
+    else:
+        raise Exception("Invalid strategy")
+    return strategy
+
+
+def raw_output_fname(outdir, participant, strategy_name):
+    return os.path.join(outdir, "SP_{}_{}_raw.txt.gz".format(participant.replace(' ', '-').replace('_', '-'),
+                                                             strategy_name))
+
+
+def run_benchmark(sp_entries, strategy, db_path, outfn_path, assessment_out, community, participant,
+                  orth_tab="orthologs", bootstrap=None):
+    pair_counts = benchmark_stats.SpeciesPairCounts()
+    with RawOutputWriter(outfn_path) as raw_out_fh:
+        res = compute_sp_benchmark(sp_entries, db_path, raw_out_fh, strategy, orth_tab=orth_tab,
+                                   pair_counts=pair_counts, bootstrap=bootstrap)
+    pair_counts.save(benchmark_stats.species_pairs_fname(outfn_path))
+    write_assessment_json_stub(assessment_out, community, participant, res)
+    return res
+
+
 def write_assessment_json_stub(fn, community, participant, result):
     challenge = "SwissProtIDs"
     stubs = []
     for metric in result:
         id_ = "{}:{}_{}_{}_A".format(community, challenge, metric['name'],
                                      participant.replace(' ', '-').replace('_', '-'))
+        extra = {'bootstrap': metric['bootstrap']} if 'bootstrap' in metric else None
         stubs.append(write_assessment_dataset(id_, community, challenge, participant, metric['name'], metric['value'],
-                                              metric.get('stderr', 0)))
+                                              metric.get('stderr', 0), validate=False, extra=extra))
+    stubs = validate_many(stubs)
     with auto_open(fn, 'wt') as fout:
         json.dump(stubs, fout, sort_keys=True, indent=4, separators=(',', ': '))
 
@@ -290,6 +363,7 @@ if __name__ == "__main__":
                         help="benchmark strategy to use. Simple: negatives are any non-prefix sharing relation, "
                              "Clade_limit: only within clades where ID is used.")
     parser.add_argument('--lineage-tree', help="path to lineage tree in phyloxml format. Used for clade_limit strategy only")
+    benchmark_stats.add_bootstrap_arguments(parser)
     parser.add_argument('--log', help="Path to log file. Defaults to stderr")
     parser.add_argument('-d', '--debug', action="store_true", help="Set logging to debug level")
     conf = parser.parse_args()
@@ -302,26 +376,17 @@ if __name__ == "__main__":
     logging.basicConfig(**log_conf)
     logger.info("running swissprot_benchmark with following arguments: {}".format(conf))
 
+    perf.start("swissprot_benchmark", os.path.dirname(os.path.abspath(conf.assessment_out)))
     os.makedirs(conf.outdir, exist_ok=True)
-    outfn_path = os.path.join(conf.outdir,
-                              "SP_{}_{}_raw.txt.gz".format(conf.participant.replace(' ', '-').replace('_', '-'),
-                                                           conf.strategy)
-                              )
-    sp_entries = get_swissprot_entries(conf.mapping, conf.sp_entries)
-    if conf.strategy.lower() == "simple":
-        strategy = SwissProtComparerSimple(sp_entries)
-    elif conf.strategy.lower() == "clade_limit":
-        strategy = SwissProtComparerTaxRangeLimited(sp_entries, species_tree_fn=conf.lineage_tree)
-    elif conf.strategy.lower() == "ids_exist_in_both":
-        strategy = SwissProtComparerExistingIdInBothSpecies(sp_entries)
-    else:
-        raise Exception("Invalid strategy")
+    outfn_path = raw_output_fname(conf.outdir, conf.participant, conf.strategy)
+    with perf.phase("reference load"):
+        sp_entries = get_swissprot_entries(conf.mapping, conf.sp_entries)
+        strategy = get_strategy(conf.strategy, sp_entries, conf.mapping, conf.sp_entries, conf.lineage_tree)
 
     orth_tab = "orthologs"
     if conf.only_one2one:
         create_one2one_orthologs_table(conf.db)
         orth_tab = "one2one_orthologs"
 
-    with auto_open(outfn_path, 'wt') as raw_out_fh:
-        res = compute_sp_benchmark(sp_entries, conf.db, raw_out_fh, strategy, orth_tab=orth_tab)
-    write_assessment_json_stub(conf.assessment_out, conf.com, conf.participant, res)
+    run_benchmark(sp_entries, strategy, conf.db, outfn_path, conf.assessment_out, conf.com, conf.participant,
+                  orth_tab=orth_tab, bootstrap=benchmark_stats.bootstrap_from_args(conf))
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
-import collections
 import csv
+import io
+import itertools
 import json
-import math
-import sys
-from bisect import bisect_right
+import os
+import struct
+import zlib
 from time import time
 try:
     import lxml.etree as etree
@@ -12,101 +13,151 @@ except ImportError:
     import xml.etree.ElementTree as etree
 import logging
 import JSON_templates
+import binary_predictions
+import perf
+import reference_indexes
+from conversion_cache import ConversionCache
 from helpers import auto_open
+from refset import ReferenceProteomes
 
 logger = logging.getLogger("validator")
+BLOCKSIZE = 1 << 22
 
 
 def load_mapping(path):
-    with auto_open(path, 'rb') as fh:
-        data = json.loads(fh.read().decode('utf-8'))
-    return data
+    return reference_indexes.load_mapping(path)
 
 
-def parse_orthoxml(fh, valid_ids, excluded_ids):
-    nsmap = {}
-    og_level = 0
-    in_species = False
-    nr_species_done = 0
-    nr_excluded_genes = 0
-    max_invalid_ids = 50
+class ThroughputMonitor(io.RawIOBase):
+    """Raw stream wrapper that counts the (decompressed) bytes read from
+    the underlying file handle and periodically logs the throughput."""
 
-    def fixtag(ns, tag):
-        return "{" + nsmap[ns] + "}" + tag
+    def __init__(self, fh, interval=20):
+        super().__init__()
+        self._fh = fh
+        self.interval = interval
+        self.bytes_read = 0
+        self.start = self._last_log = time()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._fh.readinto(b)
+        self.bytes_read += n
+        if time() - self._last_log > self.interval:
+            self.log_progress()
+        return n
+
+    def log_progress(self):
+        self._last_log = time()
+        elapsed = max(self._last_log - self.start, 1e-6)
+        logger.info("read {:.1f} MB in {:.1f} sec ({:.1f} MB/sec)"
+                    .format(self.bytes_read / 1e6, elapsed, self.bytes_read / 1e6 / elapsed))
+
+    def close(self):
+        if not self.closed:
+            self._fh.close()
+        super().close()
+
+
+def open_input(fpath, mode='rb', blocksize=BLOCKSIZE):
+    """opens the (possibly compressed) input file for reading in large blocks.
+
+    :returns: a tuple of the file handle and its ThroughputMonitor"""
+    monitor = ThroughputMonitor(auto_open(fpath, 'rb', buffer_size=blocksize))
+    fh = io.BufferedReader(monitor, buffer_size=blocksize)
+    if mode == 'rt':
+        fh = io.TextIOWrapper(fh, encoding='utf-8')
+    return fh, monitor
+
+
+def iter_orthoxml_events(fh):
+    """yields (event, localname, element) tuples of the orthoxml elements
+    relevant for validation.
+
+    With lxml, only the events of the <species>, <gene>, <groups> and
+    <orthologGroup> elements are reported. Elements are cleared once the
+    consumer has processed their end event."""
+    if etree.__name__ == 'lxml.etree':
+        for event, elem in etree.iterparse(fh, events=('start', 'end'), huge_tree=True,
+                                           tag=('{*}species', '{*}gene', '{*}groups', '{*}orthologGroup')):
+            tag = elem.tag
+            yield event, tag[tag.rfind('}') + 1:], elem
+            if event == 'end':
+                elem.clear(keep_tail=True)
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        return
 
-    logger.info("start mapping of orthoxml formatted input file")
     # The equivalent to ancestor-or-self
     parentStack = []
-    for event, elem in etree.iterparse(fh, events=('start-ns', 'start', 'end')):
+    for event, elem in etree.iterparse(fh, events=('start', 'end')):
+        tag = elem.tag
         if event == 'start':
-            elemTag = elem.tag
-            #if elem.tag == fixtag('', 'orthologGroup'):
-            if elemTag.endswith('}orthologGroup'):
-                assert not in_species
-                og_level += 1
-            #elif elem.tag == fixtag('', 'groups'):
-            elif elemTag.endswith('}groups'):
-                assert nr_species_done > 0
-            #elif elem.tag == fixtag('', 'species'):
-            elif elemTag.endswith('}species'):
-                assert not in_species
-                in_species = True
             # The list of ancestors to the elem
             # is kept here because xml.etree.ElementTree
             # does not keep the parent in the element nodes
             parentStack.append(elem)
-        elif event == 'end':
+            yield event, tag[tag.rfind('}') + 1:], elem
+        else:
             parentStack.pop()
-            elemTag = elem.tag
-            #if elem.tag == fixtag('', 'orthologGroup'):
-            if elemTag.endswith('}orthologGroup'):
-                og_level -= 1
-                assert og_level >= 0
-            #elif elem.tag == fixtag('', 'species'):
-            elif elemTag.endswith('}species'):
-                assert in_species
-                in_species = False
-                nr_species_done += 1
-            #elif elem.tag == fixtag('', 'gene'):
-            elif elemTag.endswith('}gene'):
-                try:
-                    protId = elem.get('protId')
-                    if protId not in valid_ids:
-                        if protId not in excluded_ids:
-                            max_invalid_ids -= 1
-                            logger.warning("\"{}\" is an invalid protein id for this reference dataset"
-                                           .format(protId))
-                            if max_invalid_ids < 0:
-                                raise AssertionError(
-                                    'Too many invalid crossreferences found. Did you select the right reference dataset?')
-                        else:
-                            logger.debug("excluding protein \"{}\" from the benchmark analysis".format(protId))
-                            nr_excluded_genes += 1
-                except KeyError:
-                    raise AssertionError('<gene> elements must encode xref in "protId" attribute')
+            yield event, tag[tag.rfind('}') + 1:], elem
             # we can clear all elements right away
             elem.clear()
-            
-            # This commented piece of code only works in lxml
-            # and it was obtained from
-            # https://web.archive.org/web/20210309115224/http://www.ibm.com/developerworks/xml/library/x-hiperfparse/#listing4
-            # Basically, it removes all the previous siblings
-            # of current element
-            #while elem.getprevious() is not None:
-            #    del elem.getparent()[0]
-            # It is the inspiration to next one.
+            # remove all the previous siblings of current element
             if len(parentStack) > 0:
                 eparent = parentStack[-1]
                 while len(eparent) > 1:
                     del eparent[0]
-        elif event == 'start-ns':
-            ns, url = elem
-            nsmap[ns] = url
+
+
+def parse_orthoxml(fh, valid_ids, excluded_ids):
+    og_level = 0
+    in_species = False
+    nr_species_done = 0
+    nr_genes = 0
+    nr_excluded_genes = 0
+    max_invalid_ids = 50
+
+    logger.info("start mapping of orthoxml formatted input file")
+    for event, tag, elem in iter_orthoxml_events(fh):
+        if event == 'start':
+            if tag == 'orthologGroup':
+                assert not in_species
+                og_level += 1
+            elif tag == 'groups':
+                assert nr_species_done > 0
+            elif tag == 'species':
+                assert not in_species
+                in_species = True
+        elif tag == 'gene':
+            nr_genes += 1
+            protId = elem.get('protId')
+            if protId not in valid_ids:
+                if protId not in excluded_ids:
+                    max_invalid_ids -= 1
+                    logger.warning("\"{}\" is an invalid protein id for this reference dataset"
+                                   .format(protId))
+                    if max_invalid_ids < 0:
+                        raise AssertionError(
+                            'Too many invalid crossreferences found. Did you select the right reference dataset?')
+                else:
+                    logger.debug("excluding protein \"{}\" from the benchmark analysis".format(protId))
+                    nr_excluded_genes += 1
+        elif tag == 'orthologGroup':
+            og_level -= 1
+            assert og_level >= 0
+        elif tag == 'species':
+            assert in_species
+            in_species = False
+            nr_species_done += 1
     assert not in_species
     assert og_level == 0
     assert nr_species_done > 0
     if nr_excluded_genes > 0:
         logger.info("Excluded {} genes form the predictions (excluded species)".format(nr_excluded_genes))
+    logger.info("validated {} genes of {} species".format(nr_genes, nr_species_done))
     return True
 
 
@@ -115,9 +166,23 @@ def parse_tsv(fh, valid_ids, excluded_ids):
     max_errors = 5
     invalid_ids = set([])
     reported_excluded = set([])
-    dialect = csv.Sniffer().sniff(fh.read(2048))
-    fh.seek(0)
-    csv_reader = csv.reader(fh, dialect)
+
+    # sniff the dialect on the first few lines. Lines of tab-separated
+    # files are split directly unless they contain quotes, anything else
+    # is read with the csv module.
+    head_lines = []
+    while sum(len(line) for line in head_lines) < 2048:
+        line = fh.readline()
+        if not line:
+            break
+        head_lines.append(line)
+    lines = itertools.chain(head_lines, fh)
+    dialect = csv.Sniffer().sniff("".join(head_lines))
+    if dialect.delimiter == '\t' and not dialect.skipinitialspace:
+        rows = (next(csv.reader([line], dialect)) if dialect.quotechar in line else line.rstrip('\r\n').split('\t')
+                for line in lines)
+    else:
+        rows = csv.reader(lines, dialect)
 
     def check_if_valid_id(id_):
         if id_ not in valid_ids:
@@ -135,7 +200,7 @@ def parse_tsv(fh, valid_ids, excluded_ids):
                         'Too many invalid crossreferences found. Did you select the right reference dataset?')
 
     line_nr = 0
-    for line_nr, row in enumerate(csv_reader):
+    for line_nr, row in enumerate(rows):
         if len(row) < 2:
             logger.warning("skipping relation on line {} ({})"
                            .format(line_nr, row))
@@ -143,22 +208,58 @@ def parse_tsv(fh, valid_ids, excluded_ids):
             if max_errors < 0:
                 raise AssertionError("Too many lines with less than 2 elements")
             continue
-        for z in row[:2]:
-            check_if_valid_id(z)
+        id1, id2 = row[0], row[1]
+        if id1 not in valid_ids:
+            check_if_valid_id(id1)
+        if id2 not in valid_ids:
+            check_if_valid_id(id2)
     if line_nr < 100:
         raise AssertionError("Too few ortholog pairs to be analysed")
     if len(reported_excluded) > 0:
         logger.info("excluded {} genes from the predictions (excluded species)"
                     .format(len(reported_excluded)))
+    logger.info("validated {} lines".format(line_nr + 1))
+
+
+def parse_binary_predictions(fh, refset):
+    logger.info("trying to read as binary submission file")
+    try:
+        header = binary_predictions.read_header(fh)
+        binary_predictions.check_compatible(header, refset)
+        nr_pairs = 0
+        for pairs in binary_predictions.iter_blocks(fh):
+            nr_pairs += len(pairs)
+            if len(pairs) > 0 and (pairs.min() < 1 or pairs.max() > refset.nr_proteins):
+                raise AssertionError("protein numbers outside of the reference dataset")
+            if refset.same_genome(pairs[:, 0], pairs[:, 1]).any():
+                raise AssertionError("relations within the same genome")
+    except (ValueError, zlib.error, struct.error) as e:
+        raise AssertionError(str(e))
+    if nr_pairs < 100:
+        raise AssertionError("Too few ortholog pairs to be analysed")
+    logger.info("validated {} pairs".format(nr_pairs))
 
 
-def identify_input_type_and_validate(fpath, valid_ids, excluded_ids):
+def identify_input_type_and_validate(fpath, valid_ids, excluded_ids, mapping_data=None):
     with auto_open(fpath, 'rb') as fh:
         head = fh.read(20)
 
-    if head.startswith(b'<?xml') or head.startswith(b'<ortho'):
+    if binary_predictions.is_binary_predictions(head):
+        if mapping_data is None:
+            logger.error('binary submission files can only be validated with the full mapping data')
+            return False
+        try:
+            fh, monitor = open_input(fpath, 'rb')
+            with fh:
+                parse_binary_predictions(fh, ReferenceProteomes.from_mapping(mapping_data))
+        except AssertionError as e:
+            logger.error('input file is not a valid binary submission file: {}'.format(e))
+            return False
+
+    elif head.startswith(b'<?xml') or head.startswith(b'<ortho'):
         try:
-            with auto_open(fpath, 'rb') as fh:
+            fh, monitor = open_input(fpath, 'rb')
+            with fh:
                 parse_orthoxml(fh, valid_ids, excluded_ids)
         except AssertionError as e:
             logger.error('input file is not a valid orthoxml file: {}'.format(e))
@@ -166,11 +267,13 @@ def identify_input_type_and_validate(fpath, valid_ids, excluded_ids):
 
     else:
         try:
-            with auto_open(fpath, 'rt') as fh:
+            fh, monitor = open_input(fpath, 'rt')
+            with fh:
                 parse_tsv(fh, valid_ids, excluded_ids)
         except AssertionError as e:
             logger.error('input file is not a valid tab-separated file: {}'.format(e))
             return False
+    monitor.log_progress()
     return True
 
 
@@ -193,6 +296,9 @@ if __name__ == "__main__":
     parser.add_argument('--challenges_ids', default=[], help="List of benchmarks that will be run")
     parser.add_argument('-p', '--participant', required=True, help="Name of the tool")
     parser.add_argument('-o', '--out', required=True, help="Output filename for validation json")
+    parser.add_argument('--cache-dir', help="Directory of a cache of validation results. If the same input "
+                                            "file was validated before with the same mapping, the cached "
+                                            "result is reused")
     conf = parser.parse_args()
 
     log_conf = {'level': logging.INFO, 'format': "%(asctime)-15s %(levelname)-7s: %(message)s"}
@@ -200,9 +306,29 @@ if __name__ == "__main__":
         log_conf['level'] = logging.DEBUG
     logging.basicConfig(**log_conf)
 
-    mapping_data = load_mapping(conf.mapping)
-    excluded_ids = mapping_data['excluded_ids'] if 'excluded_ids' in mapping_data else set([])
-    is_valid = identify_input_type_and_validate(conf.input_rels, mapping_data['mapping'], excluded_ids)
+    perf.start("validate", os.path.dirname(os.path.abspath(conf.out)))
+    is_valid = None
+    if conf.cache_dir is not None:
+        cache = ConversionCache(conf.cache_dir)
+        cache_key = cache.key_for(conf.input_rels, conf.mapping)
+        cached_result = conf.out + ".cached"
+        if cache.restore("validation", cache_key, {'validation.json': cached_result}):
+            with open(cached_result, 'rt') as fh:
+                is_valid = json.load(fh)['is_valid']
+            os.remove(cached_result)
+
+    if is_valid is None:
+        with perf.phase("mapping load"):
+            mapping_data = load_mapping(conf.mapping)
+        excluded_ids = mapping_data['excluded_ids'] if 'excluded_ids' in mapping_data else set([])
+        with perf.phase("validate", bytes=os.path.getsize(conf.input_rels)):
+            is_valid = identify_input_type_and_validate(conf.input_rels, mapping_data['mapping'], excluded_ids,
+                                                        mapping_data=mapping_data)
+        if conf.cache_dir is not None:
+            with open(cached_result, 'wt') as fh:
+                json.dump({'is_valid': is_valid}, fh)
+            cache.store("validation", cache_key, {'validation.json': cached_result})
+            os.remove(cached_result)
     write_participant_dataset_file(conf.out, conf.participant, conf.com, conf.challenges_ids, is_valid)
     if not is_valid:
-        sys.exit("ERROR: Submitted data does not validate against any reference data! Please check "+conf.out )
+        perf.exit("ERROR: Submitted data does not validate against any reference data! Please check "+conf.out )
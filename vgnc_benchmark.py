@@ -5,16 +5,25 @@ import json
 import logging
 import math
 import os
-import sqlite3
 
-from JSON_templates import write_assessment_dataset
-from helpers import auto_open
+import numpy
+
+import benchmark_stats
+import perf
+from JSON_templates import write_assessment_dataset, validate_many
+from helpers import auto_open, RawOutputWriter, connect_db
+from reference_indexes import load_index
 
 logger = logging.getLogger("VGNC-Benchmark")
 Protein = collections.namedtuple("Protein", ["Acc", "Species", "VGNC_ID"])
 
 
-def compute_vgnc_benchmark(vgnc_orthologs, db_path, raw_out):
+def compute_vgnc_benchmark(vgnc_orthologs, db_path, raw_out, pair_counts=None, bootstrap=None):
+    """computes the metrics of the VGNC benchmark. If pair_counts (a
+    benchmark_stats.SpeciesPairCounts) is given, the TP, FP and FN
+    relations are also counted per species pair. With bootstrap (a
+    benchmark_stats.Bootstrap), confidence intervals of TPR and PPV are
+    added to the metrics."""
     def get_prot_data_for(proteins):
         vgnc_fam = {}
         for (p1, p2), fam in vgnc_orthologs.items():
@@ -49,44 +58,53 @@ def compute_vgnc_benchmark(vgnc_orthologs, db_path, raw_out):
                 f"{protein_infos[en1].Acc}\t{protein_infos[en2].Acc}\t{typ}\t"
                 f"{protein_infos[en1].VGNC_ID}\t{protein_infos[en2].VGNC_ID}\t"
                 f"{protein_infos[en1].Species}\t{protein_infos[en2].Species}\n")
+            if pair_counts is not None:
+                pair_counts.add(typ, protein_infos[en1].Species, protein_infos[en2].Species)
+            if unit_counts is not None:
+                unit_counts.add(typ, protein_infos[en1].VGNC_ID if bootstrap.unit == "family" else en1)
 
-    con = sqlite3.connect(db_path)
+    unit_counts = benchmark_stats.UnitCounts() if bootstrap is not None else None
+    con = connect_db(db_path)
     nr_true = len(vgnc_orthologs)
     missing_true_orthologs = set(vgnc_orthologs.keys())
     logger.info(f"VGNC asserts {nr_true} orthologous relations")
     vgnc_genes = list(set(itertools.chain.from_iterable(vgnc_orthologs.keys())))
-    protein_infos = get_prot_data_for(vgnc_genes)
+    with perf.phase("proteome scan", rows=len(vgnc_genes)):
+        protein_infos = get_prot_data_for(vgnc_genes)
 
-    all_predicted_orthologs_among_vgnc_genes = set(get_orthologs_among_subset_of_proteins(vgnc_genes))
+    with perf.phase("ortholog scan") as ph:
+        all_predicted_orthologs_among_vgnc_genes = set(get_orthologs_among_subset_of_proteins(vgnc_genes))
+        ph.rows = len(all_predicted_orthologs_among_vgnc_genes)
     logger.info(f"Method predicted {len(all_predicted_orthologs_among_vgnc_genes)} among the set of "
                 f"{len(vgnc_genes)} genes in the VGNC dataset")
-    missing_true_orthologs -= set((x[0], x[1]) for x in all_predicted_orthologs_among_vgnc_genes)
-    logger.info(f"Method didn't predict {len(missing_true_orthologs)} asserted orthologs")
-    true_positives = set(vgnc_orthologs.keys()) - missing_true_orthologs
-    tp = len(vgnc_orthologs) - len(missing_true_orthologs)
-    tpr = tp / nr_true
-
-    vgnc_per_species = collections.defaultdict(set)
-    for info in protein_infos.values():
-        vgnc_per_species[info.Species].add(info.VGNC_ID)
-
-    false_positives = []
-    for p1, p2 in all_predicted_orthologs_among_vgnc_genes:
-        if protein_infos[p1].VGNC_ID != protein_infos[p2].VGNC_ID:
-            id1_in_sp2 = protein_infos[p1].VGNC_ID in vgnc_per_species[protein_infos[p2].Species]
-            id2_in_sp1 = protein_infos[p2].VGNC_ID in vgnc_per_species[protein_infos[p1].Species]
-            is_fp = id1_in_sp2 and id2_in_sp1
-            logger.debug(
-                f"is used as fp: {is_fp:1} -- "
-                f"{protein_infos[p1].VGNC_ID} ({protein_infos[p1].Acc}) vs {protein_infos[p2].VGNC_ID} ({protein_infos[p2].Acc}): "
-                f"{protein_infos[p1].VGNC_ID} in {protein_infos[p2].Species}: {id1_in_sp2}; "
-                f"{protein_infos[p2].VGNC_ID} in {protein_infos[p1].Species}: {id2_in_sp1}")
-
-            if is_fp:
-                false_positives.append((p1, p2))
-
-    nr_pos = tp + len(false_positives)
-    ppv = tp / nr_pos
+    with perf.phase("metric computation", rows=len(all_predicted_orthologs_among_vgnc_genes)):
+        missing_true_orthologs -= set((x[0], x[1]) for x in all_predicted_orthologs_among_vgnc_genes)
+        logger.info(f"Method didn't predict {len(missing_true_orthologs)} asserted orthologs")
+        true_positives = set(vgnc_orthologs.keys()) - missing_true_orthologs
+        tp = len(vgnc_orthologs) - len(missing_true_orthologs)
+        tpr = tp / nr_true
+
+        vgnc_per_species = collections.defaultdict(set)
+        for info in protein_infos.values():
+            vgnc_per_species[info.Species].add(info.VGNC_ID)
+
+        false_positives = []
+        for p1, p2 in all_predicted_orthologs_among_vgnc_genes:
+            if protein_infos[p1].VGNC_ID != protein_infos[p2].VGNC_ID:
+                id1_in_sp2 = protein_infos[p1].VGNC_ID in vgnc_per_species[protein_infos[p2].Species]
+                id2_in_sp1 = protein_infos[p2].VGNC_ID in vgnc_per_species[protein_infos[p1].Species]
+                is_fp = id1_in_sp2 and id2_in_sp1
+                logger.debug(
+                    f"is used as fp: {is_fp:1} -- "
+                    f"{protein_infos[p1].VGNC_ID} ({protein_infos[p1].Acc}) vs {protein_infos[p2].VGNC_ID} ({protein_infos[p2].Acc}): "
+                    f"{protein_infos[p1].VGNC_ID} in {protein_infos[p2].Species}: {id1_in_sp2}; "
+                    f"{protein_infos[p2].VGNC_ID} in {protein_infos[p1].Species}: {id2_in_sp1}")
+
+                if is_fp:
+                    false_positives.append((p1, p2))
+
+        nr_pos = tp + len(false_positives)
+        ppv = tp / nr_pos
 
     write_raw_rels(raw_out, true_positives, "TP")
     write_raw_rels(raw_out, false_positives, "FP")
@@ -97,10 +115,46 @@ def compute_vgnc_benchmark(vgnc_orthologs, db_path, raw_out):
     metrics = [{"name": "TPR", "value": tpr, "stderr": 1.96 * math.sqrt(tpr * (1 - tpr) / nr_true)},
                {"name": "PPV", "value": ppv, "stderr": 1.96 * math.sqrt(ppv * (1 - ppv) / nr_pos)},
                ]
+    if bootstrap is not None:
+        with perf.phase("bootstrap", rows=len(unit_counts.units)):
+            intervals = bootstrap.rates(unit_counts)
+        for metric in metrics:
+            if metric['name'] in intervals:
+                metric['bootstrap'] = intervals[metric['name']]
     return metrics
 
 
-def get_vgnc_orthologs(vgnc_orthologs_fname):
+def binary_orthologs_fname(vgnc_orthologs_fname):
+    """returns the path of the binary companion file of a VGNC orthologs
+    text file, e.g. vgnc-orthologs.txt.gz --> vgnc-orthologs.npz"""
+    base = vgnc_orthologs_fname
+    for ext in (".gz", ".txt"):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+    return base + ".npz"
+
+
+def write_vgnc_orthologs_binary(fname, orthologs):
+    """stores the asserted orthologs as sorted (min, max) pairs together with
+    an index into the list of VGNC symbols in a numpy .npz file"""
+    pairs = sorted(orthologs)
+    families = sorted(set(orthologs.values()))
+    fam_idx = {fam: k for k, fam in enumerate(families)}
+    with open(fname, 'wb') as fh:
+        numpy.savez(fh,
+                    pairs=numpy.array(pairs, dtype="int32").reshape(-1, 2),
+                    family=numpy.array([fam_idx[orthologs[p]] for p in pairs], dtype="int32"),
+                    families=numpy.array(families, dtype="U"))
+
+
+def load_vgnc_orthologs_binary(fname):
+    with numpy.load(fname) as data:
+        pairs = data['pairs']
+        families = data['families'][data['family']]
+        return dict(zip(zip(pairs[:, 0].tolist(), pairs[:, 1].tolist()), families.tolist()))
+
+
+def read_vgnc_orthologs(vgnc_orthologs_fname):
     orthologs = {}
     with auto_open(vgnc_orthologs_fname, 'rt') as fh:
         for line in fh:
@@ -111,14 +165,43 @@ def get_vgnc_orthologs(vgnc_orthologs_fname):
     return orthologs
 
 
+def get_vgnc_orthologs(vgnc_orthologs_fname):
+    orthologs = load_index("vgnc_orthologs", vgnc_orthologs_fname)
+    if orthologs is not None:
+        return orthologs
+
+    binary_fname = binary_orthologs_fname(vgnc_orthologs_fname)
+    if os.path.exists(binary_fname) and (not os.path.exists(vgnc_orthologs_fname) or
+                                         os.path.getmtime(binary_fname) >= os.path.getmtime(vgnc_orthologs_fname)):
+        logger.info(f"loading VGNC asserted orthologs from {binary_fname}")
+        return load_vgnc_orthologs_binary(binary_fname)
+    return read_vgnc_orthologs(vgnc_orthologs_fname)
+
+
+def raw_output_fname(outdir, participant):
+    return os.path.join(outdir, "VGNC_{}_raw.txt.gz".format(participant.replace(' ', '-').replace('_', '-')))
+
+
+def run_benchmark(vgnc_orthologs, db_path, outfn_path, assessment_out, community, participant, bootstrap=None):
+    pair_counts = benchmark_stats.SpeciesPairCounts()
+    with RawOutputWriter(outfn_path) as raw_out_fh:
+        res = compute_vgnc_benchmark(vgnc_orthologs, db_path, raw_out_fh, pair_counts=pair_counts,
+                                     bootstrap=bootstrap)
+    pair_counts.save(benchmark_stats.species_pairs_fname(outfn_path))
+    write_assessment_json_stub(assessment_out, community, participant, res)
+    return res
+
+
 def write_assessment_json_stub(fn, community, participant, result):
     challenge = "VGNC"
     stubs = []
     for metric in result:
         id_ = "{}:{}_{}_{}_A".format(community, challenge, metric['name'],
                                      participant.replace(' ', '-').replace('_', '-'))
+        extra = {'bootstrap': metric['bootstrap']} if 'bootstrap' in metric else None
         stubs.append(write_assessment_dataset(id_, community, challenge, participant, metric['name'], metric['value'],
-                                              metric.get('stderr', 0)))
+                                              metric.get('stderr', 0), validate=False, extra=extra))
+    stubs = validate_many(stubs)
     with auto_open(fn, 'wt') as fout:
         json.dump(stubs, fout, sort_keys=True, indent=4, separators=(',', ': '))
 
@@ -133,6 +216,7 @@ if __name__ == "__main__":
     parser.add_argument('--com', required=True, help="community id")
     parser.add_argument('--vgnc-orthologs', required=True, help="Path to text file with VGNC asserted orthologs")
     parser.add_argument('--participant', required=True, help="Name of participant method")
+    benchmark_stats.add_bootstrap_arguments(parser)
     parser.add_argument('--log', help="Path to log file. Defaults to stderr")
     parser.add_argument('-d', '--debug', action="store_true", help="Set logging to debug level")
     conf = parser.parse_args()
@@ -145,12 +229,10 @@ if __name__ == "__main__":
     logging.basicConfig(**log_conf)
     logger.info("running vgnc_benchmark with following arguments: {}".format(conf))
 
+    perf.start("vgnc_benchmark", os.path.dirname(os.path.abspath(conf.assessment_out)))
     os.makedirs(conf.outdir, exist_ok=True)
-    outfn_path = os.path.join(conf.outdir,
-                              "VGNC_{}_raw.txt.gz".format(conf.participant.replace(' ', '-').replace('_', '-'))
-                              )
-    vgnc_orthologs = get_vgnc_orthologs(conf.vgnc_orthologs)
-
-    with auto_open(outfn_path, 'wt') as raw_out_fh:
-        res = compute_vgnc_benchmark(vgnc_orthologs, conf.db, raw_out_fh)
-    write_assessment_json_stub(conf.assessment_out, conf.com, conf.participant, res)
+    outfn_path = raw_output_fname(conf.outdir, conf.participant)
+    with perf.phase("reference load"):
+        vgnc_orthologs = get_vgnc_orthologs(conf.vgnc_orthologs)
+    run_benchmark(vgnc_orthologs, conf.db, outfn_path, conf.assessment_out, conf.com, conf.participant,
+                  bootstrap=benchmark_stats.bootstrap_from_args(conf))